@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+"""A recursive DNS server on an asyncio event loop
+
+This module provides a server engine that handles every query on a single
+event loop instead of handing it to a worker thread. Queries that are answered
+from the response cache, the zone or the CH class counters are answered right
+away. Queries that need a recursive lookup are resolved on the loop as well,
+with Resolver.async_gethostbyname, so thousands of them can be in progress
+while the loop keeps receiving queries.
+
+The server also accepts queries over TCP on the same port.
+
+The delay before the loop starts a lookup is the queueing delay used for
+admission control. The number of recursive lookups in progress is bounded by
+the queue depth of the server. Queries beyond that are dropped or answered
+with SERVFAIL, just as with the threaded server.
+"""
+
+import asyncio
+import struct
+import time
+
+from dns.server import DRAIN_TIMEOUT, RequestHandler, Server, TCP_TIMEOUT
+
+
+class ServerProtocol(asyncio.DatagramProtocol):
+    """Handles the datagrams received by an AsyncServer"""
+
+    def __init__(self, server):
+        """Initialize the protocol
+
+        Args:
+            server (AsyncServer): the server, which provides the zone, the
+                caches, the resolver and the counters
+        """
+        self.server = server
+        self.transport = None
+        self.pending = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.server.limiter is not None and self.server.limited(
+                RequestHandler(data, addr, self.server.zone, self.transport,
+                               self.server)):
+            return
+        self.handle(data, addr, self.transport)
+
+    def handle(self, data, addr, sock, tcp=False):
+        """Handle a query
+
+        Args:
+            data (bytes): the query
+            addr ((str, int)): address of the client
+            sock (object): object with a sendto method for the response
+            tcp (bool): the query was received over TCP
+
+        Returns:
+            Future: the recursive lookup for the query, or None if the query
+                has been answered or dropped
+        """
+        handler = RequestHandler(data, addr, self.server.zone, sock,
+                                 self.server,
+                                 tcp=tcp)
+        try:
+            msg = handler.prepare()
+            question = handler.local(msg) if msg is not None else None
+            if question is not None and not handler.admit(msg, question):
+                question = None
+        except Exception:
+            self.server.stats["errors"] += 1
+            handler.servfail()
+            return None
+        if question is None:
+            return None
+        if len(self.pending) >= self.server.queue_depth:
+            self.server.stats["overload"] += 1
+            if self.server.overload == "servfail":
+                handler.servfail()
+            return None
+        task = asyncio.ensure_future(self.recurse(handler, msg, question,
+                                                  time.monotonic()))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+        return task
+
+    async def recurse(self, handler, msg, question, queued):
+        """Answer a question with a recursive lookup
+
+        Args:
+            handler (RequestHandler): handler for the query
+            msg (Message): the query
+            question (Question): the question to look up
+            queued (float): time the lookup was queued on the loop
+        """
+        self.server.admission.record(queued)
+        try:
+            result = await self.server.resolver.async_gethostbyname(
+                question.qname)
+            handler.recursive(msg, question, result)
+        except Exception:
+            self.server.stats["errors"] += 1
+            handler.servfail()
+
+
+class StreamProtocol(asyncio.Protocol):
+    """Handles a connection over TCP to an AsyncServer
+
+    Queries on the connection are handled as they arrive and responses are
+    written in the order they are ready. The connection is closed when the
+    client closed its side, or was idle for TCP_TIMEOUT seconds, and all its
+    queries have been answered. See RFC 7766.
+    """
+
+    def __init__(self, queries):
+        """Initialize the protocol
+
+        Args:
+            queries (ServerProtocol): the protocol that handles the queries
+        """
+        self.queries = queries
+        self.transport = None
+        self.addr = None
+        self.buffer = bytearray()
+        self.pending = set()
+        self.eof = False
+        self.timer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info("peername")
+        self.queries.server.stats["tcp_connections"] += 1
+        self.restart_timer()
+
+    def connection_lost(self, exc):
+        if self.timer is not None:
+            self.timer.cancel()
+
+    def restart_timer(self):
+        """Close the connection if it stays idle for TCP_TIMEOUT seconds"""
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = asyncio.get_running_loop().call_later(
+            TCP_TIMEOUT, self.idle)
+
+    def idle(self):
+        """Close the idle connection, or wait for its queries"""
+        self.eof = True
+        if not self.pending:
+            self.transport.close()
+
+    def data_received(self, data):
+        self.buffer += data
+        self.restart_timer()
+        while len(self.buffer) >= 2:
+            length = struct.unpack_from("!H", self.buffer)[0]
+            if len(self.buffer) < 2 + length:
+                break
+            query = bytes(self.buffer[2:2 + length])
+            del self.buffer[:2 + length]
+            self.queries.server.stats["tcp_queries"] += 1
+            task = self.queries.handle(query, self.addr, self, tcp=True)
+            if task is not None:
+                self.pending.add(task)
+                task.add_done_callback(self.finished)
+
+    def eof_received(self):
+        self.eof = True
+        if self.pending:
+            return True
+        return False
+
+    def finished(self, task):
+        """Close the connection once the last query has been answered"""
+        self.pending.discard(task)
+        if self.eof and not self.pending:
+            self.transport.close()
+
+    def sendto(self, data, addr):
+        """Write a response to the client
+
+        Args:
+            data (bytes): the encoded response
+            addr ((str, int)): ignored, responses go to the connected client
+        """
+        if not self.transport.is_closing():
+            self.transport.write(struct.pack("!H", len(data)) + bytes(data))
+
+
+class AsyncServer(Server):
+    """A recursive DNS server on an asyncio event loop"""
+
+    def __init__(self, *args, **kwargs):
+        """Initialize the server, see Server for the arguments"""
+        super().__init__(*args, **kwargs)
+        self.loop = None
+        self.stopped = None
+        self.address = None
+
+    def serve(self):
+        """Serve requests until the server is shut down
+
+        Lookups that are in progress at the shutdown are still answered, for
+        up to DRAIN_TIMEOUT seconds.
+        """
+        self.setup()
+        try:
+            asyncio.run(self.run())
+        finally:
+            self.finish()
+
+    async def run(self):
+        """Serve requests until the server is shut down"""
+        self.loop = asyncio.get_running_loop()
+        self.stopped = self.loop.create_future()
+        transport, protocol = await self.loop.create_datagram_endpoint(
+            lambda: ServerProtocol(self),
+            local_addr=("127.0.0.1", self.port),
+            reuse_port=self.reuse_port or None)
+        self.address = transport.get_extra_info("sockname")
+        listener = await self.loop.create_server(
+            lambda: StreamProtocol(protocol), "127.0.0.1", self.address[1],
+            reuse_port=self.reuse_port or None)
+        try:
+            await self.stopped
+            listener.close()
+            if protocol.pending:
+                _, pending = await asyncio.wait(list(protocol.pending),
+                                                timeout=DRAIN_TIMEOUT)
+                if pending:
+                    self.stats["drain_timeouts"] += 1
+        finally:
+            listener.close()
+            transport.close()
+
+    def shutdown(self):
+        """Shut the server down, can be called from a signal handler"""
+        super().shutdown()
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._stop)
+
+    def _stop(self):
+        """Stop serving, runs on the event loop"""
+        if not self.stopped.done():
+            self.stopped.set_result(None)
@@ -2,77 +2,581 @@
 
 """A cache for resource records
 
-This module contains a class which implements a cache for DNS resource records,
-you still have to do most of the implementation. The module also provides a
-class and a function for converting ResourceRecords from and to JSON strings.
-It is highly recommended to use these.
+This module contains a class which implements a cache for DNS resource records.
+The cache lives in memory, indexed by (name, type, class), and is written to
+disk by a background snapshot thread instead of on every change. Snapshots
+use the binary format of dns.snapshot and are memory mapped when the cache is
+loaded; entries are only decoded and moved into memory when they are looked up.
+
+Every record is stored with an absolute expiry time. Expired records are
+removed through a heap ordered by expiry time and, when the cache is full, the
+least recently used entries are evicted, so neither needs a scan of the cache.
+
+Besides records the cache holds negative answers (NXDOMAIN and NODATA), which
+are kept for the lifetime given by the SOA record of the zone. See RFC 2308.
+
+Entries that are hit often are refreshed ahead of time: when such an entry is
+looked up after most of its TTL has passed, it is queued for re-resolution by a
+background thread, so clients keep getting cache hits.
+
+Optionally, expired records are kept for a while longer, so they can be served
+when the upstream servers can not be reached in time. See RFC 8767.
+
+The cache is split into shards by the hash of the domain name. Each shard has
+its own lock, which is taken to change the shard, including moving an entry
+that was looked up to the end of the LRU order. Reading an entry does not
+lock, and threads using different shards do not wait for each other.
+
+Other tables of the resolver, such as the round trip times of name servers,
+can be attached to the cache. They are read and written together with the
+snapshot, each in a file of its own next to it.
 """
 
 
+import heapq
 import json
+import struct
+import time
+from collections import Counter, OrderedDict
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
 
+from dns.rcodes import RCode
 from dns.resource import ResourceRecord
+from dns.snapshot import Snapshot, SnapshotWriter, NEGATIVE
 from dns.types import Type
 
 
+STALE_TTL = 30
+PREFETCH_TIMEOUT = 1
+
+def normalize(dname):
+    """Return the lowercased, fully qualified form of a domain name.
+
+    Args:
+        dname (str/Name): domain name
+    """
+    name = str(dname).lower()
+    if not name.endswith("."):
+        name += "."
+    return name
+
+
+class CacheEntry:
+    """Cached records for a single (name, type, class) key
+
+    An entry holds either records or a negative answer, which is stored as a
+    tuple (expires, rcode, soa). The entry also keeps the lifetime it was
+    stored with and the number of hits since, which decide when it is
+    prefetched.
+    """
+
+    __slots__ = ("records", "negative", "ttl", "hits", "prefetching",
+                 "prefetched")
+
+    def __init__(self):
+        """Initialize an empty entry"""
+        self.records = []
+        self.negative = None
+        self.ttl = 0
+        self.hits = 0
+        self.prefetching = False
+        self.prefetched = False
+
+    def remaining(self, now):
+        """Return copies of the live records with their TTL decremented
+
+        Args:
+            now (float): current time
+        """
+        return [ResourceRecord(record.name, record.type_, record.class_,
+                               int(expires - now), record.rdata)
+                for expires, record in self.records if expires > now]
+
+    def expired(self, now, cutoff):
+        """Return copies of the expired records with a TTL of STALE_TTL
+
+        Args:
+            now (float): current time
+            cutoff (float): records that expired before this are ignored
+        """
+        return [ResourceRecord(record.name, record.type_, record.class_,
+                               STALE_TTL, record.rdata)
+                for expires, record in self.records
+                if cutoff < expires <= now]
+
+    def purge(self, now):
+        """Drop the expired records, return True if the entry is now empty
+
+        Args:
+            now (float): current time
+        """
+        self.records = [(expires, record) for expires, record in self.records
+                        if expires > now]
+        if self.negative is not None and self.negative[0] <= now:
+            self.negative = None
+        return not self.records and self.negative is None
+
+
+class CacheShard:
+    """A part of the cache with its own lock, expiry heap and LRU order"""
+
+    def __init__(self, max_entries):
+        """Initialize an empty shard
+
+        Args:
+            max_entries (int): maximum number of entries in this shard
+        """
+        self.records = OrderedDict()
+        self.expiry = []
+        self.lock = Lock()
+        self.max_entries = max_entries
+
+    def entry(self, key):
+        """Return the entry for key, creating it if needed
+
+        Must be called with the lock held.
+        """
+        entry = self.records.get(key)
+        if entry is None:
+            entry = self.records[key] = CacheEntry()
+        else:
+            self.records.move_to_end(key)
+        return entry
+
+    def touch(self, key):
+        """Mark an entry as recently used
+
+        The lock is taken, because eviction and snapshots iterate over the
+        records and moving an entry while they do so is an error.
+        """
+        with self.lock:
+            try:
+                self.records.move_to_end(key)
+            except KeyError:
+                pass
+
+    def evict(self, now, cutoff, stats):
+        """Remove expired entries and enforce the size limit
+
+        Must be called with the lock held.
+
+        Args:
+            now (float): current time
+            cutoff (float): records that expired before this are removed
+            stats (Counter): counters of the cache
+        """
+        while self.expiry and self.expiry[0][0] <= cutoff:
+            _, key = heapq.heappop(self.expiry)
+            entry = self.records.get(key)
+            if entry is not None and entry.purge(cutoff):
+                del self.records[key]
+                stats["expired"] += 1
+        while len(self.records) > self.max_entries:
+            self.records.popitem(last=False)
+            stats["evictions"] += 1
+        if len(self.expiry) > 4 * len(self.records) + 64:
+            self.expiry = [(expires, key)
+                           for key, entry in self.records.items()
+                           for expires, _ in entry.records]
+            self.expiry.extend((entry.negative[0], key)
+                               for key, entry in self.records.items()
+                               if entry.negative is not None)
+            heapq.heapify(self.expiry)
+
+
 class RecordCache:
     """Cache for ResourceRecords"""
 
-    def __init__(self, ttl):
+    def __init__(self, ttl, filename="cache", interval=60, max_entries=10000,
+                 prefetch=0.1, prefetch_hits=3, prefetch_queue=100, stale=0,
+                 shards=16):
         """Initialize the RecordCache
 
         Args:
-            ttl (int): TTL of cached entries (if > 0)
+            ttl (int): TTL of cached entries (if > 0), overrides record TTLs
+            filename (str): file used for snapshots of the cache
+            interval (int): seconds between background snapshots
+            max_entries (int): maximum number of (name, type, class) entries
+            prefetch (float): fraction of the original TTL below which a
+                popular entry is refreshed
+            prefetch_hits (int): hits after which an entry is popular
+            prefetch_queue (int): maximum number of queued prefetches
+            stale (int): seconds that expired records are kept to be served
+                stale, 0 disables serving stale records
+            shards (int): number of independently locked parts of the cache
         """
-        self.records = []
+        shards = max(1, min(shards, max_entries))
+        self.shards = [CacheShard(-(-max_entries // shards))
+                       for _ in range(shards)]
         self.ttl = ttl
+        self.max_entries = max_entries
+        self.filename = filename
+        self.snapshot = None
+        self.interval = interval
+        self.dirty = False
+        self.stopped = Event()
+        self.snapshotter = None
+        self.prefetch = prefetch
+        self.prefetch_hits = prefetch_hits
+        self.prefetch_queue = Queue(prefetch_queue)
+        self.prefetcher = None
+        self.refresh = None
+        self.stats = Counter()
+        self.stale = stale
+        self.attachments = []
 
     def lookup(self, dname, type_, class_):
         """Lookup resource records in cache
 
         Lookup for the resource records for a domain name with a specific type
-        and class.
+        and class. This never touches the cache file.
 
         Args:
             dname (str): domain name
             type_ (Type): type
             class_ (Class): class
         """
+        name = normalize(dname)
+        now = time.time()
+        if type_ != Type.ANY:
+            found = self._lookup_key((name, type_, class_), now)
+        else:
+            found = []
+            for rtype in Type:
+                found.extend(self._lookup_key((name, rtype, class_), now))
+        self.stats["hits" if found else "misses"] += 1
+        return found
+
+    def _shard(self, key):
+        """Return the shard that holds key"""
+        return self.shards[hash(key[0]) % len(self.shards)]
+
+    def _get(self, key):
+        """Return the entry for key from memory or from the snapshot"""
+        entry = self._shard(key).records.get(key)
+        if entry is None and self.snapshot is not None:
+            entry = self._promote(key)
+        return entry
+
+    def _promote(self, key):
+        """Move the entries for key from the snapshot into memory"""
+        snapshot = self.snapshot
+        try:
+            found = snapshot.find(key)
+        except (ValueError, struct.error):
+            print("could not read cache snapshot")
+            self.snapshot = None
+            return None
+        now = time.time()
+        found = [item for item in found if item[0] > now - self.stale]
+        if not found:
+            return None
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.records.get(key)
+            if entry is not None:
+                return entry
+            entry = shard.records[key] = CacheEntry()
+            entry.ttl = max(item[0] for item in found) - now
+            for expires, kind, value in found:
+                if kind == NEGATIVE:
+                    entry.negative = (expires,) + value
+                else:
+                    entry.records.append((expires, value))
+                heapq.heappush(shard.expiry, (expires, key))
+            shard.evict(now, now - self.stale, self.stats)
+        return entry
+
+    def _lookup_key(self, key, now):
+        """Return the live records for key and mark the entry as used"""
+        entry = self._get(key)
+        if entry is None:
+            return []
+        found = entry.remaining(now)
+        if found:
+            self._shard(key).touch(key)
+            entry.hits += 1
+            if entry.prefetched:
+                entry.prefetched = False
+                self.stats["prefetch_useful"] += 1
+            if (self.refresh is not None and not entry.prefetching and
+                    entry.hits >= self.prefetch_hits and
+                    max(rr.ttl for rr in found) < self.prefetch * entry.ttl):
+                self._queue_prefetch(key, entry)
+        return found
+
+    def lookup_stale(self, dname, type_, class_):
+        """Lookup expired records that are kept to be served stale
+
+        Args:
+            dname (str): domain name
+            type_ (Type): type
+            class_ (Class): class
+
+        Returns:
+            [ResourceRecord]: the expired records with a TTL of STALE_TTL
+        """
+        if self.stale <= 0:
+            return []
+        name = normalize(dname)
+        now = time.time()
+        types = list(Type) if type_ == Type.ANY else [type_]
         found = []
-        self.read_cache_file()
-        for record in self.records:
-            print("UGH")
-            if str(dname) == str(record.name) and (type_ == record.type_ or type_ == Type.ANY) and class_ == record.class_:
-                if record not in found:
-                    found.append(record)
+        for rtype in types:
+            entry = self._get((name, rtype, class_))
+            if entry is not None:
+                found.extend(entry.expired(now, now - self.stale))
+        if found:
+            self.stats["stale_hits"] += 1
         return found
 
-    def add_record(self, record):
+    def _queue_prefetch(self, key, entry):
+        """Queue a popular entry for re-resolution"""
+        entry.prefetching = True
+        try:
+            self.prefetch_queue.put_nowait(key)
+        except Full:
+            entry.prefetching = False
+            self.stats["prefetch_dropped"] += 1
+
+    def add_record(self, record, expires=None):
         """Add a new Record to the cache
 
+        Records with a TTL of zero or less are not cached.
+
         Args:
             record (ResourceRecord): the record added to the cache
+            expires (float): absolute expiry time, computed from the TTL if
+                None
         """
-        self.read_cache_file()
-        self.records.append(record)
-        self.write_cache_file()
+        now = time.time()
+        if expires is None:
+            ttl = self.ttl if self.ttl > 0 else record.ttl
+            expires = now + ttl
+        if expires <= now:
+            return
+        key = (normalize(record.name), record.type_, record.class_)
+        rdata = record.rdata.to_dict()
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entry(key)
+            entry.negative = None
+            entry.ttl = expires - now
+            entry.hits = 0
+            records = [(exp, cached) for exp, cached in entry.records
+                       if cached.rdata.to_dict() != rdata]
+            records.append((expires, record))
+            entry.records = records
+            heapq.heappush(shard.expiry, (expires, key))
+            shard.evict(now, now - self.stale, self.stats)
+            self.dirty = True
+
+    def lookup_negative(self, dname, type_, class_):
+        """Lookup a cached negative answer
+
+        Args:
+            dname (str): domain name
+            type_ (Type): type
+            class_ (Class): class
+
+        Returns:
+            (RCode, ResourceRecord): the rcode (NXDomain or NoError for NODATA)
+                and the SOA record with its TTL decremented, or None
+        """
+        entry = self._get((normalize(dname), type_, class_))
+        if entry is None:
+            return None
+        negative = entry.negative
+        now = time.time()
+        if negative is None or negative[0] <= now:
+            return None
+        self.stats["negative_hits"] += 1
+        expires, rcode, soa = negative
+        return rcode, ResourceRecord(soa.name, soa.type_, soa.class_,
+                                     int(expires - now), soa.rdata)
+
+    def add_negative(self, dname, type_, class_, rcode, soa, expires=None):
+        """Add a negative answer to the cache
+
+        The lifetime is the minimum of the TTL of the SOA record and its
+        MINIMUM field, see section 5 of RFC 2308.
+
+        Args:
+            dname (str): domain name that was queried
+            type_ (Type): type that was queried
+            class_ (Class): class that was queried
+            rcode (RCode): NXDomain, or NoError for a NODATA answer
+            soa (ResourceRecord): SOA record from the authority section
+            expires (float): absolute expiry time, computed from the SOA if
+                None
+        """
+        now = time.time()
+        if expires is None:
+            expires = now + min(soa.ttl, soa.rdata.minimum)
+        if expires <= now:
+            return
+        key = (normalize(dname), type_, class_)
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entry(key)
+            entry.records = []
+            entry.negative = (expires, RCode(rcode), soa)
+            entry.ttl = expires - now
+            heapq.heappush(shard.expiry, (expires, key))
+            shard.evict(now, now - self.stale, self.stats)
+            self.dirty = True
+
+    def expire(self):
+        """Remove all expired entries from the cache"""
+        now = time.time()
+        for shard in self.shards:
+            with shard.lock:
+                shard.evict(now, now - self.stale, self.stats)
+
+    def __len__(self):
+        return sum(len(shard.records) for shard in self.shards)
+
+    def attach(self, suffix, table):
+        """Keep a table in a file next to the snapshot
+
+        Args:
+            suffix (str): appended to the name of the snapshot file
+            table (object): has read_file and write_file methods, which are
+                called with the name of its file
+        """
+        self.attachments.append((suffix, table))
 
     def read_cache_file(self):
-        """Read the cache file from disk"""
+        """Map the cache snapshot into memory
+
+        Cache files in the old JSON format are imported into memory instead.
+        """
+        for suffix, table in self.attachments:
+            table.read_file(self.filename + suffix)
+        try:
+            self.snapshot = Snapshot.open(self.filename)
+        except OSError:
+            print("could not read cache")
+        except ValueError:
+            self._read_json()
+
+    def _read_json(self):
+        """Import a cache file in the old JSON format"""
         dcts = []
         try:
-            with open("cache", "r") as file_:
+            with open(self.filename, "r") as file_:
                 dcts = json.load(file_)
-        except:
+        except (OSError, ValueError):
             print("could not read cache")
-        self.records = [ResourceRecord.from_dict(dct) for dct in dcts]
+        for dct in dcts:
+            self.add_record(ResourceRecord.from_dict(dct), dct.get("expires"))
 
     def write_cache_file(self):
-        """Write the cache file to disk"""
-        print("We're caching")
-        dcts = [record.to_dict() for record in self.records]
+        """Write a snapshot of the cache to disk
+
+        Entries of the previous snapshot that were never looked up are copied
+        over without decoding them.
+        """
+        now = time.time()
+        writer = SnapshotWriter()
+        entries = []
+        self.dirty = False
+        for suffix, table in self.attachments:
+            table.write_file(self.filename + suffix)
+        for shard in self.shards:
+            with shard.lock:
+                shard.evict(now, now - self.stale, self.stats)
+                entries.extend((key, entry.records, entry.negative)
+                               for key, entry in shard.records.items())
+        keys = set()
+        for key, records, negative in entries:
+            keys.add(key)
+            for expires, record in records:
+                writer.add_record(key, expires, record)
+            if negative is not None:
+                writer.add_negative(key, *negative)
         try:
-            with open("cache", "w") as file_:
-                json.dump(dcts, file_, indent=2)
-        except:
+            if self.snapshot is not None:
+                for key, expires, kind, payload in self.snapshot:
+                    if key not in keys and expires > now - self.stale:
+                        writer.add_raw(key, expires, kind, payload)
+            writer.write(self.filename)
+            self.snapshot = Snapshot.open(self.filename)
+        except (OSError, ValueError, struct.error):
             print("could not write cache")
+
+    def start(self, refresh=None):
+        """Load the cache file and start the background threads
+
+        Args:
+            refresh (callable): called with (dname, type_, class_) to resolve
+                a popular entry again before it expires, entries are not
+                prefetched if None
+        """
+        self.read_cache_file()
+        self.stopped.clear()
+        self.snapshotter = Thread(target=self._snapshot_loop, daemon=True)
+        self.snapshotter.start()
+        self.refresh = refresh
+        if refresh is not None:
+            self.prefetcher = Thread(target=self._prefetch_loop,
+                                     args=(refresh,), daemon=True)
+            self.prefetcher.start()
+
+    def shutdown(self):
+        """Stop the background threads and write a final snapshot
+
+        Queued prefetches are dropped. A prefetch in progress is waited for
+        up to PREFETCH_TIMEOUT seconds, then left to finish in the
+        background.
+        """
+        self.stopped.set()
+        if self.snapshotter is not None:
+            self.snapshotter.join()
+            self.snapshotter = None
+        self.refresh = None
+        if self.prefetcher is not None:
+            while True:
+                try:
+                    key = self.prefetch_queue.get_nowait()
+                except Empty:
+                    break
+                if key is not None:
+                    self._prefetched(key, False)
+            try:
+                self.prefetch_queue.put_nowait(None)
+            except Full:
+                pass
+            self.prefetcher.join(PREFETCH_TIMEOUT)
+            self.prefetcher = None
+        self.write_cache_file()
+
+    def _prefetch_loop(self, refresh):
+        """Resolve queued entries again until shutdown"""
+        while not self.stopped.is_set():
+            key = self.prefetch_queue.get()
+            if key is None or self.stopped.is_set():
+                break
+            self.stats["prefetches"] += 1
+            try:
+                refresh(*key)
+                refreshed = True
+            except Exception:
+                self.stats["prefetch_failed"] += 1
+                refreshed = False
+            self._prefetched(key, refreshed)
+
+    def _prefetched(self, key, refreshed):
+        """Mark a queued prefetch as done"""
+        entry = self._shard(key).records.get(key)
+        if entry is not None:
+            entry.prefetching = False
+            entry.prefetched = refreshed
+
+    def _snapshot_loop(self):
+        """Periodically write the cache to disk if it changed"""
+        while not self.stopped.wait(self.interval):
+            self.expire()
+            if self.dirty:
+                self.write_cache_file()
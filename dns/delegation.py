@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""A cache of zone cuts
+
+The resolver remembers the delegations it learns from referrals: the name
+servers of a zone and the addresses of those servers from the glue of the
+referral. A lookup can then start at the servers of the closest enclosing zone
+that is known, instead of at a root server. This is the SLIST of section 5.3.3
+of RFC 1034.
+
+Name servers and their addresses expire with the TTLs of their records. A new
+referral for a zone replaces what was known about it.
+
+A referral is only believed for a zone strictly below the zone of the server
+that sent it, and only glue inside the new zone is kept. A server can thus
+not take over its parent or a sibling zone.
+"""
+
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from dns.cache import normalize
+from dns.types import Type
+
+
+def within(name, zone):
+    """Return True if a normalized name is zone or below it"""
+    return zone == "." or name == zone or name.endswith("." + zone)
+
+
+def referral_cut(name, zone, authorities):
+    """Return the zone a referral delegates to
+
+    Args:
+        name (str): the name that was looked up
+        zone (str): the zone of the server that sent the referral
+        authorities ([ResourceRecord]): authority section of the referral
+
+    Returns:
+        str: normalized name of the first zone with NS records that contains
+            name and is strictly below zone, or None if there is none
+    """
+    name = normalize(name)
+    zone = normalize(zone)
+    for record in authorities:
+        if record.type_ != Type.NS:
+            continue
+        cut = normalize(record.name)
+        if cut != zone and within(cut, zone) and within(name, cut):
+            return cut
+    return None
+
+
+class Delegation:
+    """The name servers of a zone"""
+
+    def __init__(self, zone):
+        """Initialize the delegation
+
+        Args:
+            zone (str): normalized name of the zone
+        """
+        self.zone = zone
+        self.servers = {}
+        self.addresses = {}
+
+    def add_server(self, nsname, expires):
+        """Add a name server, which is kept until expires"""
+        self.servers[nsname] = max(expires, self.servers.get(nsname, 0))
+
+    def add_address(self, nsname, address, expires):
+        """Add an address of a name server, which is kept until expires"""
+        addresses = self.addresses.setdefault(nsname, {})
+        addresses[address] = max(expires, addresses.get(address, 0))
+
+    def lookup(self, now):
+        """Return the addresses of the name servers that have not expired
+
+        Args:
+            now (float): current time
+
+        Returns:
+            [str]: addresses of the name servers
+        """
+        result = []
+        for nsname, expires in self.servers.items():
+            if expires <= now:
+                continue
+            for address, address_expires in \
+                    self.addresses.get(nsname, {}).items():
+                if address_expires > now and address not in result:
+                    result.append(address)
+        return result
+
+    def expires(self):
+        """Return the time the last name server expires"""
+        return max(self.servers.values(), default=0)
+
+
+class DelegationCache:
+    """Cache of the name servers of zones"""
+
+    def __init__(self, max_entries=10000):
+        """Initialize the DelegationCache
+
+        Args:
+            max_entries (int): maximum number of cached zones
+        """
+        self.zones = OrderedDict()
+        self.max_entries = max_entries
+        self.lock = Lock()
+
+    def add_referral(self, name, zone, authorities, additionals):
+        """Remember the delegation in a referral
+
+        Only NS records for a zone that contains name and is strictly below
+        zone are used, and only glue for the name servers of that zone which
+        is inside it.
+
+        Args:
+            name (str): the name that was looked up
+            zone (str): the zone of the server that sent the referral
+            authorities ([ResourceRecord]): authority section of the response
+            additionals ([ResourceRecord]): additional section of the response
+
+        Returns:
+            str: the zone of the delegation, or None if there is none
+        """
+        cut = referral_cut(name, zone, authorities)
+        if cut is None:
+            return None
+        now = time.time()
+        delegation = Delegation(cut)
+        for record in authorities:
+            if record.type_ == Type.NS and normalize(record.name) == cut:
+                delegation.add_server(normalize(record.rdata.nsdname),
+                                      now + record.ttl)
+        for record in additionals:
+            nsname = normalize(record.name)
+            if (record.type_ == Type.A and nsname in delegation.servers and
+                    within(nsname, cut)):
+                delegation.add_address(nsname, record.rdata.address,
+                                       now + record.ttl)
+        with self.lock:
+            self.zones[delegation.zone] = delegation
+            self.zones.move_to_end(delegation.zone)
+            while len(self.zones) > self.max_entries:
+                self.zones.popitem(last=False)
+        return delegation.zone
+
+    def lookup(self, name):
+        """Return the closest enclosing zone of a name with known servers
+
+        Args:
+            name (str): domain name
+
+        Returns:
+            (str, [str]): the zone and the addresses of its name servers, or
+                None if no enclosing zone is known
+        """
+        name = normalize(name)
+        now = time.time()
+        while True:
+            delegation = self.zones.get(name)
+            if delegation is not None:
+                addresses = delegation.lookup(now)
+                if addresses:
+                    return delegation.zone, addresses
+                if delegation.expires() <= now:
+                    self.remove(delegation)
+            if name == ".":
+                return None
+            name = name.split(".", 1)[1] or "."
+
+    def remove(self, delegation):
+        """Forget an expired delegation"""
+        with self.lock:
+            if self.zones.get(delegation.zone) is delegation:
+                del self.zones[delegation.zone]
+
+    def __len__(self):
+        return len(self.zones)
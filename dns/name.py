@@ -70,7 +70,7 @@ class Name:
                 offset += 1
                 blabel = packet[offset:offset + label_length]
                 if blabel:
-                    labels.append(blabel.decode("utf-8"))
+                    labels.append(str(blabel, "utf-8"))
                 offset += label_length
                 if hops == 0:
                     next_offset = offset
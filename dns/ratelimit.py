@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+"""Response rate limiting
+
+This module limits how many responses a client network gets. Clients are
+grouped by their /24 for IPv4 and their /56 for IPv6. Every network has a
+token bucket that fills with NETWORK_FACTOR times rate tokens per second, and
+every (network, question) pair has one that fills with rate tokens per second.
+A query is only answered when both buckets have a token. The bucket of the
+network caps a client that asks for a different random name every time, so
+it can not empty the buckets of everyone else. A query that is not answered
+does not take a token from the bucket of its network. Every slip-th of those
+gets a truncated response instead, so a real client behind a flooded network
+can still ask again over TCP.
+
+The buckets live in fixed-size tables of arrays indexed by the hash of the
+key, so there are no objects per client. Two keys that hash to the same slot
+share its bucket, a key never gets a full bucket by taking a slot over. The
+tables are not locked, they are only used by the thread or event loop that
+receives the queries over UDP.
+"""
+
+import socket
+import time
+from array import array
+
+from dns.responsecache import skip_name
+
+
+ALLOW = 0
+DROP = 1
+SLIP = 2
+NETWORK_FACTOR = 8
+
+
+def prefix(addr):
+    """Return the network part of a client address
+
+    Args:
+        addr ((str, int)): address of the client
+
+    Returns:
+        bytes: the first 3 bytes of an IPv4 address or 7 bytes of IPv6
+    """
+    host = addr[0]
+    if ":" in host:
+        return socket.inet_pton(socket.AF_INET6, host.split("%")[0])[:7]
+    return socket.inet_aton(host)[:3]
+
+
+def question(data):
+    """Return the question of a query with the name in lower case
+
+    Args:
+        data (bytes): the query
+
+    Returns:
+        bytes: the question, or an empty string if it can not be found
+    """
+    try:
+        end = skip_name(data, 12)
+    except IndexError:
+        return b""
+    return bytes(data[12:end]).lower() + bytes(data[end:end + 4])
+
+
+class Buckets:
+    """A fixed-size table of token buckets"""
+
+    def __init__(self, size, rate, burst):
+        """Initialize the table with full buckets
+
+        Args:
+            size (int): number of buckets
+            rate (float): tokens added to a bucket per second
+            burst (float): size of a bucket
+        """
+        self.size = size
+        self.rate = rate
+        self.burst = burst
+        self.tokens = array("d", bytes(8 * size))
+        self.updated = array("d", bytes(8 * size))
+
+    def fill(self, key, now):
+        """Add the tokens since the last update to the bucket of a key
+
+        Args:
+            key (int): hash of the key
+            now (float): current time
+
+        Returns:
+            int: index of the bucket
+        """
+        index = key % self.size
+        elapsed = now - self.updated[index]
+        self.tokens[index] = min(self.burst,
+                                 self.tokens[index] + elapsed * self.rate)
+        self.updated[index] = now
+        return index
+
+
+class RateLimiter:
+    """Token buckets per client network and question"""
+
+    def __init__(self, rate, burst=None, size=65536, slip=2):
+        """Initialize the RateLimiter
+
+        Args:
+            rate (float): responses per second for one question
+            burst (float): size of a bucket of a question, rate if None
+            size (int): number of buckets in each table
+            slip (int): send a truncated response for every slip-th limited
+                query, 0 to drop all of them
+        """
+        burst = burst if burst is not None else rate
+        self.slip = slip
+        self.questions = Buckets(size, rate, burst)
+        self.networks = Buckets(size, NETWORK_FACTOR * rate,
+                                NETWORK_FACTOR * burst)
+        self.limited = 0
+
+    def check(self, addr, data):
+        """Take a token for a query
+
+        Args:
+            addr ((str, int)): address of the client
+            data (bytes): the query
+
+        Returns:
+            int: ALLOW if the query may be answered, otherwise DROP or SLIP
+        """
+        network = prefix(addr)
+        now = time.monotonic()
+        net = self.networks.fill(hash(network), now)
+        if self.networks.tokens[net] >= 1:
+            index = self.questions.fill(hash(network + question(data)), now)
+            if self.questions.tokens[index] >= 1:
+                self.questions.tokens[index] -= 1
+                self.networks.tokens[net] -= 1
+                return ALLOW
+        self.limited += 1
+        if self.slip and self.limited % self.slip == 0:
+            return SLIP
+        return DROP
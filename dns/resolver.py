@@ -5,104 +5,765 @@
 This module contains a class for resolving hostnames. You will have to implement
 things in this module. This resolver will be both used by the DNS client and the
 DNS server, but with a different list of servers.
+
+With caching enabled, the resolver remembers the zone cuts from the referrals
+it follows, see dns.delegation. Lookups start at the servers of the closest
+zone that is known, and only at a root server if there is none.
+
+The resolver measures the round trip times of the servers it asks, see
+dns.rtt, and asks the fastest of the servers of a zone first. The times are
+kept with the cache.
+
+With a stagger delay, the servers of a zone are raced: the query goes to the
+fastest server, and to the next one every time the stagger delay passes
+without a response. The first response wins and later ones are ignored.
+
+Queries over UDP go through a dns.transport.Transport, which keeps a pool of
+sockets on random ports and gives every query a random ID.
+
+Besides the blocking gethostbyname there is async_gethostbyname for asyncio.
+Both run the same resolution steps, which are written as a generator that
+yields the queries to send, see Resolver.iterate. They share the cache, the
+transport, the delegations and the round trip times, so one thread can run
+thousands of lookups at once. The addresses of name servers that come without
+glue are resolved by the same steps, never by the resolver of the system.
 """
 
 
+import asyncio
 import socket
+import time
+from collections import Counter
+from queue import Empty, Queue
+from threading import Lock, Thread
 
 from dns.classes import Class
 from dns.message import Message, Question, Header
 from dns.name import Name
+from dns.rcodes import RCode
 from dns.types import Type
 from dns.resource import ResourceRecord
-from dns.cache import RecordCache
+from dns.singleflight import Flight, SingleFlight
+from dns.cache import RecordCache, normalize
+from dns.delegation import DelegationCache, referral_cut, within
+from dns.rtt import RTTTable
+from dns.tcp import recv_message, send_message
+from dns.transport import LoopReplies, Transport, random_ident
+
+
+STALE_DEADLINE = 1.8
+STALE_RECHECK = 30
+ROOT_SERVER = "192.112.36.4"
+GLUELESS_DEPTH = 3
+ERROR_RCODES = (RCode.FormErr, RCode.ServFail, RCode.NotImp, RCode.Refused)
 
 class Resolver:
     """DNS resolver"""
 
-    def __init__(self, timeout, caching, ttl, rd):
+    def __init__(self, timeout, caching, ttl, rd, cache=None,
+                 stale_deadline=STALE_DEADLINE, stagger=0, transport=None):
         """Initialize the resolver
 
         Args:
             caching (bool): caching is enabled if True
             ttl (int): ttl of cache entries (if > 0)
+            cache (RecordCache): cache shared with other resolvers, a private
+                one is loaded from disk if None and caching is enabled
+            stale_deadline (float): seconds to wait for a refresh before a
+                stale answer is returned, if the cache keeps stale records
+            stagger (float): seconds to wait for a response before the next
+                server of a zone is asked as well, 0 asks one server at a time
+            transport (Transport): sockets shared with other resolvers, a
+                private one is used if None
         """
         self.timeout = timeout
         self.caching = caching
         self.ttl = ttl
         self.rd = rd
+        self.cache = cache
+        self.stale_deadline = stale_deadline
+        self.stagger = stagger
+        self.stats = Counter()
+        self.flights = SingleFlight(self.stats)
+        self.async_flights = {}
+        self.refreshes = {}
+        self.failed = {}
+        self.lock = Lock()
+        self.transport = transport
+        if self.transport is None:
+            self.transport = Transport(stats=self.stats)
+        self.servers = RTTTable()
+        self.delegations = None
+        if self.caching:
+            self.delegations = DelegationCache()
+        if self.caching and self.cache is None:
+            self.cache = RecordCache(ttl)
+            self.cache.attach(".rtt", self.servers)
+            self.cache.read_cache_file()
+        elif self.cache is not None:
+            self.cache.attach(".rtt", self.servers)
 
     def getnsaddr(self, nsname, additionals):
         for rr in additionals:
-            print(str(rr.name) + " " + str(nsname))
             if str(rr.name) == str(nsname) and rr.type_ == Type.A:
                 return rr.rdata.address
         return None
 
-    def gethostbyname(self, hostname, dnsserv='192.112.36.4'):
+    def send(self, query, dnsserv):
+        """Send a query to a server and return its response
+
+        Args:
+            query (Message): the query
+            dnsserv (str): address of the server
+
+        Returns:
+            Message: the response
+        """
+        return self.race(query, [dnsserv])[0]
+
+    def race(self, query, servers):
+        """Send a query to several servers and return the first response
+
+        The query is sent to the next server every stagger seconds until a
+        response arrives, or the timeout passes after the first one was sent.
+        The queries to the other servers are cancelled. A response with an
+        error rcode does not win, the next server is asked right away.
+
+        Args:
+            query (Message): the query
+            servers ([str]): addresses of the servers, best first
+
+        Returns:
+            (Message, str): the response and the address of the server that
+                sent it
+        """
+        data = query.to_bytes()
+        replies = Queue()
+        waiting = list(servers)
+        sent = []
+        start = time.monotonic()
+        deadline = start + self.timeout
+        next_send = start
+        try:
+            while True:
+                now = time.monotonic()
+                if waiting and now >= next_send:
+                    self.ask(data, waiting.pop(0), replies, sent)
+                    next_send = now + self.stagger
+                if now >= deadline:
+                    raise self.give_up(sent, now)
+                wait = min(next_send, deadline) if waiting else deadline
+                try:
+                    reply = replies.get(timeout=max(wait - now, 0.001))
+                except Empty:
+                    continue
+                response = self.accept(reply)
+                if response is not None:
+                    break
+                if waiting:
+                    next_send = now
+                elif all(pending.response is not None for pending in sent):
+                    raise self.rejected(sent)
+        finally:
+            for pending in sent:
+                self.transport.cancel(pending)
+        if response.header.tc:
+            self.stats["truncated"] += 1
+            response = self.send_tcp(query, reply.server)
+        return response, reply.server
+
+    async def async_race(self, query, servers):
+        """Send a query to several servers and return the first response
+
+        This is race for coroutines, it waits on the event loop instead of
+        blocking the thread.
+
+        Args:
+            query (Message): the query
+            servers ([str]): addresses of the servers, best first
+
+        Returns:
+            (Message, str): the response and the address of the server that
+                sent it
+        """
+        loop = asyncio.get_running_loop()
+        data = query.to_bytes()
+        replies = LoopReplies(loop)
+        waiting = [await self.async_address(loop, str(server))
+                   for server in servers]
+        sent = []
+        start = time.monotonic()
+        deadline = start + self.timeout
+        next_send = start
+        getter = asyncio.ensure_future(replies.get())
+        try:
+            while True:
+                now = time.monotonic()
+                if waiting and now >= next_send:
+                    self.ask(data, waiting.pop(0), replies, sent)
+                    next_send = now + self.stagger
+                if now >= deadline:
+                    raise self.give_up(sent, now)
+                wait = min(next_send, deadline) if waiting else deadline
+                await asyncio.wait({getter}, timeout=max(wait - now, 0.001))
+                if not getter.done():
+                    continue
+                reply = getter.result()
+                response = self.accept(reply)
+                if response is not None:
+                    break
+                getter = asyncio.ensure_future(replies.get())
+                if waiting:
+                    next_send = now
+                elif all(pending.response is not None for pending in sent):
+                    raise self.rejected(sent)
+        finally:
+            getter.cancel()
+            for pending in sent:
+                self.transport.cancel(pending)
+        if response.header.tc:
+            self.stats["truncated"] += 1
+            response = await loop.run_in_executor(None, self.send_tcp, query,
+                                                  reply.server)
+        return response, reply.server
+
+    @staticmethod
+    async def async_address(loop, server):
+        """Return the IPv4 address of a server without blocking the loop
+
+        Args:
+            loop (AbstractEventLoop): the running loop
+            server (str): address or host name of the server
+
+        Returns:
+            str: the address of the server
+        """
+        try:
+            socket.inet_aton(server)
+            return server
+        except OSError:
+            pass
+        info = await loop.getaddrinfo(server, None, family=socket.AF_INET,
+                                      type=socket.SOCK_DGRAM)
+        return info[0][4][0]
+
+    def ask(self, data, dnsserv, replies, sent):
+        """Send the query of a race to the next server
+
+        Args:
+            data (bytes): the encoded query
+            dnsserv (str): address of the server
+            replies (object): receives the response, see Transport.send
+            sent ([Pending]): the queries of the race so far, the new one is
+                appended
+        """
+        self.stats["queries"] += 1
+        if sent:
+            self.stats["raced"] += 1
+        sent.append(self.transport.send(data, str(dnsserv), replies))
+
+    def give_up(self, sent, now):
+        """Penalize the servers of a race that none answered
+
+        Returns:
+            socket.timeout: the error to raise
+        """
+        self.stats["timeouts"] += 1
+        for pending in sent:
+            if pending.response is None:
+                self.servers.timeout(pending.server, now - pending.sent)
+        return socket.timeout("timed out")
+
+    def rejected(self, sent):
+        """Return the error to raise when every server of a race answered
+        with an error rcode"""
+        self.stats["rejected"] += 1
+        servers = ", ".join(pending.server for pending in sent)
+        return ConnectionRefusedError("no usable response from " + servers)
+
+    def accept(self, reply):
+        """Record the round trip time of a server that answered a race
+
+        A server that answers with an error is penalized instead.
+
+        Args:
+            reply (Pending): the answered query
+
+        Returns:
+            Message: the response, or None if it has an error rcode
+        """
+        response = Message.from_bytes(reply.response)
+        if response.header.rcode in ERROR_RCODES:
+            self.stats["lame"] += 1
+            self.servers.error(reply.server)
+            return None
+        self.servers.record(reply.server, reply.rtt())
+        return response
+
+    def attempts(self, servers):
+        """Return the ways to ask the servers of a zone, best first
+
+        Args:
+            servers ([str]): addresses of the servers
+
+        Returns:
+            [str/[str]]: addresses to ask one at a time, or a single list of
+                addresses to race
+        """
+        servers = self.servers.choose(servers)
+        if self.stagger and len(servers) > 1:
+            return [servers]
+        return servers
+
+    def send_tcp(self, query, dnsserv):
+        """Send a query to a server over TCP and return its response
+
+        Args:
+            query (Message): the query
+            dnsserv (str): address of the server
+
+        Returns:
+            Message: the response
+        """
+        self.stats["tcp_queries"] += 1
+        try:
+            with socket.create_connection((str(dnsserv),
+                                           self.transport.port),
+                                          self.timeout) as sock:
+                send_message(sock, query.to_bytes())
+                data = recv_message(sock)
+        except socket.timeout:
+            self.stats["timeouts"] += 1
+            raise
+        if data is None:
+            raise ConnectionError("connection closed by server")
+        return Message.from_bytes(data)
+
+    def getsoa(self, response):
+        """Return the SOA record if the response is a negative answer
+
+        A negative answer is either NXDOMAIN, or NODATA: no error and no
+        answers, but an SOA record in the authority section (RFC 2308).
+        """
+        if response.answers:
+            return None
+        if response.header.rcode not in (RCode.NoError, RCode.NXDomain):
+            return None
+        for authority in response.authorities:
+            if authority.type_ == Type.SOA:
+                return authority
+        return None
+
+    def gethostbyname_stale(self, hostname, dnsserv, stale):
+        """Refresh an expired name, falling back to the stale records
+
+        The name is resolved in a background thread, at most one per name at
+        a time. If that does not finish within the stale deadline, or fails,
+        the answer is made from the stale records while the refresh keeps
+        running. For STALE_RECHECK seconds after that, the stale records are
+        served right away without a new refresh. See RFC 8767.
+
+        Args:
+            hostname (str): the hostname to resolve
+            dnsserv (str): address of the server to ask first, the servers
+                of the closest known zone or a root server if None
+            stale ([ResourceRecord]): the stale records for hostname
+
+        Returns:
+            (str, [str], [str]): (hostname, aliaslist, ipaddrlist)
+        """
+        key = (normalize(str(hostname)), Type.A, Class.IN)
+        if self.recheck(key):
+            return self.stale_answer(hostname, stale)
+        with self.lock:
+            flight = self.refreshes.get(key)
+            if flight is None:
+                flight = self.refreshes[key] = Flight()
+                Thread(target=self.refresh, args=(key, flight, hostname,
+                                                  dnsserv),
+                       daemon=True).start()
+        if flight.done.wait(self.stale_deadline):
+            if flight.result is not None and flight.result[2]:
+                return flight.result
+        else:
+            self.failed[key] = time.monotonic() + STALE_RECHECK
+        return self.stale_answer(hostname, stale)
+
+    def refresh(self, key, flight, hostname, dnsserv):
+        """Resolve an expired name for gethostbyname_stale
+
+        Args:
+            key (tuple): (name, type, class) of the refresh
+            flight (Flight): receives the result of the refresh
+            hostname (str): the hostname to resolve
+            dnsserv (str): address of the server to ask first, the servers
+                of the closest known zone or a root server if None
+        """
+        try:
+            flight.result = self.gethostbyname(hostname, dnsserv, False)
+        except Exception:
+            pass
+        if flight.result is not None and flight.result[2]:
+            self.failed.pop(key, None)
+        else:
+            self.failed[key] = time.monotonic() + STALE_RECHECK
+        with self.lock:
+            del self.refreshes[key]
+        flight.done.set()
+
+    def recheck(self, key):
+        """Return True if a refresh of key failed less than STALE_RECHECK
+        seconds ago, so the stale records are served without trying again"""
+        until = self.failed.get(key)
+        if until is None:
+            return False
+        if until > time.monotonic():
+            self.stats["stale_recheck"] += 1
+            return True
+        self.failed.pop(key, None)
+        return False
+
+    def stale_answer(self, hostname, stale):
+        """Make an answer from stale records
+
+        Args:
+            hostname (str): the hostname to resolve
+            stale ([ResourceRecord]): the stale records for hostname
+
+        Returns:
+            (str, [str], [str]): (hostname, aliaslist, ipaddrlist)
+        """
+        self.cache.stats["stale_served"] += 1
+        aliaslist = [rr.rdata.cname for rr in stale if rr.type_ == Type.CNAME]
+        ipaddrlist = [rr.rdata.address for rr in stale if rr.type_ == Type.A]
+        if not ipaddrlist and aliaslist:
+            stale = self.cache.lookup_stale(aliaslist[0], Type.A, Class.IN)
+            ipaddrlist = [rr.rdata.address for rr in stale]
+        return hostname, aliaslist, ipaddrlist
+
+    def from_cache(self, hostname):
+        """Look a host name up in the cache
+
+        Args:
+            hostname (str): the hostname to resolve
+
+        Returns:
+            ((str, [str], [str]), str, [ResourceRecord]): the answer, or None
+                if the cache has none; the name of an alias to look up
+                instead, or None; and the stale records of hostname
+        """
+        ipaddrlist = []
+        cnames = []
+        rcord = self.cache.lookup(hostname, Type.ANY, Class.IN)
+        if(rcord):
+            for rec in rcord:
+                if rec.type_ == Type.A:
+                    arec = rec.rdata
+                    ipaddrlist.append(arec.address)
+                elif rec.type_ == Type.CNAME:
+                    crec = rec.rdata
+                    cnames.append(crec.cname)
+        if ipaddrlist:
+            return (hostname, cnames, ipaddrlist), None, []
+        elif cnames:
+            return None, cnames[0], []
+        elif self.cache.lookup_negative(hostname, Type.A, Class.IN):
+            return (hostname, [], []), None, []
+        return None, None, self.cache.lookup_stale(hostname, Type.ANY,
+                                                   Class.IN)
+
+    def through_alias(self, hostname, alias, result):
+        """Make the answer for a name from the answer for its alias
+
+        Args:
+            hostname (str): the hostname to resolve
+            alias (str): the name hostname is an alias of
+            result ((str, [str], [str])): the answer for alias, or None
+
+        Returns:
+            (str, [str], [str]): (hostname, aliaslist, ipaddrlist) with alias
+                first in the aliaslist, or None if result is None
+        """
+        if result is None:
+            return None
+        return hostname, [alias] + result[1], result[2]
+
+    def gethostbyname(self, hostname, dnsserv=None, usecache=True,
+                      cacheonly=False):
         """Translate a host name to IPv4 address.
 
         Currently this method contains an example. You will have to replace
         this example with the algorithm described in section 5.3.3 in RFC 1034.
 
+        Concurrent lookups of the same name that are not answered from the
+        cache share a single resolution.
+
+        Args:
+            hostname (str): the hostname to resolve
+            dnsserv (str): address of the server to ask first, the servers
+                of the closest known zone or a root server if None
+            usecache (bool): answer from the cache if possible, the result
+                is still added to the cache if False
+            cacheonly (bool): only answer from the cache, using stale records
+                if there are no others, and never ask a server
+
+        Returns:
+            (str, [str], [str]): (hostname, aliaslist, ipaddrlist), or None if
+                cacheonly is True and the cache has no answer
+        """
+        if(self.caching and usecache):
+            result, alias, stale = self.from_cache(hostname)
+            if result is not None:
+                return result
+            elif alias is not None:
+                result = self.gethostbyname(alias, dnsserv,
+                                            cacheonly=cacheonly)
+                return self.through_alias(hostname, alias, result)
+            if stale and cacheonly:
+                return self.stale_answer(hostname, stale)
+            if stale:
+                return self.gethostbyname_stale(hostname, dnsserv, stale)
+        if cacheonly:
+            return None
+
+        key = (normalize(str(hostname)), Type.A, Class.IN)
+        return self.flights.do(key, self.resolve, hostname, dnsserv)
+
+    async def async_gethostbyname(self, hostname, dnsserv=None,
+                                  usecache=True):
+        """Translate a host name to IPv4 address without blocking
+
+        This is gethostbyname for coroutines. It shares the cache, the
+        transport and the tables of the resolver with gethostbyname, and
+        concurrent lookups of the same name on one event loop share a single
+        resolution.
+
         Args:
             hostname (str): the hostname to resolve
+            dnsserv (str): address of the server to ask first, the servers
+                of the closest known zone or a root server if None
+            usecache (bool): answer from the cache if possible, the result
+                is still added to the cache if False
 
         Returns:
             (str, [str], [str]): (hostname, aliaslist, ipaddrlist)
         """
-        ipaddrlist = []
-        cnames = []
-        temp = []
-        if(self.caching):
-            rcache = RecordCache(self.ttl)
-            rcord = rcache.lookup(hostname, Type.ANY, Class.IN)
-            if(rcord):
-                for rec in rcord:
-                    if rec.type_ == Type.A:
-                        arec = rec.rdata
-                        ipaddrlist.append(arec.address)
-                    elif rec.type_ == Type.CNAME:
-                        crec = rec.rdata
-                        cnames.append(crec.cname)
-            if ipaddrlist:
-                return hostname, cnames, ipaddrlist
-            elif cnames:
-                return self.gethostbyname(cnames[0], dnsserv)
-        
+        if self.caching and usecache:
+            result, alias, stale = self.from_cache(hostname)
+            if result is not None:
+                return result
+            elif alias is not None:
+                result = await self.async_gethostbyname(alias, dnsserv)
+                return self.through_alias(hostname, alias, result)
+            if stale:
+                return await self.async_gethostbyname_stale(hostname, dnsserv,
+                                                            stale)
+
+        loop = asyncio.get_running_loop()
+        key = (loop, normalize(str(hostname)), Type.A, Class.IN)
+        flight = self.async_flights.get(key)
+        if flight is None:
+            flight = asyncio.ensure_future(self.async_resolve(hostname,
+                                                              dnsserv))
+            self.async_flights[key] = flight
+            flight.add_done_callback(
+                lambda _: self.async_flights.pop(key, None))
+        else:
+            self.stats["coalesced"] += 1
+        return await asyncio.shield(flight)
+
+    async def async_gethostbyname_stale(self, hostname, dnsserv, stale):
+        """Refresh an expired name, falling back to the stale records
+
+        This is gethostbyname_stale for coroutines, the refresh keeps running
+        on the event loop after the stale deadline. Concurrent refreshes of a
+        name share one lookup, and after a failed one the stale records are
+        served right away for STALE_RECHECK seconds.
+
+        Args:
+            hostname (str): the hostname to resolve
+            dnsserv (str): address of the server to ask first, the servers
+                of the closest known zone or a root server if None
+            stale ([ResourceRecord]): the stale records for hostname
+
+        Returns:
+            (str, [str], [str]): (hostname, aliaslist, ipaddrlist)
+        """
+        key = (normalize(str(hostname)), Type.A, Class.IN)
+        if self.recheck(key):
+            return self.stale_answer(hostname, stale)
+        refresh = asyncio.ensure_future(
+            self.async_gethostbyname(hostname, dnsserv, False))
+        refresh.add_done_callback(
+            lambda task: task.cancelled() or task.exception())
+        try:
+            result = await asyncio.wait_for(asyncio.shield(refresh),
+                                            self.stale_deadline)
+        except Exception:
+            result = None
+        if result is not None and result[2]:
+            self.failed.pop(key, None)
+            return result
+
+        self.failed[key] = time.monotonic() + STALE_RECHECK
+        return self.stale_answer(hostname, stale)
+
+    def resolve(self, hostname, dnsserv):
+        """Translate a host name to IPv4 address by asking the servers
+
+        The cache is not consulted, but the answers are added to it.
+
+        Args:
+            hostname (str): the hostname to resolve
+            dnsserv (str/[str]): address of the server to ask first, a list
+                of addresses to race, or None for the servers of the closest
+                known zone or a root server
+
+        Returns:
+            (str, [str], [str]): (hostname, aliaslist, ipaddrlist)
+        """
+        steps = self.iterate(hostname, dnsserv)
+        try:
+            request = next(steps)
+            while True:
+                try:
+                    reply = self.race(*request)
+                except OSError as error:
+                    request = steps.throw(error)
+                else:
+                    request = steps.send(reply)
+        except StopIteration as stop:
+            return stop.value
+
+    async def async_resolve(self, hostname, dnsserv):
+        """Translate a host name to IPv4 address by asking the servers
+
+        This is resolve for coroutines.
+
+        Args:
+            hostname (str): the hostname to resolve
+            dnsserv (str/[str]): address of the server to ask first, a list
+                of addresses to race, or None for the servers of the closest
+                known zone or a root server
+
+        Returns:
+            (str, [str], [str]): (hostname, aliaslist, ipaddrlist)
+        """
+        steps = self.iterate(hostname, dnsserv)
+        try:
+            request = next(steps)
+            while True:
+                try:
+                    reply = await self.async_race(*request)
+                except OSError as error:
+                    request = steps.throw(error)
+                else:
+                    request = steps.send(reply)
+        except StopIteration as stop:
+            return stop.value
+
+    def iterate_closest(self, hostname, depth=0):
+        """Resolve a host name, starting at the closest known zone
+
+        The servers of the zone are tried in turn. When none of them answers,
+        the lookup starts again at a root server. See iterate.
+
+        Args:
+            hostname (str): the hostname to resolve
+            depth (int): number of name server lookups this one is part of
+        """
+        closest = None
+        if self.delegations is not None:
+            closest = self.delegations.lookup(str(hostname))
+        if closest is not None:
+            self.stats["delegation_hits"] += 1
+            for address in self.attempts(closest[1]):
+                try:
+                    return (yield from self.iterate(hostname, address,
+                                                    closest[0], depth))
+                except OSError:
+                    self.stats["delegation_failures"] += 1
+        return (yield from self.iterate(hostname, ROOT_SERVER, ".", depth))
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(self.timeout)
+    def iterate_glueless(self, nsnames, depth):
+        """Look up the addresses of name servers that came without glue
 
+        The names are looked up in the cache, or resolved like any other
+        name, one at a time until one of them has an address. See iterate.
+
+        Args:
+            nsnames ([str]): names of the name servers
+            depth (int): number of name server lookups the lookup that needs
+                them is part of
+
+        Returns:
+            [str]: the addresses of the first name server that has any
+        """
+        if depth >= GLUELESS_DEPTH:
+            return []
+        for nsname in nsnames:
+            self.stats["glueless"] += 1
+            if self.caching:
+                result, _, _ = self.from_cache(nsname)
+                if result is not None and result[2]:
+                    return result[2]
+            try:
+                _, _, addresses = yield from self.iterate_closest(nsname,
+                                                                  depth + 1)
+            except OSError:
+                continue
+            if addresses:
+                return addresses
+        return []
+
+    def iterate(self, hostname, dnsserv, zone=".", depth=0):
+        """The steps of resolving a host name
+
+        This generator does not send anything itself, so resolve and
+        async_resolve share it. It yields (query, servers) for every query
+        that must be sent, and is sent back the (response, server) of race,
+        or has the error of race thrown in. It returns the result of
+        resolve.
+
+        Args:
+            hostname (str): the hostname to resolve
+            dnsserv (str/[str]): address of the server to ask first, a list
+                of addresses to race, or None for the servers of the closest
+                known zone or a root server
+            zone (str): the zone the servers are authoritative for, only
+                referrals to zones below it are followed
+            depth (int): number of name server lookups this one is part of,
+                see iterate_glueless
+        """
+        if dnsserv is None:
+            return (yield from self.iterate_closest(hostname, depth))
         # Create and send query
         question = Question(Name(str(hostname)), Type.A, Class.IN)
-        header = Header(9001, 0, 1, 0, 0, 0)
+        header = Header(random_ident(), 0, 1, 0, 0, 0)
         header.qr = 0
         header.opcode = 0
         header.rd = 1
         query = Message(header, [question])
-        sock.sendto(query.to_bytes(), (str(dnsserv), 53))
-
-        # Receive response
-        data = sock.recv(2048)
-        response = Message.from_bytes(data)
-        print("Number of answers: " +str(len(response.answers)))
-        print("Number of authorities: " + str(len(response.authorities)))
-        print("Number of additionals: " + str(len(response.additionals)))
+        self.stats["resolutions"] += 1
+        if isinstance(dnsserv, list):
+            response, dnsserv = yield query, dnsserv
+        else:
+            response, _ = yield query, [dnsserv]
 
         # Get data
-        aliaslist = cnames
+        aliaslist = []
         ipaddrlist = []
         dnslist = []
         
         while response.answers:
             for answer in response.answers:
                 if answer.type_ == Type.A:
-                    print("found A RR")
                     if(self.caching):
-                        rcache.add_record(answer)
+                        self.cache.add_record(answer)
                     ipaddrlist.append(answer.rdata.address)
                 if answer.type_ == Type.CNAME:
+                    if(self.caching):
+                        self.cache.add_record(answer)
                     aliaslist.append(answer.rdata.cname)
                 if answer.type_ == Type.NS:
                     dnslist.append(answer.rdata.nsdname)
@@ -111,9 +772,7 @@ class Resolver:
             elif aliaslist:
                 question = Question(Name(aliaslist[0]), Type.A, Class.IN)
                 query = Message(header, [question])
-                sock.sendto(query.to_bytes(), (dnsserv, 53))
-                data = sock.recv(2048)
-                response = Message.from_bytes(data)
+                response, _ = yield query, [dnsserv]
             elif dnslist:
                 nsname = dnslist.pop()
                 maybe_dnsserv = self.getnsaddr(nsname, response.additionals)
@@ -121,29 +780,56 @@ class Resolver:
                     dnsserv = maybe_dnsserv
                 else:
                     pass
-                sock.sendto(query.to_bytes(), (dnsserv, 53))
-                data = sock.recv(2048)
-                response = Message.from_bytes(data)
+                response, _ = yield query, [dnsserv]
             else:
                 break
 
+        soa = self.getsoa(response)
+        if soa is not None:
+            self.stats["negative"] += 1
+            if self.caching:
+                self.cache.add_negative(question.qname, question.qtype,
+                                        question.qclass, response.header.rcode,
+                                        soa)
+            return hostname, aliaslist, []
+
         if response.authorities:
+            cut = referral_cut(hostname, zone, response.authorities)
+            if cut is None:
+                self.stats["lame_referrals"] += 1
+                return hostname, aliaslist, []
+            if self.delegations is not None:
+                self.delegations.add_referral(hostname, zone,
+                                              response.authorities,
+                                              response.additionals)
             for authority in response.authorities:
-                if authority.type_ != Type.NS:
-                    pass
+                if (authority.type_ != Type.NS or
+                        normalize(authority.name) != cut):
+                    continue
                 dnslist.append(authority.rdata.nsdname)
-            while dnslist:
-                nsname = dnslist.pop()
-                maybe_next_dnsserv = self.getnsaddr(nsname, response.additionals)
+            servers = []
+            glueless = []
+            for nsname in dnslist:
+                maybe_next_dnsserv = None
+                if within(normalize(nsname), zone):
+                    maybe_next_dnsserv = self.getnsaddr(nsname,
+                                                        response.additionals)
                 if maybe_next_dnsserv:
-                    next_dns_serv = maybe_next_dnsserv
+                    servers.append(maybe_next_dnsserv)
                 else:
-                    pass
-                (hname, aliasl, ipaddrl) = self.gethostbyname(hostname, nsname)
+                    glueless.append(str(nsname))
+            if not servers:
+                servers = yield from self.iterate_glueless(glueless, depth)
+            error = None
+            for next_dnsserv in self.attempts(servers):
+                try:
+                    (hname, aliasl, ipaddrl) = yield from self.iterate(
+                        hostname, next_dnsserv, cut, depth)
+                except OSError as exc:
+                    error = exc
+                    continue
                 if ipaddrl:
                     return hname, aliasl, ipaddrl
-
-        
-        
-        
-        
+            if error is not None:
+                raise error
+        return hostname, aliaslist, []
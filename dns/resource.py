@@ -273,12 +273,13 @@ class SOARecordData(RecordData):
             compress (dict): dict from domain names to pointers.
         """
         data = self.mname.to_bytes(offset, compress)
-        data += self.rname.to_bytes(len(data), compress)
+        data += self.rname.to_bytes(offset + len(data), compress)
         data += struct.pack("!I", self.serial)
         data += struct.pack("!i", self.refresh)
         data += struct.pack("!i", self.retry)
         data += struct.pack("!i", self.expire)
         data += struct.pack("!I", self.minimum)
+        return data
 
     @classmethod
     def from_bytes(cls, packet, offset, rdlength):
@@ -296,7 +297,7 @@ class SOARecordData(RecordData):
         retry = struct.unpack_from("!i", packet, offset + 8)[0]
         expire = struct.unpack_from("!i", packet, offset + 12)[0]
         minimum = struct.unpack_from("!I", packet, offset + 16)[0]
-        return cls(mname, rname, serial, refresh, retry, expire, minimum), offset + 20
+        return cls(mname, rname, serial, refresh, retry, expire, minimum)
 
     def to_dict(self):
         """Convert to dict."""
@@ -309,7 +310,7 @@ class SOARecordData(RecordData):
     def from_dict(cls, dct):
         """Create a RecordData object from dict."""
         return cls(Name(dct["mname"]), Name(dct["rname"]), dct["serial"],
-                   dt["refresh"], dct["retry"], dct["expire"], dct["minimum"])
+                   dct["refresh"], dct["retry"], dct["expire"], dct["minimum"])
 
 
 class GenericRecordData(RecordData):
@@ -341,7 +342,7 @@ class GenericRecordData(RecordData):
             offset (int): offset in message.
             rdlength (int): length of rdata.
         """
-        data = packet[offset:offset+rdlength]
+        data = bytes(packet[offset:offset+rdlength])
         return cls(data)
 
     def to_dict(self):
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+"""A cache of encoded responses
+
+This module contains a cache for complete responses of the server in wire
+format. Responses are keyed by the raw question section of the query and the
+header flags that change the answer. A hit only needs a copy of the cached
+bytes with the ID of the query and the remaining TTLs patched in, at offsets
+that are computed once when the response is cached.
+"""
+
+
+import struct
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+RD_CD = 0x0110
+HEADER = struct.Struct("!6H")
+TTL = struct.Struct("!I")
+
+
+def skip_name(packet, offset):
+    """Return the offset just past an encoded domain name
+
+    Args:
+        packet (bytes): packet
+        offset (int): offset of the name in packet
+    """
+    while True:
+        length = packet[offset]
+        if length == 0:
+            return offset + 1
+        if length >= 192:
+            return offset + 2
+        offset += length + 1
+
+
+def query_key(packet):
+    """Return the cache key of a query or None if it can not be cached
+
+    Only standard queries with a single question and no other records are
+    cached. The question must not use compression.
+
+    Args:
+        packet (bytes): the query
+    """
+    if len(packet) < 17 or packet[4:12] != b"\x00\x01" + bytes(6):
+        return None
+    flags = (packet[2] << 8) | packet[3]
+    if flags & 0xf800:
+        return None
+    offset = 12
+    try:
+        while packet[offset]:
+            if packet[offset] >= 64:
+                return None
+            offset += packet[offset] + 1
+    except IndexError:
+        return None
+    end = offset + 5
+    if end != len(packet):
+        return None
+    return struct.pack("!H", flags & RD_CD) + bytes(packet[12:end])
+
+
+def ttl_offsets(packet):
+    """Return (offset, ttl) for every resource record in a response
+
+    Args:
+        packet (bytes): the response
+    """
+    _, _, qd_count, an_count, ns_count, ar_count = \
+        HEADER.unpack_from(packet, 0)
+    offset = 12
+    for _ in range(qd_count):
+        offset = skip_name(packet, offset) + 4
+    offsets = []
+    for _ in range(an_count + ns_count + ar_count):
+        offset = skip_name(packet, offset) + 4
+        ttl, rdlength = struct.unpack_from("!IH", packet, offset)
+        offsets.append((offset, ttl))
+        offset += 6 + rdlength
+    return offsets
+
+
+class ResponseCache:
+    """Cache of encoded responses"""
+
+    def __init__(self, max_entries=10000):
+        """Initialize the ResponseCache
+
+        Args:
+            max_entries (int): maximum number of cached responses
+        """
+        self.responses = OrderedDict()
+        self.max_entries = max_entries
+        self.lock = Lock()
+
+    def get(self, query):
+        """Return the cached response for a query
+
+        Args:
+            query (bytes): the query
+
+        Returns:
+            bytes: the response with the ID of the query and decremented TTLs,
+                or None
+        """
+        key = query_key(query)
+        if key is None:
+            return None
+        entry = self.responses.get(key)
+        if entry is None:
+            return None
+        created, expires, template, offsets = entry
+        now = time.time()
+        if now >= expires:
+            return None
+        elapsed = int(now - created)
+        response = bytearray(template)
+        response[0:2] = query[0:2]
+        for offset, ttl in offsets:
+            TTL.pack_into(response, offset, max(0, ttl - elapsed))
+        return response
+
+    def put(self, query, response):
+        """Cache the response to a query
+
+        The response is kept as long as the lowest TTL in it. Responses
+        without resource records are not cached.
+
+        Args:
+            query (bytes): the query
+            response (bytes): the encoded response
+        """
+        key = query_key(query)
+        if key is None:
+            return
+        offsets = ttl_offsets(response)
+        if not offsets:
+            return
+        lifetime = min(ttl for _, ttl in offsets)
+        if lifetime <= 0:
+            return
+        now = time.time()
+        with self.lock:
+            self.responses[key] = (now, now + lifetime, bytes(response),
+                                   offsets)
+            self.responses.move_to_end(key)
+            while len(self.responses) > self.max_entries:
+                self.responses.popitem(last=False)
+
+    def clear(self):
+        """Remove all cached responses"""
+        with self.lock:
+            self.responses.clear()
+
+    def __len__(self):
+        return len(self.responses)
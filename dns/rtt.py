@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+"""Round trip times of name servers
+
+The resolver measures how long every name server takes to answer and keeps a
+smoothed round trip time (SRTT) per server address. A server that times out
+gets a penalty: its SRTT is doubled, and at least the time the resolver waited
+for it. A server that answers with an error such as REFUSED is penalized the
+same way, with at least LAME_RTT, so a fast lame server is not preferred. When
+the resolver can ask several servers, it asks the one with the lowest SRTT
+first.
+
+SRTTs decay over time: a server that has not been asked for HALF_LIFE seconds
+counts as twice as fast as it was, so a server that timed out once is tried
+again later. Servers that were never asked get a small random SRTT, so each
+of them is tried early. With probability EXPLORE another server than the best
+one is asked first, which keeps the SRTTs of the others up to date.
+
+The table can be written to and read from a JSON file, so it survives a
+restart together with the record cache.
+"""
+
+import json
+import os
+import random
+import time
+from threading import Lock
+
+
+SMOOTHING = 0.3
+HALF_LIFE = 600
+EXPLORE = 0.05
+MAX_RTT = 10.0
+LAME_RTT = 1.0
+UNKNOWN_RTT = (0.001, 0.032)
+
+
+class RTTTable:
+    """Smoothed round trip times per name server address"""
+
+    def __init__(self, smoothing=SMOOTHING, half_life=HALF_LIFE,
+                 explore=EXPLORE):
+        """Initialize the RTTTable
+
+        Args:
+            smoothing (float): weight of a new measurement in the SRTT
+            half_life (float): seconds after which an SRTT is halved
+            explore (float): probability that another server than the best
+                one is ordered first
+        """
+        self.smoothing = smoothing
+        self.half_life = half_life
+        self.explore = explore
+        self.servers = {}
+        self.lock = Lock()
+
+    def score(self, address, now=None):
+        """Return the decayed SRTT of a server
+
+        Args:
+            address (str): address of the server
+            now (float): current time
+
+        Returns:
+            float: SRTT in seconds, None if the server was never asked
+        """
+        entry = self.servers.get(address)
+        if entry is None:
+            return None
+        if now is None:
+            now = time.time()
+        srtt, updated, _ = entry
+        return srtt * 0.5 ** (max(0, now - updated) / self.half_life)
+
+    def record(self, address, rtt):
+        """Add a measured round trip time
+
+        Args:
+            address (str): address of the server
+            rtt (float): seconds until the response arrived
+        """
+        now = time.time()
+        with self.lock:
+            srtt = self.score(address, now)
+            if srtt is not None:
+                rtt = (1 - self.smoothing) * srtt + self.smoothing * rtt
+            timeouts = self.servers.get(address, (0, 0, 0))[2]
+            self.servers[address] = (min(rtt, MAX_RTT), now, timeouts)
+
+    def timeout(self, address, waited):
+        """Penalize a server that did not answer
+
+        Args:
+            address (str): address of the server
+            waited (float): seconds the resolver waited for the response
+        """
+        now = time.time()
+        with self.lock:
+            srtt = self.score(address, now) or 0
+            timeouts = self.servers.get(address, (0, 0, 0))[2] + 1
+            self.servers[address] = (min(max(2 * srtt, waited), MAX_RTT),
+                                     now, timeouts)
+
+    def error(self, address):
+        """Penalize a server that answered with an error
+
+        Args:
+            address (str): address of the server
+        """
+        now = time.time()
+        with self.lock:
+            srtt = self.score(address, now) or 0
+            timeouts = self.servers.get(address, (0, 0, 0))[2]
+            self.servers[address] = (min(max(2 * srtt, LAME_RTT), MAX_RTT),
+                                     now, timeouts)
+
+    def choose(self, addresses):
+        """Order servers by SRTT, best first
+
+        Args:
+            addresses ([str]): addresses of the servers
+
+        Returns:
+            [str]: the addresses in the order they should be asked
+        """
+        now = time.time()
+        scores = {}
+        for address in addresses:
+            score = self.score(address, now)
+            if score is None:
+                score = random.uniform(*UNKNOWN_RTT)
+            scores[address] = score
+        order = sorted(scores, key=scores.get)
+        if len(order) > 1 and random.random() < self.explore:
+            order.insert(0, order.pop(random.randrange(1, len(order))))
+        return order
+
+    def table(self):
+        """Return the table, for the counters of the server
+
+        Returns:
+            {str: (float, int)}: decayed SRTT in milliseconds and number of
+                timeouts by server address
+        """
+        now = time.time()
+        return {address: (self.score(address, now) * 1000, timeouts)
+                for address, (_, _, timeouts) in list(self.servers.items())}
+
+    def read_file(self, filename):
+        """Load the table from a file written by write_file
+
+        A missing or damaged file leaves the table as it is.
+
+        Args:
+            filename (str): the file
+        """
+        try:
+            with open(filename, "r") as file_:
+                servers = json.load(file_)
+            servers = {address: (float(srtt), float(updated), int(timeouts))
+                       for address, (srtt, updated, timeouts)
+                       in servers.items()}
+        except OSError:
+            return
+        except (ValueError, TypeError, AttributeError):
+            print("could not read round trip times")
+            return
+        with self.lock:
+            self.servers.update(servers)
+
+    def write_file(self, filename):
+        """Write the table to a file
+
+        Args:
+            filename (str): the file, replaced atomically
+        """
+        tmpname = "{}.{}.tmp".format(filename, os.getpid())
+        with self.lock:
+            servers = dict(self.servers)
+        try:
+            with open(tmpname, "w") as file_:
+                json.dump(servers, file_)
+            os.replace(tmpname, filename)
+        except OSError:
+            print("could not write round trip times")
+
+    def __len__(self):
+        return len(self.servers)
@@ -4,157 +4,945 @@
 
 This module provides a recursive DNS server. You will have to implement this
 server using the algorithm described in section 4.3.2 of RFC 1034.
+
+The server listens on UDP and TCP. Responses over UDP that are larger than 512
+bytes are truncated to the header and question with the TC bit set, so the
+client can ask again over TCP.
+
+Queries over UDP can be rate limited per client network and question, see
+dns.ratelimit.
+
+Queries are handled by a fixed pool of worker threads, fed through a bounded
+queue by the receive loops. When the queue is full, new queries are dropped or
+answered with SERVFAIL right away. When queries wait too long for a worker,
+queries that need a recursive lookup are shed first, while answers from the
+zone and the cache are still given.
+
+The receive loop reads queries into buffers from a BufferPool and the query is
+parsed from a memoryview of the buffer. The buffer goes back to the pool when
+the query has been answered, so receiving does not allocate a new packet.
+
+The counters of the server, its resolver and its cache can be queried with TXT
+queries in the CH class: "stats.bind." returns all counters, and a name such
+as "hits.cache." or "queries.server." returns a single counter. The names in
+COUNTERS are always answered, with 0 before they are first counted. The
+queries of each type are counted as "server.qtype.A", asked for as
+"qtype.a.server."; types without a name are counted as "server.qtype.TYPE65"
+as in RFC 3597. The smoothed round trip time and the timeouts of each name
+server the resolver has asked are "rtt.10.0.0.1.srtt_ms" and
+"rtt.10.0.0.1.timeouts", asked for as "10.0.0.1.srtt_ms.rtt.". Other names
+are answered with NXDOMAIN.
+
+After handle_signals, SIGHUP reads the zone file again on a separate thread
+and swaps the new zone in, so queries are answered from the old zone until the
+new one is ready. SIGTERM stops receiving, the queries that were already
+received are answered for up to DRAIN_TIMEOUT seconds and the cache is written
+to its snapshot.
 """
 
+import signal
 import socket
-from threading import Thread
+import struct
+import sys
+import time
+from collections import Counter, deque
+from queue import Full, Queue
+from threading import BoundedSemaphore, Lock, Thread
 from dns.message import Message
 from dns.message import Header
 from dns.message import Question
 from dns.zone import Zone
 from dns.zone import Catalog
 from dns.resolver import Resolver
+from dns.cache import RecordCache
+from dns.shmcache import SharedRecordCache
+from dns.responsecache import ResponseCache, skip_name
 from dns.classes import Class
 from dns.types import Type
 from dns.resource import ResourceRecord
 from dns.resource import ARecordData
 from dns.resource import CNAMERecordData
+from dns.resource import GenericRecordData
+from dns.rcodes import RCode
+from dns.ratelimit import ALLOW, SLIP, RateLimiter
+from dns.tcp import recv_message, send_message
+
+
+RECEIVE_SIZE = 65535
+UDP_SIZE = 512
+TC = 0x0200
+TCP_TIMEOUT = 10
+TCP_CONNECTIONS = 128
+DELAY_WEIGHT = 0.1
+DRAIN_TIMEOUT = 5
+COUNTERS = {
+    "server": ("queries", "authoritative", "recursive", "chaos",
+               "response_cache_hits", "truncated", "errors", "overload",
+               "shed", "shed_cache_answers", "rate_limited", "slipped",
+               "tcp_connections", "tcp_queries", "tcp_refused",
+               "drain_timeouts", "zone_reloads", "zone_reload_errors"),
+    "resolver": ("resolutions", "queries", "coalesced", "raced", "timeouts",
+                 "rejected", "truncated", "tcp_queries", "unmatched",
+                 "lame", "lame_referrals", "negative", "glueless",
+                 "delegation_hits", "delegation_failures", "stale_served",
+                 "stale_recheck"),
+    "cache": ("hits", "misses", "negative_hits", "stale_hits", "expired",
+              "evictions", "prefetches", "prefetch_useful",
+              "prefetch_failed", "prefetch_dropped"),
+}
+
+
+def known_counters():
+    """Return the names of the counters that are answered before they are
+    first counted
+
+    Returns:
+        {str}: lowercased names of the counters in COUNTERS and of the
+            counters of the query types
+    """
+    names = {"{}.{}".format(prefix, key)
+             for prefix, keys in COUNTERS.items() for key in keys}
+    names.update("server.qtype.{}".format(qtype).lower() for qtype in Type)
+    return names
 
-class RequestHandler(Thread):
+
+def truncate(response):
+    """Return the header and question of a response with the TC bit set
+
+    Args:
+        response (bytes): the encoded response
+    """
+    ident, flags, qd_count = struct.unpack_from("!3H", response)
+    end = 12
+    for _ in range(qd_count):
+        end = skip_name(response, end) + 4
+    return struct.pack("!6H", ident, flags | TC, qd_count, 0, 0, 0) + \
+        bytes(response[12:end])
+
+
+class RequestHandler:
     """A handler for requests to the DNS server"""
 
-    def __init__(self, data, addr, zone, sock):
-        """Initialize the handler thread"""
-        super().__init__()
-        self.daemon = True
+    def __init__(self, data, addr, zone, sock, server=None, buffer=None,
+                 tcp=False):
+        """Initialize the handler
+
+        Args:
+            data (bytes): the query, may be a memoryview of buffer
+            addr ((str, int)): address of the client
+            zone (Zone): the zone the server is authoritative for
+            sock (socket): socket to send the response on
+            server (Server): the server that received the query, which
+                provides the caches, the resolver and the counters
+            buffer (bytearray): buffer from the BufferPool of the server
+                holding the query, released by close
+            tcp (bool): the query was received over TCP, sock is the
+                TCPConnection it was received on
+        """
         self.data = data
+        self.buffer = buffer
+        self.tcp = tcp
+        self.received = time.monotonic()
         self.addr = addr
         self.sock = sock
         self.zone = zone
+        self.server = server
+        if server is None:
+            self.cache = None
+            self.responses = None
+            self.resolver = Resolver(100, False, 0, True)
+            self.stats = Counter()
+            self.qtypes = Counter()
+        else:
+            self.cache = server.cache
+            self.responses = server.responses
+            self.resolver = server.resolver
+            self.stats = server.stats
+            self.qtypes = server.qtypes
+
+    def getttl(self, name, type_):
+        """Return the remaining TTL of a cached record set, 0 if not cached"""
+        if self.cache is None:
+            return 0
+        records = self.cache.lookup(name, type_, Class.IN)
+        if not records:
+            records = self.cache.lookup_stale(name, type_, Class.IN)
+        return min((rr.ttl for rr in records), default=0)
 
-    def getdomains(self, hname):
-        print(hname)
-        domains = []
-        parts = hname.split('.')
-        for i in range(len(parts)):
-            domains.append('.'.join(parts[i:]))
-        if domains:
-            domains[-1] = '.'
-        return domains
+    def send(self, response):
+        """Send a response, truncated if it is too large for UDP
+
+        Args:
+            response (bytes): the encoded response
+        """
+        if not self.tcp and len(response) > UDP_SIZE:
+            self.stats["truncated"] += 1
+            response = truncate(response)
+        self.sock.sendto(response, self.addr)
+
+    def respond(self, response):
+        """Send a response and store it in the response cache
+
+        Args:
+            response (bytes): the encoded response
+        """
+        self.send(response)
+        if self.responses is not None:
+            self.responses.put(self.data, response)
+
+    def chaos(self, msg):
+        """Answer a CH class query for the counters of the server
+
+        Args:
+            msg (Message): the query
+        """
+        question = msg.questions[0]
+        labels = [label.lower() for label in question.qname.labels]
+        stats = self.server.statistics() if self.server is not None else {}
+        if labels == ["stats", "bind"]:
+            strings = ["{}={}".format(key, value)
+                       for key, value in sorted(stats.items())]
+        else:
+            key = ".".join(labels[-1:] + labels[:-1])
+            lowered = {name.lower(): value for name, value in stats.items()}
+            if key in lowered:
+                strings = [str(lowered[key])]
+            elif key in known_counters():
+                strings = ["0"]
+            else:
+                strings = None
+
+        answers = []
+        if strings and question.qtype in (Type.TXT, Type.ANY):
+            for string in strings:
+                data = string.encode("utf-8")[:255]
+                answers.append(ResourceRecord(
+                    question.qname, Type.TXT, Class.CH, 0,
+                    GenericRecordData(struct.pack("!B", len(data)) + data)))
+        header = Header(msg.header.ident, 0, 1, len(answers), 0, 0)
+        header.qr = 1
+        header.aa = 1
+        header.rd = msg.header.rd
+        header.rcode = RCode.NoError if strings is not None else RCode.NXDomain
+        response = Message(header, [question], answers)
+        self.send(response.to_bytes())
+
+    def servfail(self):
+        """Answer the query with SERVFAIL without parsing all of it"""
+        self.empty(RCode.ServFail)
+
+    def slip(self):
+        """Answer the query with an empty truncated response, so that the
+        client asks again over TCP"""
+        self.empty(RCode.NoError, True)
+
+    def empty(self, rcode, tc=False):
+        """Answer the query without records and without parsing all of it
+
+        Args:
+            rcode (RCode): rcode of the response
+            tc (bool): set the TC bit
+        """
+        try:
+            header = Header.from_bytes(self.data)
+            question = b""
+            if header.qd_count == 1:
+                question = self.data[12:skip_name(self.data, 12) + 4]
+        except (ValueError, IndexError):
+            return
+        if header.qr:
+            return
+        response = Header(header.ident, 0, 1 if question else 0, 0, 0, 0)
+        response.qr = 1
+        response.opcode = header.opcode
+        response.rd = header.rd
+        response.ra = 1
+        response.tc = 1 if tc else 0
+        response.rcode = rcode
+        self.send(response.to_bytes() + question)
+
+    def close(self):
+        """Give the buffer of the query back to the server
+
+        For a query over TCP, this tells the connection that the query has
+        been handled.
+        """
+        if self.buffer is not None and self.server is not None:
+            self.server.buffers.put(self.buffer)
+        if self.tcp and self.data is not None:
+            self.sock.finish()
+        self.buffer = None
+        self.data = None
 
     def run(self):
-        """ Run the handler thread"""
+        """ Handle the request"""
+        msg = self.prepare()
+        if msg is None:
+            return
+        question = self.local(msg)
+        if question is not None and self.admit(msg, question):
+            self.recursive(msg, question,
+                           self.resolver.gethostbyname(question.qname))
+
+    def admit(self, msg, question):
+        """Decide whether a question may be resolved recursively
+
+        While the server is overloaded, questions are only answered from the
+        cache, and the others are shed: answered with SERVFAIL or dropped.
+
+        Args:
+            msg (Message): the query
+            question (Question): the question that needs a recursive lookup
+
+        Returns:
+            bool: True if the question may be resolved, False if it has been
+                answered from the cache or shed
+        """
+        if self.server is None or not self.server.admission.overloaded():
+            return True
+        result = self.resolver.gethostbyname(question.qname, cacheonly=True)
+        if result is None:
+            self.stats["shed"] += 1
+            if self.server.overload == "servfail":
+                self.servfail()
+        else:
+            self.stats["shed_cache_answers"] += 1
+            self.recursive(msg, question, result)
+        return False
+
+    def prepare(self):
+        """Count the query and answer it from the response cache, the zone
+        or the CH class
+
+        Returns:
+            Message: the parsed query, or None if it has been answered
+        """
+        stats = self.stats
+        qtypes = self.qtypes
+        stats["queries"] += 1
+        if self.responses is not None:
+            response = self.responses.get(self.data)
+            if response is not None:
+                self.send(response)
+                stats["response_cache_hits"] += 1
+                qtypes[struct.unpack_from("!H", self.data,
+                                          len(self.data) - 4)[0]] += 1
+                return None
+        if self.zone is not None:
+            response = self.zone.answer(self.data)
+            if response is not None:
+                self.send(response)
+                stats["authoritative"] += 1
+                qtypes[struct.unpack_from(
+                    "!H", response, skip_name(response, 12))[0]] += 1
+                return None
+
         msg = Message.from_bytes(self.data)
-        header = msg.header
-        recursion = header.rd != 0
         questions = msg.questions
+        if questions:
+            qtypes[questions[0].qtype] += 1
+            if questions[0].qclass == Class.CH:
+                stats["chaos"] += 1
+                self.chaos(msg)
+                return None
+        return msg
+
+    def local(self, msg):
+        """Answer the query from the zone
+
+        Args:
+            msg (Message): the query
+
+        Returns:
+            Question: the question that needs a recursive lookup, or None
+        """
+        recursion = msg.header.rd != 0
+        for question in msg.questions:
+            if self.authoritative(msg, question):
+                return None
+            if recursion and question.qtype in (Type.A, Type.CNAME):
+                self.stats["recursive"] += 1
+                return question
+        return None
+
+    def authoritative(self, msg, question):
+        """Answer a question from the zone
+
+        Args:
+            msg (Message): the query
+            question (Question): the question
+
+        Returns:
+            bool: True if the question has been answered
+        """
+        if self.zone is None:
+            return False
+        response = self.zone.respond(msg.header.ident, msg.header.rd,
+                                     question.to_bytes(0, None))
+        if response is None:
+            return False
+        self.stats["authoritative"] += 1
+        self.send(response)
+        return True
+
+    def recursive(self, msg, question, result):
+        """Answer a question with the result of a recursive lookup
 
+        Args:
+            msg (Message): the query
+            question (Question): the question that was looked up
+            result ((str, [str], [str])): the result of gethostbyname
+        """
+        header = msg.header
         answers = []
-        authorative = []
-        additional = []
-        for question in questions:
-            qname = question.qname
-            qtype = question.qtype
-            if question.qclass != Class.IN:
+        (hostname, aliaslist, ipaddrlist) = result
+        header_response = Header(header.ident, 0, 1, len(aliaslist) + len(ipaddrlist), 0, 0)
+        header_response.qr = 1
+        header_response.opcode = 0
+        header_response.aa = 0
+        header_response.tc = 0
+        header_response.rd = header.rd
+        header_response.ra = 1
+        header_response.rcode = 0
+
+        name = question.qname
+        for alias in aliaslist:
+            answers.append(ResourceRecord.from_dict(
+                { "name" : str(name) ,
+                  "type" : str(Type.CNAME) ,
+                  "class": str(Class.IN) ,
+                  "ttl"  : self.getttl(name, Type.CNAME),
+                  "rdata": { "cname" : str(alias) } } ))
+            name = alias
+        for addr in ipaddrlist:
+            answers.append(ResourceRecord.from_dict(
+                { "name" : str(name) ,
+                  "type" : str(Type.A) ,
+                  "class": str(Class.IN) ,
+                  "ttl"  : self.getttl(name, Type.A),
+                  "rdata": { "address" : str(addr) } } ))
+        response = Message(header_response, msg.questions, answers)
+        self.respond(response.to_bytes())
+
+
+class TCPConnection:
+    """A client connection over TCP
+
+    Queries on a connection are handled by the worker pool like queries over
+    UDP, so a client can send several queries without waiting and gets the
+    responses in the order they are ready. The connection is closed when the
+    client closed its side, or was idle for TCP_TIMEOUT seconds, and all its
+    queries have been handled. See RFC 7766.
+    """
+
+    def __init__(self, sock, addr, server):
+        """Initialize the connection
+
+        Args:
+            sock (socket): the accepted socket
+            addr ((str, int)): address of the client
+            server (Server): the server that accepted the connection
+        """
+        self.sock = sock
+        self.addr = addr
+        self.server = server
+        self.lock = Lock()
+        self.pending = 0
+        self.reading = True
+
+    def sendto(self, data, addr):
+        """Send a response to the client
+
+        Args:
+            data (bytes): the encoded response
+            addr ((str, int)): ignored, responses go to the connected client
+        """
+        with self.lock:
+            try:
+                send_message(self.sock, data)
+            except OSError:
                 pass
-            domains = self.getdomains(str(qname))
-            for domain in domains:
-                if not self.zone.records.get(domain, False):
-                    continue
-                for rr in self.zone.records[domain]:
-                    if (rr.type_ == Type.A or rr.type_ == Type.CNAME) and domain == str(qname):
-                        answers.append(rr)
-                    if rr.type_ == Type.NS:
-                        authorative.append(rr)
-                        for rec in self.zone.records[str(rr.rdata.nsdname)]:
-                            if rec not in additional:
-                                if rec.qtype == Type.A:
-                                    additional.append(rec)
-            if authorative or answers:
-                header_response = Header(9001, 0, 1, len(answers), len(authorative), len(additionals))
-                header_response.qr = True
-                header_response.opcode(1)
-                header_response.aa(False)
-                header_respones.tc(False)
-                header_response.rd(False)
-                header_response.ra(True)
-                header_response.z(False)
-                header_respones.rcode(False)
-
-                respons = Message(header_response, [question], answers, authorities, additionals)
-
-                self.sock.sendto(respons.to_bytes(), self.addr)
-                break
 
-            if recursion and (qtype == Type.A or qtype == Type.CNAME):
-                answers = []
-                resolver = Resolver(100, False, 0, True)
-                (hostname, aliaslist, ipaddrlist) = resolver.gethostbyname(question.qname)
-                header_response = Header(9001, 0, 1, len(aliaslist) + len(ipaddrlist), 0, 0)
-                header_response.qr = 1
-                header_response.opcode = 1
-                header_response.aa = 0
-                header_response.tc = 0
-                header_response.rd = 0
-                header_response.ra = 1
-                header_response.rcode = 0
-
-                for addr in ipaddrlist:
-                    answers.append(ResourceRecord.from_dict(
-                        { "name" : str(hostname) ,
-                          "type" : str(Type.A) ,
-                          "class": str(Class.IN) ,
-                          "ttl"  : 0,
-                          "rdata": { "address" : str(addr) } } ))
-                for alias in aliaslist:
-                    answers.append(ResourceRecord.from_dict(
-                        { "name" : str(hostname) ,
-                          "type" : str(Type.CNAME) ,
-                          "class": str(Class.IN) ,
-                          "ttl"  : 0,
-                          "rdata": { "cname" : str(alias) } } ))
-                response = Message(header_response, questions, answers)
-                self.sock.sendto(response.to_bytes(), self.addr)
-                break
+    def serve(self):
+        """Read queries until the client is done"""
+        self.sock.settimeout(TCP_TIMEOUT)
+        try:
+            while not self.server.done:
+                data = recv_message(self.sock)
+                if data is None:
+                    break
+                with self.lock:
+                    self.pending += 1
+                self.server.stats["tcp_queries"] += 1
+                self.server.dispatch(RequestHandler(
+                    data, self.addr, self.server.zone, self, self.server,
+                    tcp=True))
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                self.reading = False
+                if self.pending == 0:
+                    self.close()
+
+    def finish(self):
+        """Note that a query has been handled"""
+        with self.lock:
+            self.pending -= 1
+            if not self.reading and self.pending == 0:
+                self.close()
+
+    def stop(self):
+        """Stop reading queries, the queries in progress are still answered"""
+        try:
+            self.sock.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+    def close(self):
+        """Close the connection, the lock must be held"""
+        self.server.connections.discard(self)
+        self.server.tcp_slots.release()
+        self.sock.close()
+
+
+class BufferPool:
+    """Reusable buffers for receiving packets"""
+
+    def __init__(self, size, count):
+        """Initialize the pool
+
+        Buffers are allocated when they are first needed. At most count free
+        buffers are kept.
+
+        Args:
+            size (int): size of a buffer in bytes
+            count (int): maximum number of free buffers
+        """
+        self.size = size
+        self.count = count
+        self.free = deque()
+
+    def get(self):
+        """Return a free buffer, allocating one if there is none"""
+        try:
+            return self.free.pop()
+        except IndexError:
+            return bytearray(self.size)
+
+    def put(self, buffer):
+        """Give a buffer back to the pool
+
+        Args:
+            buffer (bytearray): a buffer returned by get
+        """
+        if len(self.free) < self.count:
+            self.free.append(buffer)
+
+
+class AdmissionControl:
+    """Tracks how long requests wait for a worker
+
+    The delay is a moving average of the time between receiving a request and
+    starting to handle it. The server is overloaded while the delay is above
+    the target, and then sheds the requests that need a recursive lookup.
+    """
 
+    def __init__(self, target):
+        """Initialize the admission control
+
+        Args:
+            target (float): maximum delay in seconds, 0 never sheds requests
+        """
+        self.target = target
+        self.delay = 0.0
+
+    def record(self, received):
+        """Record the delay of a request that is about to be handled
+
+        Args:
+            received (float): time.monotonic() when the request was received
+        """
+        delay = time.monotonic() - received
+        self.delay += (delay - self.delay) * DELAY_WEIGHT
+
+    def overloaded(self):
+        """Return True if requests wait longer than the target"""
+        return self.target > 0 and self.delay > self.target
+
+
+class WorkerPool:
+    """A fixed number of threads handling queued requests"""
+
+    def __init__(self, size, depth, stats, admission=None):
+        """Initialize the pool
+
+        Args:
+            size (int): number of worker threads
+            depth (int): maximum number of queued requests
+            stats (Counter): counters of the server
+            admission (AdmissionControl): records the queueing delay of the
+                requests if not None
+        """
+        self.size = size
+        self.queue = Queue(depth)
+        self.stats = stats
+        self.admission = admission
+        self.workers = []
+
+    def start(self):
+        """Start the worker threads"""
+        for _ in range(self.size):
+            worker = Thread(target=self.work, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, handler):
+        """Queue a request
+
+        Args:
+            handler (RequestHandler): handler for the request
+
+        Returns:
+            bool: False if the queue is full and the request was not queued
+        """
+        try:
+            self.queue.put_nowait(handler)
+        except Full:
+            return False
+        return True
 
-        
-            
+    def work(self):
+        """Handle requests from the queue until shutdown"""
+        while True:
+            handler = self.queue.get()
+            if handler is None:
+                break
+            if self.admission is not None:
+                self.admission.record(handler.received)
+            try:
+                handler.run()
+            except Exception:
+                self.stats["errors"] += 1
+                try:
+                    handler.servfail()
+                except Exception:
+                    # Not even SERVFAIL can be sent, keep the worker alive
+                    pass
+            finally:
+                handler.close()
 
+    def shutdown(self, timeout=None):
+        """Stop the workers after they finished the queued requests
 
+        Args:
+            timeout (float): seconds to wait for the workers, None waits
+                until they are done
 
+        Returns:
+            bool: False if some workers were still busy after timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            for _ in self.workers:
+                self.queue.put(None, timeout=self.remaining(deadline))
+        except Full:
+            return False
+        for worker in self.workers:
+            worker.join(self.remaining(deadline))
+            if worker.is_alive():
+                return False
+        self.workers = []
+        return True
 
+    @staticmethod
+    def remaining(deadline):
+        """Return the seconds left until deadline, None if there is none"""
+        if deadline is None:
+            return None
+        return max(0, deadline - time.monotonic())
 
 
 class Server:
     """A recursive DNS server"""
 
-    def __init__(self, port, caching, ttl):
+    def __init__(self, port, caching, ttl, cache_size=10000,
+                 shared_cache=None, stale=0, workers=16, queue_depth=1000,
+                 overload="servfail", reuse_port=False, rate_limit=0,
+                 slip=2, shed_delay=0.1, zone_file=None, stagger=0):
         """Initialize the server
 
         Args:
             port (int): port that server is listening on
             caching (bool): server uses resolver with caching if true
             ttl (int): ttl for records (if > 0) of cache
+            cache_size (int): maximum number of entries in the cache
+            shared_cache (str): file for a cache shared with other server
+                processes, the cache is private to this server if None
+            stale (int): seconds to keep expired records to answer with when
+                the upstream servers do not respond in time, 0 disables this
+            workers (int): number of threads handling requests
+            queue_depth (int): maximum number of requests waiting for a worker
+            overload (str): "servfail" to answer requests that do not fit in
+                the queue with SERVFAIL, "drop" to drop them
+            reuse_port (bool): bind the port with SO_REUSEPORT, so that other
+                server processes can listen on it too
+            rate_limit (float): responses per second to a client network for
+                the same question over UDP, 0 disables rate limiting
+            slip (int): answer every slip-th rate limited query with a
+                truncated response instead of dropping it, 0 drops all
+            shed_delay (float): seconds queries may wait for a worker on
+                average, before queries that are not answered from the zone
+                or the cache are shed, 0 never sheds queries
+            zone_file (str): master file of the zone the server is
+                authoritative for, or None
+            stagger (float): seconds the resolver waits for a name server
+                before it races the next one, 0 asks one at a time
+
+        Raises:
+            ValueError: if stale is set together with shared_cache, which
+                does not keep expired records
         """
         self.caching = caching
         self.ttl = ttl
         self.port = port
         self.done = False
+        self.sock = None
+        self.listener = None
+        self.connections = set()
+        self.zone = None
+        self.cache = None
+        self.responses = ResponseCache(cache_size) if caching else None
+        if caching and shared_cache:
+            if stale:
+                raise ValueError("the shared cache can not serve stale "
+                                 "records")
+            self.cache = SharedRecordCache(ttl, shared_cache,
+                                           max_entries=cache_size)
+        elif caching:
+            self.cache = RecordCache(ttl, max_entries=cache_size, stale=stale)
+        self.resolver = Resolver(100, caching, 0, True, self.cache,
+                                 stagger=stagger)
+        self.stats = Counter()
+        self.qtypes = Counter()
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.admission = AdmissionControl(shed_delay)
+        self.pool = WorkerPool(workers, queue_depth, self.stats,
+                               self.admission)
+        self.buffers = BufferPool(RECEIVE_SIZE, workers + queue_depth)
+        self.overload = overload
+        self.reuse_port = reuse_port
+        self.tcp_slots = BoundedSemaphore(TCP_CONNECTIONS)
+        self.zone_file = zone_file
+        self.limiter = None
+        if rate_limit > 0:
+            self.limiter = RateLimiter(rate_limit, slip=slip)
 
-    def serve(self):
-        """Start serving requests"""
+    def statistics(self):
+        """Return the counters of the server, the resolver and the cache
+
+        Returns:
+            {str: int}: counters by name, such as "cache.hits"
+        """
+        stats = {}
+        for key, value in dict(self.stats).items():
+            stats["server." + key] = value
+        for qtype, value in dict(self.qtypes).items():
+            try:
+                qtype = str(Type(qtype))
+            except ValueError:
+                qtype = "TYPE{}".format(qtype)
+            stats["server.qtype.{}".format(qtype)] = value
+        for key, value in dict(self.resolver.stats).items():
+            stats["resolver." + key] = value
+        if self.cache is not None:
+            for key, value in dict(self.cache.stats).items():
+                stats["cache." + key] = value
+            stats["cache.entries"] = len(self.cache)
+        if self.responses is not None:
+            stats["responses.entries"] = len(self.responses)
+        if self.resolver.delegations is not None:
+            stats["delegations.entries"] = len(self.resolver.delegations)
+        stats["rtt.entries"] = len(self.resolver.servers)
+        for address, (srtt, timeouts) in self.resolver.servers.table().items():
+            stats["rtt.{}.srtt_ms".format(address)] = int(srtt)
+            stats["rtt.{}.timeouts".format(address)] = timeouts
+        stats["server.queue_delay_ms"] = int(self.admission.delay * 1000)
+        return stats
+
+    def load_zone(self):
+        """Read and compile the zone file
+
+        Returns:
+            Zone: the zone the server is authoritative for, empty if the
+                server has no zone file
+        """
         zone = Zone()
-        zone.read_master_file('zone')
+        if self.zone_file is not None:
+            zone.read_master_file(self.zone_file)
+        return zone
+
+    def setup(self):
+        """Read the zone and start the cache"""
+        self.zone = self.load_zone()
+        if self.cache is not None:
+            self.cache.start(lambda dname, type_, class_:
+                             self.resolver.gethostbyname(dname,
+                                                         usecache=False))
+
+    def reload(self):
+        """Read the zone file again and answer from the new zone
+
+        The new zone is compiled before it replaces the old one, which is
+        kept if the file can not be read.
+
+        Returns:
+            bool: True if the new zone is in use
+        """
+        try:
+            zone = self.load_zone()
+        except (OSError, ValueError) as error:
+            self.stats["zone_reload_errors"] += 1
+            print("could not reload zone: {}".format(error), file=sys.stderr)
+            return False
+        self.zone = zone
+        if self.responses is not None:
+            self.responses.clear()
+        self.stats["zone_reloads"] += 1
+        return True
+
+    def handle_signals(self):
+        """Reload the zone on SIGHUP and shut down on SIGTERM, must be called
+        from the main thread"""
+        signal.signal(signal.SIGHUP, lambda signum, frame: Thread(
+            target=self.reload, daemon=True).start())
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.shutdown())
+
+    def serve(self):
+        """Serve requests until the server is shut down
+
+        Queries that were received before the shutdown are still answered,
+        for up to DRAIN_TIMEOUT seconds.
+        """
+        self.setup()
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         sock.bind(('127.0.0.1',self.port))
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listener.bind(('127.0.0.1', self.port))
+        listener.listen()
+        self.sock = sock
+        self.listener = listener
+        Thread(target=self.serve_tcp, args=(listener,), daemon=True).start()
+        self.pool.start()
+        if self.done:
+            self.wake()
+        try:
+            while True:
+                buffer = self.buffers.get()
+                size, addr = sock.recvfrom_into(buffer)
+                if addr is None:
+                    # The socket has been shut down and is empty
+                    self.buffers.put(buffer)
+                    break
+                handler = RequestHandler(memoryview(buffer)[:size], addr,
+                                         self.zone, sock, self, buffer)
+                if self.limited(handler):
+                    handler.close()
+                else:
+                    self.dispatch(handler)
+        finally:
+            listener.close()
+            if not self.pool.shutdown(DRAIN_TIMEOUT):
+                self.stats["drain_timeouts"] += 1
+            sock.close()
+            self.finish()
+
+    def limited(self, handler):
+        """Apply response rate limiting to a query over UDP
+
+        Args:
+            handler (RequestHandler): handler for the query
+
+        Returns:
+            bool: True if the query has been dropped or slipped
+        """
+        if self.limiter is None:
+            return False
+        action = self.limiter.check(handler.addr, handler.data)
+        if action == ALLOW:
+            return False
+        self.stats["rate_limited"] += 1
+        if action == SLIP:
+            self.stats["slipped"] += 1
+            handler.slip()
+        return True
+
+    def dispatch(self, handler):
+        """Queue a request for the worker pool
+
+        Args:
+            handler (RequestHandler): handler for the request
+        """
+        if not self.pool.submit(handler):
+            self.stats["overload"] += 1
+            if self.overload == "servfail":
+                handler.servfail()
+            handler.close()
+
+    def serve_tcp(self, sock):
+        """Accept connections over TCP
+
+        Args:
+            sock (socket): the listening socket
+        """
         while not self.done:
-            data, addr = sock.recvfrom(65000) 
-            handler = RequestHandler(data, addr, zone, sock)
-            handler.start()
+            try:
+                conn, addr = sock.accept()
+            except OSError:
+                break
+            if not self.tcp_slots.acquire(blocking=False):
+                self.stats["tcp_refused"] += 1
+                conn.close()
+                continue
+            self.stats["tcp_connections"] += 1
+            connection = TCPConnection(conn, addr, self)
+            self.connections.add(connection)
+            if self.done:
+                connection.stop()
+            Thread(target=connection.serve, daemon=True).start()
 
-            
+    def wake(self):
+        """Make the receive loops return, the sockets stay open"""
+        for sock in (self.sock, self.listener):
+            if sock is None:
+                continue
+            try:
+                sock.shutdown(socket.SHUT_RD)
+            except OSError:
+                # Linux wakes up the receiver of an unconnected UDP socket,
+                # even though it reports ENOTCONN
+                pass
+        for connection in list(self.connections):
+            connection.stop()
 
     def shutdown(self):
-        """Shut the server down"""
+        """Shut the server down, can be called from a signal handler
+
+        The server stops receiving queries. serve returns when the queries it
+        received have been answered.
+        """
         self.done = True
+        self.wake()
+
+    def finish(self):
+        """Stop the cache and write its snapshot, and close the sockets of
+        the resolver"""
+        if self.cache is not None:
+            self.cache.shutdown()
+        self.resolver.transport.close()
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+
+"""A record cache shared between processes
+
+This module contains a cache with the same interface as RecordCache, which
+keeps its entries in a memory mapped file instead of in the memory of one
+process. Every server process that maps the same file sees the same cache.
+Put the file on a tmpfs such as /dev/shm to keep it in memory only.
+
+The file holds a hash table of fixed-size slots, grouped into buckets by the
+hash of the (name, type, class) key:
+
+    header:  magic "DNSS", version (H), buckets (I), slots per bucket (I),
+             slot size (I)
+    slot:    sequence (I), key hash (I), expiry time (d), kind (B, empty,
+             positive or negative), payload length (H), payload
+
+Readers do not lock. A writer makes the sequence number odd while it changes a
+slot and even again afterwards, and readers retry when the sequence changed
+while they copied the slot. Writers lock their bucket with a byte range lock
+on the file, so writers to different buckets never wait for each other. Byte
+range locks only exclude other processes, so threads of one process also
+take a lock from a small striped set of thread locks.
+
+Every process that maps the file holds a shared lock on a byte of the header.
+A process that finds a file of another size only initializes it again when it
+can lock that byte exclusively, so the file is never shrunk under a process
+that has it mapped.
+
+The payload of a slot is a list of entries of an expiry time (d), a length (H)
+and a resource record in wire format. For negative answers the single entry
+holds the question, the rcode (B) and the SOA record as in dns.snapshot.
+"""
+
+
+import fcntl
+import mmap
+import os
+import struct
+import time
+from collections import Counter
+from threading import Lock
+
+from dns.cache import normalize
+from dns.message import Question
+from dns.name import Name
+from dns.rcodes import RCode
+from dns.resource import ResourceRecord
+from dns.snapshot import keyhash
+from dns.types import Type
+
+
+MAGIC = b"DNSS"
+VERSION = 1
+HEADER = struct.Struct("!4sHIII")
+USERS = 1
+SLOT = struct.Struct("!IIdBH")
+ITEM = struct.Struct("!dH")
+EMPTY = 0
+POSITIVE = 1
+NEGATIVE = 2
+READ_RETRIES = 100
+THREAD_LOCKS = 64
+
+
+class SharedRecordCache:
+    """Cache for ResourceRecords in a shared memory mapped file"""
+
+    def __init__(self, ttl, filename, max_entries=10000, slots=8,
+                 slot_size=512):
+        """Initialize the SharedRecordCache
+
+        Args:
+            ttl (int): TTL of cached entries (if > 0), overrides record TTLs
+            filename (str): the shared file, created if it does not exist
+            max_entries (int): number of slots in the table
+            slots (int): number of slots per bucket
+            slot_size (int): size of a slot in bytes
+        """
+        self.ttl = ttl
+        self.stale = 0
+        self.filename = filename
+        self.slots = slots
+        self.slot_size = slot_size
+        self.buckets = max(1, max_entries // slots)
+        self.locks = [Lock() for _ in range(min(self.buckets, THREAD_LOCKS))]
+        self.fd = None
+        self.buf = None
+        self.stats = Counter()
+        self.attachments = []
+
+    def attach(self, suffix, table):
+        """Keep a table in a file next to the shared file
+
+        The table is read when the file is mapped and written when it is
+        unmapped. Processes that share the cache also share these files, the
+        last one to write wins.
+
+        Args:
+            suffix (str): appended to the name of the shared file
+            table (object): has read_file and write_file methods, which are
+                called with the name of its file
+        """
+        self.attachments.append((suffix, table))
+
+    def start(self, refresh=None):
+        """Map the shared file, creating and initializing it if needed
+
+        A file of another size is only initialized again when no other
+        process has it mapped.
+
+        Args:
+            refresh (callable): ignored, the shared cache does not prefetch
+
+        Raises:
+            ValueError: if the file has another size and is in use
+        """
+        for suffix, table in self.attachments:
+            table.read_file(self.filename + suffix)
+        self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o600)
+        size = HEADER.size + self.buckets * self.slots * self.slot_size
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, 0)
+        try:
+            header = os.pread(self.fd, HEADER.size, 0)
+            expected = HEADER.pack(MAGIC, VERSION, self.buckets, self.slots,
+                                   self.slot_size)
+            if header != expected or os.fstat(self.fd).st_size != size:
+                try:
+                    fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1,
+                                USERS)
+                except OSError:
+                    raise ValueError("shared cache {} is in use with another "
+                                     "size".format(self.filename)) from None
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, size)
+                os.pwrite(self.fd, expected, 0)
+            fcntl.lockf(self.fd, fcntl.LOCK_SH, 1, USERS)
+        except Exception:
+            os.close(self.fd)
+            self.fd = None
+            raise
+        else:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, 0)
+        self.buf = mmap.mmap(self.fd, size)
+
+    def shutdown(self):
+        """Flush and unmap the shared file"""
+        for suffix, table in self.attachments:
+            table.write_file(self.filename + suffix)
+        if self.buf is not None:
+            self.buf.flush()
+            self.buf.close()
+            self.buf = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def read_cache_file(self):
+        """Map the shared file, which holds the cache contents"""
+        if self.buf is None:
+            self.start()
+
+    def write_cache_file(self):
+        """Flush the shared file to disk"""
+        if self.buf is not None:
+            self.buf.flush()
+
+    def _offset(self, bucket, slot):
+        """Return the offset of a slot in the file"""
+        return HEADER.size + (bucket * self.slots + slot) * self.slot_size
+
+    def _read(self, offset):
+        """Return a consistent copy of a slot without locking
+
+        Returns:
+            bytes: the slot, or None if it kept changing while reading
+        """
+        for _ in range(READ_RETRIES):
+            seq = SLOT.unpack_from(self.buf, offset)[0]
+            if seq & 1:
+                continue
+            data = self.buf[offset:offset + self.slot_size]
+            if SLOT.unpack_from(self.buf, offset)[0] == seq:
+                return data
+        return None
+
+    def _find(self, key):
+        """Return (expires, kind, payload) of the slot holding key"""
+        hash_ = keyhash(key)
+        bucket = hash_ % self.buckets
+        for slot in range(self.slots):
+            data = self._read(self._offset(bucket, slot))
+            if data is None:
+                continue
+            _, shash, expires, kind, length = SLOT.unpack_from(data, 0)
+            if kind == EMPTY or shash != hash_:
+                continue
+            payload = data[SLOT.size:SLOT.size + length]
+            if self._key(payload) == key:
+                return expires, kind, payload
+        return None
+
+    @staticmethod
+    def _key(payload):
+        """Return the cache key of a slot payload"""
+        name, offset = Name.from_bytes(payload, ITEM.size)
+        type_, class_ = struct.unpack_from("!HH", payload, offset)
+        return normalize(name), type_, class_
+
+    @staticmethod
+    def _items(payload):
+        """Yield (expires, offset) for the entries of a payload"""
+        offset = 0
+        while offset < len(payload):
+            expires, length = ITEM.unpack_from(payload, offset)
+            yield expires, offset + ITEM.size
+            offset += ITEM.size + length
+
+    def lookup(self, dname, type_, class_):
+        """Lookup resource records in cache
+
+        Args:
+            dname (str): domain name
+            type_ (Type): type
+            class_ (Class): class
+        """
+        name = normalize(dname)
+        now = time.time()
+        if type_ != Type.ANY:
+            found = self._lookup_key((name, type_, class_), now)
+        else:
+            found = []
+            for rtype in Type:
+                found.extend(self._lookup_key((name, rtype, class_), now))
+        self.stats["hits" if found else "misses"] += 1
+        return found
+
+    def _lookup_key(self, key, now):
+        """Return the live records for key"""
+        slot = self._find(key)
+        if slot is None or slot[0] <= now or slot[1] != POSITIVE:
+            return []
+        found = []
+        for expires, offset in self._items(slot[2]):
+            if expires > now:
+                record = ResourceRecord.from_bytes(slot[2], offset)[0]
+                record.ttl = int(expires - now)
+                found.append(record)
+        return found
+
+    def lookup_negative(self, dname, type_, class_):
+        """Lookup a cached negative answer
+
+        Args:
+            dname (str): domain name
+            type_ (Type): type
+            class_ (Class): class
+
+        Returns:
+            (RCode, ResourceRecord): the rcode and the SOA record with its TTL
+                decremented, or None
+        """
+        now = time.time()
+        slot = self._find((normalize(dname), type_, class_))
+        if slot is None or slot[0] <= now or slot[1] != NEGATIVE:
+            return None
+        self.stats["negative_hits"] += 1
+        expires, payload = slot[0], slot[2]
+        _, offset = Question.from_bytes(payload, ITEM.size)
+        soa = ResourceRecord.from_bytes(payload, offset + 1)[0]
+        soa.ttl = int(expires - now)
+        return RCode(payload[offset]), soa
+
+    def lookup_stale(self, dname, type_, class_):
+        """The shared cache does not keep expired records"""
+        return []
+
+    def add_record(self, record, expires=None):
+        """Add a new Record to the cache
+
+        Records with a TTL of zero or less and record sets that do not fit in
+        a slot are not cached.
+
+        Args:
+            record (ResourceRecord): the record added to the cache
+            expires (float): absolute expiry time, computed from the TTL if
+                None
+        """
+        now = time.time()
+        if expires is None:
+            ttl = self.ttl if self.ttl > 0 else record.ttl
+            expires = now + ttl
+        if expires <= now:
+            return
+        key = (normalize(record.name), record.type_, record.class_)
+        rdata = record.rdata.to_bytes(0, None)
+        data = record.to_bytes(0, None)
+        item = ITEM.pack(expires, len(data)) + data
+
+        def merge(old):
+            items = [item]
+            for exp, offset in self._items(old):
+                cached = ResourceRecord.from_bytes(old, offset)[0]
+                if exp > now and cached.rdata.to_bytes(0, None) != rdata:
+                    length = ITEM.unpack_from(old, offset - ITEM.size)[1]
+                    items.append(old[offset - ITEM.size:offset + length])
+            return b"".join(items)
+        self._store(key, POSITIVE, merge, now)
+
+    def add_negative(self, dname, type_, class_, rcode, soa, expires=None):
+        """Add a negative answer to the cache
+
+        Args:
+            dname (str): domain name that was queried
+            type_ (Type): type that was queried
+            class_ (Class): class that was queried
+            rcode (RCode): NXDomain, or NoError for a NODATA answer
+            soa (ResourceRecord): SOA record from the authority section
+            expires (float): absolute expiry time, computed from the SOA if
+                None
+        """
+        now = time.time()
+        if expires is None:
+            expires = now + min(soa.ttl, soa.rdata.minimum)
+        if expires <= now:
+            return
+        key = (normalize(dname), type_, class_)
+        data = Question(Name(key[0]), type_, class_).to_bytes(0, None)
+        data += struct.pack("!B", rcode)
+        data += soa.to_bytes(len(data), None)
+        payload = ITEM.pack(expires, len(data)) + data
+        self._store(key, NEGATIVE, lambda old: payload, now)
+
+    def _store(self, key, kind, build, now):
+        """Write an entry into the slot for key
+
+        The slot already holding the key is reused, otherwise an empty or
+        expired slot, otherwise the slot that expires first.
+
+        Args:
+            key ((str, Type, Class)): normalized cache key
+            kind (int): POSITIVE or NEGATIVE
+            build (callable): returns the new payload given the payload that
+                is currently cached for key as a positive entry
+            now (float): current time
+        """
+        hash_ = keyhash(key)
+        bucket = hash_ % self.buckets
+        lockpos = HEADER.size + bucket * self.slots * self.slot_size
+        with self.locks[bucket % len(self.locks)]:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, lockpos)
+            try:
+                self._write(key, hash_, bucket, kind, build, now)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, lockpos)
+
+    def _write(self, key, hash_, bucket, kind, build, now):
+        """Write an entry into a bucket, the bucket must be locked"""
+        target, old, earliest = None, b"", None
+        for slot in range(self.slots):
+            offset = self._offset(bucket, slot)
+            _, shash, expires, skind, length = SLOT.unpack_from(
+                self.buf, offset)
+            payload = self.buf[offset + SLOT.size:
+                               offset + SLOT.size + length]
+            if skind != EMPTY and shash == hash_ and \
+                    self._key(payload) == key:
+                target = offset
+                if skind == POSITIVE and expires > now:
+                    old = payload
+                break
+            if earliest is None or expires < earliest[0]:
+                earliest = (expires, offset)
+        if target is None:
+            target = earliest[1]
+        payload = build(old)
+        if SLOT.size + len(payload) > self.slot_size:
+            return
+        expires = max(exp for exp, _ in self._items(payload))
+        seq = SLOT.unpack_from(self.buf, target)[0]
+        struct.pack_into("!I", self.buf, target, (seq + 1) & 0xffffffff)
+        self.buf[target + SLOT.size:target + SLOT.size + len(payload)] = \
+            payload
+        struct.pack_into("!IdBH", self.buf, target + 4, hash_, expires,
+                         kind, len(payload))
+        struct.pack_into("!I", self.buf, target, (seq + 2) & 0xffffffff)
+
+    def expire(self):
+        """Expired slots are reused by writers, nothing to do"""
+
+    def __len__(self):
+        now = time.time()
+        count = 0
+        for bucket in range(self.buckets):
+            for slot in range(self.slots):
+                _, _, expires, kind, _ = SLOT.unpack_from(
+                    self.buf, self._offset(bucket, slot))
+                if kind != EMPTY and expires > now:
+                    count += 1
+        return count
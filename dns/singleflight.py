@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+"""Coalescing of identical lookups
+
+When many threads want the same thing at the same moment, only the first one
+does the work. The others wait for it and get the same result, or the same
+exception.
+"""
+
+from collections import Counter
+from threading import Event, Lock
+
+
+class Flight:
+    """A lookup in progress"""
+
+    def __init__(self):
+        """Initialize the flight"""
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs at most one call at a time for every key"""
+
+    def __init__(self, stats=None):
+        """Initialize the SingleFlight
+
+        Args:
+            stats (Counter): counters to count "coalesced" calls in, which
+                waited for another call instead of running
+        """
+        self.flights = {}
+        self.lock = Lock()
+        self.stats = stats if stats is not None else Counter()
+
+    def do(self, key, function, *args):
+        """Call function, or wait for the call in progress for key
+
+        Args:
+            key (object): hashable key of the call
+            function (callable): the function to call
+            args: arguments for function
+
+        Returns:
+            object: the result of the call
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+        if not leader:
+            self.stats["coalesced"] += 1
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = function(*args)
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result
+
+    def __len__(self):
+        return len(self.flights)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+"""Binary snapshots of the record cache
+
+A snapshot starts with a header and a bucket index, followed by the entries.
+Entries are grouped by the CRC32 of their (name, type, class) key, so the
+records for one key are found by reading a single bucket of the memory mapped
+file. Nothing else in the snapshot has to be decoded, which makes loading a
+snapshot independent of its size.
+
+    header:  magic "DNSC", version (H), number of buckets (I)
+    index:   number of buckets + 1 offsets (Q) to the first entry of a bucket
+    entry:   expiry time (d), kind (B), payload length (H), payload
+
+The payload of a positive entry is a resource record in wire format. The
+payload of a negative entry is the question in wire format, followed by the
+rcode (B) and the SOA record in wire format. Names are never compressed.
+"""
+
+
+import mmap
+import os
+import struct
+import zlib
+
+from dns.classes import Class
+from dns.message import Question
+from dns.name import Name
+from dns.rcodes import RCode
+from dns.resource import ResourceRecord
+from dns.types import Type
+
+
+MAGIC = b"DNSC"
+VERSION = 1
+HEADER = struct.Struct("!4sHI")
+OFFSET = struct.Struct("!Q")
+ENTRY = struct.Struct("!dBH")
+
+POSITIVE = 0
+NEGATIVE = 1
+
+
+def keyhash(key):
+    """Return the stable hash of a (name, type, class) cache key
+
+    Args:
+        key ((str, Type, Class)): normalized cache key
+    """
+    name, type_, class_ = key
+    return zlib.crc32(name.encode("utf-8") + struct.pack("!HH", type_, class_))
+
+
+class SnapshotWriter:
+    """Builds a snapshot file from cache entries"""
+
+    def __init__(self):
+        """Initialize an empty snapshot"""
+        self.entries = []
+
+    def add_record(self, key, expires, record):
+        """Add a positive entry
+
+        Args:
+            key ((str, Type, Class)): normalized cache key
+            expires (float): absolute expiry time
+            record (ResourceRecord): the cached record
+        """
+        self.add_raw(key, expires, POSITIVE, record.to_bytes(0, None))
+
+    def add_negative(self, key, expires, rcode, soa):
+        """Add a negative entry
+
+        Args:
+            key ((str, Type, Class)): normalized cache key
+            expires (float): absolute expiry time
+            rcode (RCode): NXDomain, or NoError for NODATA
+            soa (ResourceRecord): the SOA record of the negative answer
+        """
+        name, type_, class_ = key
+        payload = Question(Name(name), type_, class_).to_bytes(0, None)
+        payload += struct.pack("!B", rcode)
+        payload += soa.to_bytes(len(payload), None)
+        self.add_raw(key, expires, NEGATIVE, payload)
+
+    def add_raw(self, key, expires, kind, payload):
+        """Add an entry with an already encoded payload
+
+        Args:
+            key ((str, Type, Class)): normalized cache key
+            expires (float): absolute expiry time
+            kind (int): POSITIVE or NEGATIVE
+            payload (bytes): encoded payload
+        """
+        self.entries.append((keyhash(key), expires, kind, payload))
+
+    def write(self, filename):
+        """Write the snapshot to a file
+
+        The file is written under a temporary name and moved into place, so
+        readers never see a partial snapshot.
+
+        Args:
+            filename (str): name of the snapshot file
+        """
+        nbuckets = max(1, len(self.entries))
+        buckets = [[] for _ in range(nbuckets)]
+        for hash_, expires, kind, payload in self.entries:
+            buckets[hash_ % nbuckets].append(
+                ENTRY.pack(expires, kind, len(payload)) + payload)
+
+        index = []
+        offset = HEADER.size + OFFSET.size * (nbuckets + 1)
+        for bucket in buckets:
+            index.append(OFFSET.pack(offset))
+            offset += sum(len(entry) for entry in bucket)
+        index.append(OFFSET.pack(offset))
+
+        tmpname = "{}.{}.tmp".format(filename, os.getpid())
+        with open(tmpname, "wb") as file_:
+            file_.write(HEADER.pack(MAGIC, VERSION, nbuckets))
+            file_.write(b"".join(index))
+            for bucket in buckets:
+                file_.write(b"".join(bucket))
+        os.replace(tmpname, filename)
+
+
+class Snapshot:
+    """A memory mapped snapshot file
+
+    Entries are only decoded when they are looked up.
+    """
+
+    def __init__(self, buf):
+        """Initialize the snapshot
+
+        Args:
+            buf (mmap): the mapped snapshot file
+        """
+        self.buf = buf
+        magic, version, self.nbuckets = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a cache snapshot")
+
+    @classmethod
+    def open(cls, filename):
+        """Map a snapshot file into memory
+
+        Args:
+            filename (str): name of the snapshot file
+
+        Raises:
+            OSError: if the file can not be mapped
+            ValueError: if the file is not a snapshot of this version
+        """
+        with open(filename, "rb") as file_:
+            if os.fstat(file_.fileno()).st_size < HEADER.size:
+                raise ValueError("not a cache snapshot")
+            buf = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buf)
+
+    def _bucket(self, index):
+        """Return the start and end offset of a bucket"""
+        offset = HEADER.size + OFFSET.size * index
+        start = OFFSET.unpack_from(self.buf, offset)[0]
+        end = OFFSET.unpack_from(self.buf, offset + OFFSET.size)[0]
+        return start, end
+
+    def _entries(self, start, end):
+        """Yield (key, expires, kind, offset, length) for a range of entries"""
+        while start < end:
+            expires, kind, length = ENTRY.unpack_from(self.buf, start)
+            offset = start + ENTRY.size
+            name, keyend = Name.from_bytes(self.buf, offset)
+            type_, class_ = struct.unpack_from("!HH", self.buf, keyend)
+            key = (str(name).lower() or ".", Type(type_), Class(class_))
+            yield key, expires, kind, offset, length
+            start = offset + length
+
+    def find(self, key):
+        """Return the decoded entries for a key
+
+        Args:
+            key ((str, Type, Class)): normalized cache key
+
+        Returns:
+            [(float, int, object)]: (expires, kind, value) tuples, where value
+                is a ResourceRecord for positive entries and a (RCode,
+                ResourceRecord) tuple for negative entries
+        """
+        start, end = self._bucket(keyhash(key) % self.nbuckets)
+        found = []
+        for ekey, expires, kind, offset, _ in self._entries(start, end):
+            if ekey == key:
+                found.append((expires, kind, self._decode(kind, offset)))
+        return found
+
+    def _decode(self, kind, offset):
+        """Decode the payload of an entry"""
+        if kind == POSITIVE:
+            return ResourceRecord.from_bytes(self.buf, offset)[0]
+        _, offset = Question.from_bytes(self.buf, offset)
+        rcode = RCode(self.buf[offset])
+        return rcode, ResourceRecord.from_bytes(self.buf, offset + 1)[0]
+
+    def __iter__(self):
+        """Yield (key, expires, kind, payload) for every entry"""
+        start = self._bucket(0)[0]
+        end = OFFSET.unpack_from(
+            self.buf, HEADER.size + OFFSET.size * self.nbuckets)[0]
+        for key, expires, kind, offset, length in self._entries(start, end):
+            yield key, expires, kind, self.buf[offset:offset + length]
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+"""A supervisor for server worker processes
+
+This module runs a number of server processes that all listen on the same
+port. Every worker binds its own socket with SO_REUSEPORT and the kernel
+spreads the queries over them, so the workers do not share a GIL.
+
+The supervisor restarts workers that exit. A worker that dies within
+RESTART_DELAY seconds of being started is restarted after that delay, so a
+worker that can not start does not make the supervisor spin.
+
+Every worker writes its counters as a line of JSON to a pipe to the supervisor
+every few seconds. The supervisor adds up the counters of all workers,
+including the last counters of workers that were restarted. Sending SIGUSR1 to
+the supervisor prints the totals.
+
+SIGHUP is passed on to the workers, which reload their zone. The workers are
+stopped with SIGTERM, so they answer the queries they received before they
+exit.
+"""
+
+import json
+import os
+import select
+import signal
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+
+RESTART_DELAY = 1.0
+
+
+class Worker:
+    """A worker process as seen by the supervisor"""
+
+    def __init__(self, index, pid, fd):
+        """Initialize the worker
+
+        Args:
+            index (int): number of the worker
+            pid (int): process id
+            fd (int): read end of the pipe the worker reports its counters on
+        """
+        self.index = index
+        self.pid = pid
+        self.fd = fd
+        self.started = time.time()
+        self.buffer = b""
+        self.stats = {}
+
+    def read(self):
+        """Read the reports that are available on the pipe
+
+        Returns:
+            bool: False if the pipe has been closed by the worker
+        """
+        data = os.read(self.fd, 65536)
+        if not data:
+            return False
+        lines = (self.buffer + data).split(b"\n")
+        self.buffer = lines.pop()
+        for line in reversed(lines):
+            try:
+                self.stats = json.loads(line.decode("utf-8"))
+                break
+            except ValueError:
+                continue
+        return True
+
+
+class Supervisor:
+    """Runs server worker processes and restarts them when they exit"""
+
+    def __init__(self, factory, workers, interval=5):
+        """Initialize the supervisor
+
+        Args:
+            factory (callable): returns a new server, called in the worker
+                process. The server must bind its port with SO_REUSEPORT.
+            workers (int): number of worker processes
+            interval (float): seconds between reports of the workers
+        """
+        self.factory = factory
+        self.workers = workers
+        self.interval = interval
+        self.children = {}
+        self.restarts = []
+        self.retired = Counter()
+        self.stats = Counter()
+        self.done = False
+
+    def start(self):
+        """Start all workers"""
+        for index in range(self.workers):
+            self.spawn(index)
+
+    def spawn(self, index):
+        """Start a worker process
+
+        Args:
+            index (int): number of the worker
+        """
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            self.work(wfd)
+        os.close(wfd)
+        self.children[pid] = Worker(index, pid, rfd)
+        self.stats["spawned"] += 1
+
+    def work(self, wfd):
+        """Run a server in the worker process, never returns
+
+        Args:
+            wfd (int): write end of the pipe to the supervisor
+        """
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        code = 0
+        try:
+            server = self.factory()
+            server.handle_signals()
+
+            def report():
+                while True:
+                    line = json.dumps(server.statistics()) + "\n"
+                    os.write(wfd, line.encode("utf-8"))
+                    time.sleep(self.interval)
+            threading.Thread(target=report, daemon=True).start()
+            server.serve()
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def poll(self, timeout):
+        """Collect reports, reap exited workers and restart them
+
+        Args:
+            timeout (float): seconds to wait for reports
+        """
+        fds = {worker.fd: worker for worker in self.children.values()}
+        if fds:
+            readable = select.select(list(fds), [], [], timeout)[0]
+            for fd in readable:
+                fds[fd].read()
+        else:
+            time.sleep(timeout)
+        self.reap()
+        now = time.time()
+        for due, index in list(self.restarts):
+            if due <= now and not self.done:
+                self.restarts.remove((due, index))
+                self.stats["restarts"] += 1
+                self.spawn(index)
+
+    def reap(self):
+        """Schedule a restart for every worker that exited"""
+        while self.children:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            worker = self.retire(pid)
+            delay = RESTART_DELAY
+            if time.time() - worker.started >= RESTART_DELAY:
+                delay = 0
+            self.restarts.append((time.time() + delay, worker.index))
+
+    def retire(self, pid):
+        """Forget an exited worker and keep its counters
+
+        Args:
+            pid (int): process id of the worker
+
+        Returns:
+            Worker: the worker
+        """
+        worker = self.children.pop(pid)
+        while worker.read():
+            pass
+        os.close(worker.fd)
+        for key, value in worker.stats.items():
+            if not key.endswith(".entries"):
+                self.retired[key] += value
+        return worker
+
+    def statistics(self):
+        """Return the counters of all workers added up
+
+        Returns:
+            {str: int}: counters by name, such as "cache.hits"
+        """
+        stats = Counter(self.retired)
+        for worker in self.children.values():
+            stats.update(worker.stats)
+        for key, value in self.stats.items():
+            stats["supervisor." + key] = value
+        stats["supervisor.workers"] = len(self.children)
+        return dict(stats)
+
+    def report(self):
+        """Print the counters of all workers"""
+        for key, value in sorted(self.statistics().items()):
+            print("{}={}".format(key, value))
+        sys.stdout.flush()
+
+    def reload(self):
+        """Make all workers reload their zone"""
+        self.stats["reloads"] += 1
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+
+    def stop(self):
+        """Terminate all workers and wait for them to exit"""
+        self.done = True
+        self.restarts = []
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(self.children):
+            os.waitpid(pid, 0)
+            self.retire(pid)
+
+    def run(self):
+        """Run the workers until SIGINT or SIGTERM, must be called from the
+        main thread"""
+        def stop(signum, frame):
+            self.done = True
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.reload())
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.report())
+        self.start()
+        while not self.done:
+            self.poll(1)
+        self.stop()
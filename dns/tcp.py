@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+"""DNS messages over TCP
+
+Over TCP every message is preceded by its length as a two byte integer, see
+section 4.2.2 of RFC 1035 and RFC 7766.
+"""
+
+import struct
+
+
+def send_message(sock, data):
+    """Send a message on a TCP socket
+
+    Args:
+        sock (socket): connected socket
+        data (bytes): the encoded message
+    """
+    sock.sendall(struct.pack("!H", len(data)) + bytes(data))
+
+
+def recv_exact(sock, size):
+    """Receive exactly size bytes from a TCP socket
+
+    Returns:
+        bytes: the data, or None if the connection was closed before size
+            bytes were received
+    """
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def recv_message(sock):
+    """Receive a message from a TCP socket
+
+    Args:
+        sock (socket): connected socket
+
+    Returns:
+        bytes: the encoded message, or None if the connection was closed
+    """
+    prefix = recv_exact(sock, 2)
+    if prefix is None:
+        return None
+    return recv_exact(sock, struct.unpack("!H", prefix)[0])
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+"""UDP transport for the resolver
+
+This module sends the queries of the resolver over a small pool of long-lived
+UDP sockets. Each socket is bound to a random source port, and every query
+gets a random ID. A single thread receives on all sockets. It hands every
+response to the query it answers, which is found by the socket, the address
+and port of the server, the ID and the question. Responses that match no
+outstanding query are dropped, which makes forged responses hard to get
+accepted (RFC 5452). One socket can carry thousands of outstanding queries.
+"""
+
+import asyncio
+import random
+import selectors
+import socket
+import struct
+import time
+from collections import Counter
+from itertools import count
+from threading import Lock, Thread
+
+from dns.ratelimit import question
+
+
+SOCKETS = 4
+PORT = 53
+RECEIVE_SIZE = 65535
+PORT_RANGE = (1024, 65535)
+BIND_TRIES = 10
+
+_random = random.SystemRandom()
+
+
+def random_ident():
+    """Return a random 16 bit query ID"""
+    return _random.getrandbits(16)
+
+
+class Pending:
+    """A query waiting for its response"""
+
+    def __init__(self, key, server, replies):
+        """Initialize the query
+
+        Args:
+            key (tuple): (socket, address, port, ID, question) of the response
+            server (str): the server the query was sent to
+            replies (object): has a put method, which is called with this
+                query when the response arrives
+        """
+        self.key = key
+        self.server = server
+        self.replies = replies
+        self.sent = time.monotonic()
+        self.received = None
+        self.response = None
+
+    def rtt(self):
+        """Return the seconds from sending the query to the response"""
+        return self.received - self.sent
+
+
+class LoopReplies:
+    """Hands responses from the receiving thread to an event loop"""
+
+    def __init__(self, loop):
+        """Initialize the LoopReplies
+
+        Args:
+            loop (AbstractEventLoop): the loop of the waiting coroutine
+        """
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def put(self, pending):
+        """Queue an answered query, called by the receiving thread"""
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, pending)
+        except RuntimeError:
+            # The loop has been closed, nobody waits for the response
+            pass
+
+    async def get(self):
+        """Return the next answered query"""
+        return await self.queue.get()
+
+
+class Transport:
+    """Sends queries over pooled UDP sockets and routes the responses"""
+
+    def __init__(self, sockets=SOCKETS, stats=None, port=PORT):
+        """Initialize the Transport
+
+        The sockets and the receiving thread are started by the first query.
+
+        Args:
+            sockets (int): number of sockets in the pool
+            stats (Counter): counters to count "unmatched" responses in
+            port (int): port of the servers
+        """
+        self.size = sockets
+        self.port = port
+        self.stats = stats if stats is not None else Counter()
+        self.sockets = []
+        self.pending = {}
+        self.lock = Lock()
+        self.turn = count()
+        self.selector = None
+        self.waker = None
+        self.receiver = None
+
+    def start(self):
+        """Open the sockets and start receiving"""
+        with self.lock:
+            if self.receiver is not None:
+                return
+            self.selector = selectors.DefaultSelector()
+            self.waker = socket.socketpair()
+            self.selector.register(self.waker[0], selectors.EVENT_READ)
+            sockets = [self.open() for _ in range(self.size)]
+            for sock in sockets:
+                self.selector.register(sock, selectors.EVENT_READ)
+            self.sockets = sockets
+            self.receiver = Thread(target=self.receive, daemon=True)
+            self.receiver.start()
+
+    def open(self):
+        """Return a UDP socket bound to a random port"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for _ in range(BIND_TRIES):
+            try:
+                sock.bind(("", _random.randint(*PORT_RANGE)))
+                return sock
+            except OSError:
+                continue
+        sock.bind(("", 0))
+        return sock
+
+    def send(self, data, server, replies):
+        """Send a query with a new random ID
+
+        Args:
+            data (bytes): the encoded query, its ID is replaced
+            server (str): address or host name of the server
+            replies (object): has a put method, which is called with the
+                Pending query when the response arrives
+
+        Returns:
+            Pending: the query, to be cancelled when no longer needed
+        """
+        if self.receiver is None:
+            self.start()
+        address = socket.gethostbyname(server)
+        sock = self.sockets[next(self.turn) % len(self.sockets)]
+        asked = question(data)
+        with self.lock:
+            while True:
+                ident = random_ident()
+                key = (sock, address, self.port, ident, asked)
+                if key not in self.pending:
+                    break
+            pending = self.pending[key] = Pending(key, server, replies)
+        try:
+            sock.sendto(struct.pack("!H", ident) + bytes(data[2:]),
+                        (address, self.port))
+        except OSError:
+            self.cancel(pending)
+            raise
+        return pending
+
+    def cancel(self, pending):
+        """Stop waiting for the response to a query
+
+        Args:
+            pending (Pending): the query
+        """
+        with self.lock:
+            if self.pending.get(pending.key) is pending:
+                del self.pending[pending.key]
+
+    def receive(self):
+        """Hand the responses on all sockets to their queries until close"""
+        while True:
+            for key, _ in self.selector.select():
+                sock = key.fileobj
+                if sock is self.waker[0]:
+                    return
+                try:
+                    data, addr = sock.recvfrom(RECEIVE_SIZE)
+                except OSError:
+                    continue
+                if len(data) < 12:
+                    self.stats["unmatched"] += 1
+                    continue
+                ident = struct.unpack_from("!H", data)[0]
+                match = (sock, addr[0], addr[1], ident, question(data))
+                with self.lock:
+                    pending = self.pending.pop(match, None)
+                if pending is None:
+                    self.stats["unmatched"] += 1
+                    continue
+                pending.received = time.monotonic()
+                pending.response = data
+                pending.replies.put(pending)
+
+    def close(self):
+        """Stop receiving and close the sockets"""
+        with self.lock:
+            receiver, self.receiver = self.receiver, None
+        if receiver is None:
+            return
+        self.waker[1].send(b"\0")
+        receiver.join()
+        self.selector.close()
+        for sock in self.sockets + list(self.waker):
+            sock.close()
+        self.sockets = []
+
+    def __len__(self):
+        return len(self.pending)
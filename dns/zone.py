@@ -7,8 +7,107 @@ Instead of tree structures we simply use dictionaries from domain names to
 zones or record sets.
 
 These classes are merely a suggestion, feel free to use something else.
+
+A zone never changes after its master file has been read, so every response
+the server can give from it is compiled into wire format right away: the
+answers for every (name, type), the empty answers for names without records of
+a type, the referrals for delegated names and NXDOMAIN. Answering a query is
+then a lookup in a dictionary, and copying the ID, the RD flag and the
+question of the query into the response.
 """
 
+import struct
+
+from dns.classes import Class
+from dns.message import Question
+from dns.name import Name
+from dns.rcodes import RCode
+from dns.resource import ResourceRecord, ARecordData, CNAMERecordData
+from dns.resource import NSRecordData, SOARecordData
+from dns.types import Type
+
+
+HEADER = struct.Struct("!6H")
+QR = 0x8000
+AA = 0x0400
+RD = 0x0100
+RA = 0x0080
+MAX_CHAIN = 8
+
+
+def key(name):
+    """Return the key of a domain name in Zone.records
+
+    Args:
+        name (Name/str): domain name
+    """
+    return str(Name(str(name))).lower() or "."
+
+
+def wire(name):
+    """Return a domain name in lower case wire format
+
+    Args:
+        name (str): domain name
+    """
+    return Name(name if name != "." else "").to_bytes(0, None).lower()
+
+
+def parent(name):
+    """Return the parent of a domain name key, None for the root"""
+    if name == ".":
+        return None
+    return name.split(".", 1)[1] or "."
+
+
+def within(name, origin):
+    """Return True if the domain name key is at or below origin"""
+    return origin == "." or name == origin or name.endswith("." + origin)
+
+
+def encode(records, offset, compress):
+    """Encode resource records
+
+    Args:
+        records ([ResourceRecord]): the records
+        offset (int): offset of the first record in the message
+        compress (dict): names for compression, or None to not compress
+
+    Returns:
+        bytes: the encoded records
+    """
+    data = b""
+    for record in records:
+        data += record.to_bytes(offset + len(data), compress)
+    return data
+
+
+def parse_rdata(type_, fields):
+    """Create record data from the fields of a master file line
+
+    Args:
+        type_ (Type): type of the record
+        fields ([str]): the fields after the type
+
+    Returns:
+        RecordData: the record data, or None if the type is not supported
+    """
+    if type_ == Type.A:
+        address, = fields
+        return ARecordData(address)
+    if type_ == Type.NS:
+        nsdname, = fields
+        return NSRecordData(Name(nsdname))
+    if type_ == Type.CNAME:
+        cname, = fields
+        return CNAMERecordData(Name(cname))
+    if type_ == Type.SOA:
+        mname, rname, serial, refresh, retry, expire, minimum = fields
+        return SOARecordData(Name(mname), Name(rname), int(serial),
+                             int(refresh), int(retry), int(expire),
+                             int(minimum))
+    return None
+
 
 class Catalog:
     """A catalog of zones"""
@@ -33,6 +132,13 @@ class Zone:
     def __init__(self):
         """Initialize the Zone """
         self.records = {}
+        self.origin = None
+        self.class_ = Class.IN
+        self.soa = None
+        self.names = set()
+        self.answers = {}
+        self.referrals = {}
+        self.nxdomain = None
 
     def add_node(self, name, record_set):
         """Add a record set to the zone
@@ -41,33 +147,346 @@ class Zone:
             name (str): domain name
             record_set ([ResourceRecord]): resource records
         """
-        self.records[name] = record_set
+        self.records[key(name)] = record_set
+
+    def add_record(self, record):
+        """Add a resource record to the zone
+
+        Args:
+            record (ResourceRecord): the record
+        """
+        self.records.setdefault(key(record.name), []).append(record)
 
     def read_master_file(self, filename):
         """Read the zone from a master file
 
-        See section 5 of RFC 1035.
+        See section 5 of RFC 1035. Lines hold a resource record, with or
+        without a domain name, as [<TTL>][<class>]<type><rdata> or
+        [<class>][<TTL>]<type><rdata>. Records without a domain name belong to
+        the previous name, and a missing TTL or class is the last one given.
+        Parentheses continue a record on the next lines and comments start
+        with a semicolon. Records of types other than A, NS, CNAME and SOA are
+        skipped. The zone is compiled after reading.
 
         Args:
             filename (str): the filename of the master file
+
+        Raises:
+            ValueError: if the master file is not a valid zone
         """
-        with open("zone") as f:
-            content = f.readlines()
-        content = [x.strip() for x in content] #Remove empty lines
+        with open(filename) as file_:
+            lines = file_.read().splitlines()
 
-        contentcleaned = [x for x in content if not (x[0] == ';') and not  "AAAA" in x] #Remove AAAA types and comments
+        owner, ttl, class_ = None, None, None
+        for number, line in self._entries(lines):
+            fields = line.split()
+            if not fields:
+                continue
+            if not line[0].isspace():
+                owner = fields.pop(0)
+            elif owner is None:
+                raise ValueError("line {}: no domain name".format(number))
+            for _ in range(2):
+                if fields and fields[0].isdigit():
+                    ttl = int(fields.pop(0))
+                elif fields and fields[0].upper() in Class.__members__:
+                    class_ = Class[fields.pop(0).upper()]
+            if not fields or fields[0].upper() not in Type.__members__:
+                raise ValueError("line {}: no valid type".format(number))
+            type_ = Type[fields.pop(0).upper()]
+            if ttl is None:
+                raise ValueError("line {}: no TTL".format(number))
+            try:
+                rdata = parse_rdata(type_, fields)
+            except ValueError:
+                raise ValueError("line {}: invalid {} record".format(
+                    number, type_))
+            if rdata is not None:
+                self.add_record(ResourceRecord(Name(owner.rstrip(".")), type_,
+                                               class_ or Class.IN, ttl,
+                                               rdata))
+        self.compile()
 
-        for y in contentcleaned:
-            #y[0] = Either '.' or Domain Name
-            #y[1] = First index in [<Class>][<TTL]<type><rdata> or [<TTL>][<Class]<type><rdata>
-            #y[2] = etc
-            #y[3] = etc
-            add_node(self, y[0], ResourceRecord.from_dict(
-                                 { "name" : str(y[0]) ,
-                                   "type" : str(y[2]) ,
-                                   "class": str(Class.IN) ,
-                                   "ttl"  : str(y[1]),
-                                   "rdata": { "address" : y[3] } } ))
+    @staticmethod
+    def _entries(lines):
+        """Yield (line number, entry) for a master file
 
+        Comments are removed and entries in parentheses are joined.
+        """
+        entry, start = None, 0
+        for number, line in enumerate(lines, 1):
+            line = line.split(";", 1)[0]
+            if entry is None:
+                entry, start = line, number
+            else:
+                entry += " " + line
+            if entry.count("(") > entry.count(")"):
+                continue
+            yield start, entry.replace("(", " ").replace(")", " ")
+            entry = None
+        if entry is not None:
+            raise ValueError("line {}: unbalanced parentheses".format(start))
+
+    def check(self):
+        """Check that the records form a zone
+
+        Raises:
+            ValueError: if the zone does not have exactly one SOA record, has
+                names outside the zone, records of more than one class, data
+                below a delegation that is not glue or a delegation without
+                the glue it needs
+        """
+        records = [rr for rrset in self.records.values() for rr in rrset]
+        if not records:
+            return
+        if len({rr.class_ for rr in records}) > 1:
+            raise ValueError("records of more than one class")
+        soas = [rr for rr in records if rr.type_ == Type.SOA]
+        if len(soas) != 1:
+            raise ValueError("a zone needs exactly one SOA record")
+        origin = key(soas[0].name)
+        for name in self.records:
+            if not within(name, origin):
+                raise ValueError("{} is outside the zone {}".format(name,
+                                                                    origin))
+        cuts = self._cuts(origin)
+        glue = set()
+        for cut in cuts:
+            for rr in self.records[cut]:
+                if rr.type_ != Type.NS:
+                    continue
+                target = key(rr.rdata.nsdname)
+                if not within(target, cut):
+                    continue
+                if not any(a.type_ == Type.A
+                           for a in self.records.get(target, [])):
+                    raise ValueError("no glue for {}".format(target))
+                glue.add(target)
+        for name, rrset in self.records.items():
+            if self._cut(name, cuts, origin) in (None, name):
+                continue
+            if name not in glue or any(rr.type_ != Type.A for rr in rrset):
+                raise ValueError("{} is below a delegation and not glue"
+                                 .format(name))
 
+    def _cuts(self, origin):
+        """Return the names below origin that are delegated"""
+        return {name for name, rrset in self.records.items()
+                if name != origin and any(rr.type_ == Type.NS for rr in rrset)}
 
+    @staticmethod
+    def _cut(name, cuts, origin):
+        """Return the highest delegation at or above name, or None"""
+        found = None
+        while name is not None and name != origin:
+            if name in cuts:
+                found = name
+            name = parent(name)
+        return found
+
+    def compile(self):
+        """Check the zone and compile all of its responses
+
+        Raises:
+            ValueError: if the records do not form a zone, see check
+        """
+        self.check()
+        self.answers = {}
+        self.referrals = {}
+        self.nxdomain = None
+        soas = [rr for rrset in self.records.values() for rr in rrset
+                if rr.type_ == Type.SOA]
+        if not soas:
+            self.origin = None
+            return
+        soa = soas[0]
+        self.origin = key(soa.name)
+        self.class_ = soa.class_
+        self.soa = ResourceRecord(soa.name, Type.SOA, soa.class_,
+                                  min(soa.ttl, soa.rdata.minimum), soa.rdata)
+        cuts = self._cuts(self.origin)
+
+        for cut in cuts:
+            ns = [rr for rr in self.records[cut] if rr.type_ == Type.NS]
+            self.referrals[wire(cut)] = self._template(
+                None, RCode.NoError, False, [], ns, self._glue(ns))
+        self.nxdomain = self._template(None, RCode.NXDomain, True, [],
+                                       [self.soa], [])
+
+        self.names = set()
+        for name in self.records:
+            if self._cut(name, cuts, self.origin) is not None:
+                continue
+            while name is not None and within(name, self.origin):
+                self.names.add(name)
+                name = parent(name)
+        for name in self.names:
+            rrset = self.records.get(name, [])
+            for qtype in Type:
+                self.answers[(wire(name), qtype)] = self._answer(name, qtype,
+                                                                 cuts)
+            cnames = [rr for rr in rrset if rr.type_ == Type.CNAME]
+            if cnames:
+                template = self._template(name, RCode.NoError, True, cnames,
+                                          [], [])
+            else:
+                template = self._template(name, RCode.NoError, True, [],
+                                          [self.soa], [])
+            self.answers[(wire(name), None)] = template
+
+    def _glue(self, ns):
+        """Return the A records in the zone for the targets of NS records"""
+        glue = []
+        for rr in ns:
+            glue += [a for a in self.records.get(key(rr.rdata.nsdname), [])
+                     if a.type_ == Type.A and a not in glue]
+        return glue
+
+    def _answer(self, name, qtype, cuts):
+        """Compile the response for a name in the zone and a type
+
+        CNAME records are followed as long as they point into the zone.
+        """
+        answers = []
+        rcode = RCode.NoError
+        current = name
+        for _ in range(MAX_CHAIN):
+            if current not in self.names:
+                rcode = RCode.NXDomain
+                break
+            rrset = self.records.get(current, [])
+            matching = [rr for rr in rrset
+                        if qtype == Type.ANY or rr.type_ == qtype]
+            if matching:
+                answers += matching
+                break
+            cnames = [rr for rr in rrset if rr.type_ == Type.CNAME]
+            if not cnames or qtype == Type.CNAME:
+                break
+            answers += cnames
+            current = key(cnames[0].rdata.cname)
+            if not within(current, self.origin) or \
+                    self._cut(current, cuts, self.origin) is not None:
+                break
+
+        if answers:
+            authorities = [self.soa] if rcode == RCode.NXDomain else []
+            additionals = []
+            if qtype == Type.NS:
+                additionals = self._glue(
+                    [rr for rr in answers if rr.type_ == Type.NS])
+            return self._template(name, rcode, True, answers, authorities,
+                                  additionals)
+        return self._template(name, rcode, True, [], [self.soa], [])
+
+    def _template(self, name, rcode, aa, answers, authorities, additionals):
+        """Return a response without its header and question
+
+        Args:
+            name (str): name of the question the response is for, the
+                records are compressed against it, or None if the response is
+                for any name and is not compressed
+            rcode (RCode): rcode of the response
+            aa (bool): the response is authoritative
+            answers ([ResourceRecord]): answer section
+            authorities ([ResourceRecord]): authority section
+            additionals ([ResourceRecord]): additional section
+
+        Returns:
+            (int, int, int, int, bytes): the flags, the number of records in
+                each section and the encoded sections
+        """
+        compress = None
+        offset = 12
+        if name is not None:
+            compress = {}
+            question = Question(Name(name), Type.A, self.class_)
+            offset += len(question.to_bytes(offset, compress))
+        body = encode(answers + authorities + additionals, offset, compress)
+        flags = QR | RA | rcode | (AA if aa else 0)
+        return flags, len(answers), len(authorities), len(additionals), body
+
+    def find(self, name, qtype):
+        """Return the compiled response for a question
+
+        Args:
+            name (bytes): the name in lower case wire format
+            qtype (int): the type
+
+        Returns:
+            (int, int, int, int, bytes): the response, see _template, or None
+                if the name is not in the zone
+        """
+        if self.origin is None:
+            return None
+        origin = wire(self.origin)
+        cut = None
+        offset = 0
+        while True:
+            suffix = name[offset:]
+            if suffix == origin:
+                break
+            if suffix in self.referrals:
+                cut = suffix
+            if not name[offset]:
+                return None
+            offset += name[offset] + 1
+        if cut is not None:
+            return self.referrals[cut]
+        template = self.answers.get((name, qtype))
+        if template is None:
+            template = self.answers.get((name, None), self.nxdomain)
+        return template
+
+    def respond(self, ident, rd, question):
+        """Return the response to a question from the zone
+
+        Args:
+            ident (int): ID of the query
+            rd (bool): the RD flag of the query
+            question (bytes): the question section of the query in wire
+                format, without compression
+
+        Returns:
+            bytes: the response, or None if the zone can not answer it
+        """
+        name = bytes(question[:-4]).lower()
+        qtype, qclass = struct.unpack_from("!HH", question, len(question) - 4)
+        if qclass != self.class_:
+            return None
+        template = self.find(name, qtype)
+        if template is None:
+            return None
+        flags, an_count, ns_count, ar_count, body = template
+        return HEADER.pack(ident, flags | (RD if rd else 0), 1, an_count,
+                           ns_count, ar_count) + bytes(question) + body
+
+    def answer(self, query):
+        """Return the response to a query from the zone
+
+        Only standard queries with a single uncompressed question are
+        answered here.
+
+        Args:
+            query (bytes): the query
+
+        Returns:
+            bytes: the response, or None if the zone can not answer it
+        """
+        if self.origin is None or len(query) < 17:
+            return None
+        ident, flags, qd_count = struct.unpack_from("!3H", query)
+        if flags & 0xf800 or qd_count != 1:
+            return None
+        end = 12
+        try:
+            while query[end]:
+                if query[end] >= 64:
+                    return None
+                end += query[end] + 1
+        except IndexError:
+            return None
+        end += 5
+        if end > len(query):
+            return None
+        return self.respond(ident, flags & RD, query[12:end])
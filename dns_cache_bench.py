@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+""" Cache contention benchmark
+
+This script drives a RecordCache from many threads at once and reports the
+throughput for a range of shard counts.
+"""
+
+
+import random
+import time
+from argparse import ArgumentParser
+from threading import Barrier, Thread
+
+from dns.cache import RecordCache
+from dns.classes import Class
+from dns.name import Name
+from dns.resource import ResourceRecord, ARecordData
+from dns.types import Type
+
+
+def worker(cache, names, operations, writes, barrier):
+    """Perform lookups and writes on the cache"""
+    rand = random.Random()
+    barrier.wait()
+    for _ in range(operations):
+        name = rand.choice(names)
+        if rand.random() < writes:
+            cache.add_record(ResourceRecord(Name(name), Type.A, Class.IN, 300,
+                                            ARecordData("10.0.0.1")))
+        else:
+            cache.lookup(name, Type.A, Class.IN)
+
+
+def run(shards, threads, names, operations, writes):
+    """Return the operations per second for one shard count"""
+    # Every shard can hold all names, so nothing is evicted however the
+    # names hash
+    cache = RecordCache(0, max_entries=len(names) * shards, shards=shards)
+    for name in names:
+        cache.add_record(ResourceRecord(Name(name), Type.A, Class.IN, 300,
+                                        ARecordData("10.0.0.1")))
+    barrier = Barrier(threads + 1)
+    workers = [Thread(target=worker,
+                      args=(cache, names, operations, writes, barrier))
+               for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    return threads * operations / (time.perf_counter() - start)
+
+
+def bench():
+    """Run the benchmark"""
+    parser = ArgumentParser(description="RecordCache contention benchmark")
+    parser.add_argument("--threads", type=int, default=16,
+                        help="number of threads")
+    parser.add_argument("--shards", type=int, nargs="+",
+                        default=[1, 2, 4, 8, 16, 32],
+                        help="shard counts to measure")
+    parser.add_argument("--names", type=int, default=10000,
+                        help="number of distinct names")
+    parser.add_argument("--operations", type=int, default=20000,
+                        help="operations per thread")
+    parser.add_argument("--writes", type=float, default=0.1,
+                        help="fraction of operations that are writes")
+    args = parser.parse_args()
+
+    names = ["host{}.example.com".format(i) for i in range(args.names)]
+    print("threads: {}, writes: {:.0%}".format(args.threads, args.writes))
+    for shards in args.shards:
+        rate = run(shards, args.threads, names, args.operations, args.writes)
+        print("{:>4} shards: {:>10.0f} ops/s".format(shards, rate))
+
+
+if __name__ == "__main__":
+    bench()
@@ -25,6 +25,8 @@ def resolve():
 
     resolver = Resolver(args.timeout, args.caching, args.ttl, True)
     (hostname, aliaslist, ipaddrlist) = resolver.gethostbyname(args.hostname)
+    if args.caching:
+        resolver.cache.write_cache_file()
 
     print(hostname)
     print(aliaslist)
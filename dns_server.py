@@ -8,7 +8,9 @@ This script contains the code for starting a DNS server.
 
 from argparse import ArgumentParser
 
+from dns.aioserver import AsyncServer
 from dns.server import Server
+from dns.supervisor import Supervisor
 
 
 def run_server():
@@ -19,9 +21,60 @@ def run_server():
             help="TTL value of cached entries (if > 0)")
     parser.add_argument("-p", "--port", type=int, default=53,
             help="Port which server listens on")
+    parser.add_argument("-z", "--zone", metavar="file",
+            help="Master file of the zone to answer authoritatively")
+    parser.add_argument("--cache-size", metavar="entries", type=int,
+            default=10000, help="Maximum number of cached entries")
+    parser.add_argument("--shared-cache", metavar="file",
+            help="Share the cache with other servers through this file")
+    parser.add_argument("--serve-stale", metavar="time", type=int, default=0,
+            help="Serve expired records for this long when upstream fails")
+    parser.add_argument("--threads", type=int, default=16,
+            help="Number of threads handling queries")
+    parser.add_argument("--queue-depth", type=int, default=1000,
+            help="Maximum number of queries waiting for a thread")
+    parser.add_argument("--overload", choices=["servfail", "drop"],
+            default="servfail", help="What to do with queries that do not fit "
+            "in the queue")
+    parser.add_argument("--engine", choices=["threads", "asyncio"],
+            default="threads", help="Handle queries on a pool of threads or "
+            "on an asyncio event loop")
+    parser.add_argument("--rate-limit", metavar="rate", type=float, default=0,
+            help="Responses per second to a client network for the same "
+            "question over UDP, 0 for no limit")
+    parser.add_argument("--slip", type=int, default=2,
+            help="Send a truncated response for every slip-th rate limited "
+            "query, 0 to drop them all")
+    parser.add_argument("--shed-delay", metavar="seconds", type=float,
+            default=0.1, help="Shed queries that need a recursive lookup when "
+            "queries wait longer than this for a thread, 0 never sheds")
+    parser.add_argument("--stagger", metavar="seconds", type=float,
+            default=0, help="Also ask the next name server of a zone when "
+            "there is no response after this long, 0 asks one at a time")
+    parser.add_argument("--workers", type=int, default=0,
+            help="Number of server processes sharing the port, 0 to serve "
+            "from this process")
     args = parser.parse_args()
+    if args.serve_stale and args.shared_cache:
+        parser.error("--serve-stale can not be used with --shared-cache, "
+                     "the shared cache does not keep expired records")
 
-    server = Server(args.port, args.caching, args.ttl)
+    engine = AsyncServer if args.engine == "asyncio" else Server
+    def factory():
+        return engine(args.port, args.caching, args.ttl, args.cache_size,
+                      args.shared_cache, args.serve_stale, args.threads,
+                      args.queue_depth, args.overload, args.workers > 0,
+                      args.rate_limit, args.slip, args.shed_delay,
+                      args.zone, args.stagger)
+
+    if args.workers > 0:
+        supervisor = Supervisor(factory, args.workers)
+        supervisor.run()
+        supervisor.report()
+        return
+
+    server = factory()
+    server.handle_signals()
     try:
         server.serve()
     except KeyboardInterrupt:
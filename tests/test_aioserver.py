@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+from util import DNSTestCase
+
+from dns.aioserver import AsyncServer, ServerProtocol
+from dns.message import Message, Header, Question
+from dns.name import Name
+from dns.rcodes import RCode
+from dns.types import Type
+from dns.classes import Class
+
+
+class ServerProtocolTestCase(DNSTestCase):
+    def setUp(self):
+        self.server = AsyncServer(5353, False, 0, queue_depth=1)
+        self.server.resolver = MagicMock()
+        self.server.resolver.async_gethostbyname = AsyncMock(
+            return_value=("example.com.", [], ["10.0.0.1"]))
+        self.transport = MagicMock()
+
+    def query(self, name, qtype=Type.A, qclass=Class.IN):
+        header = Header(1234, 0, 1, 0, 0, 0)
+        header.rd = 1
+        return Message(header, [Question(Name(name), qtype, qclass)]) \
+            .to_bytes()
+
+    def receive(self, *queries):
+        async def run():
+            protocol = ServerProtocol(self.server)
+            protocol.connection_made(self.transport)
+            for query in queries:
+                protocol.datagram_received(query, ("127.0.0.1", 5000))
+            await asyncio.gather(*protocol.pending)
+        asyncio.run(run())
+        return [Message.from_bytes(call[0][0])
+                for call in self.transport.sendto.call_args_list]
+
+    def test_recursive(self):
+        response, = self.receive(self.query("example.com."))
+        self.assertEqual(response.header.ident, 1234)
+        self.assertEqual(response.header.rcode, RCode.NoError)
+        self.assertEqual(response.answers[0].rdata.address, "10.0.0.1")
+
+    def test_chaos_on_loop(self):
+        response, = self.receive(self.query("queries.server.", Type.TXT,
+                                                Class.CH))
+        self.assertEqual(response.answers[0].rdata.data[1:], b"1")
+        self.server.resolver.async_gethostbyname.assert_not_called()
+
+    def test_resolver_error(self):
+        self.server.resolver.async_gethostbyname.side_effect = OSError
+        response, = self.receive(self.query("example.com."))
+        self.assertEqual(response.header.rcode, RCode.ServFail)
+        self.assertEqual(self.server.stats["errors"], 1)
+
+    def test_overload(self):
+        responses = self.receive(self.query("example.com."),
+                                 self.query("example.org."))
+        self.assertEqual(sorted(r.header.rcode for r in responses),
+                         [RCode.NoError, RCode.ServFail])
+        self.assertEqual(self.server.stats["overload"], 1)
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import time
+from threading import Event, Thread
+from unittest.mock import patch
+
+from util import DNSTestCase
+
+from dns.cache import RecordCache
+from dns.resource import ResourceRecord, ARecordData, CNAMERecordData
+from dns.resource import SOARecordData, GenericRecordData
+from dns.rcodes import RCode
+from dns.name import Name
+from dns.types import Type
+from dns.classes import Class
+
+
+class RecordCacheTestCase(DNSTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, "cache")
+        self.cache = RecordCache(0, self.filename)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_lookup_case_insensitive(self):
+        record = ResourceRecord(Name("Example.com"), Type.A, Class.IN, 300,
+                                ARecordData("1.2.3.4"))
+        self.cache.add_record(record)
+        found = self.cache.lookup("example.COM", Type.A, Class.IN)
+        self.assertEqual([rr.rdata.address for rr in found], ["1.2.3.4"])
+        self.assertEqual(self.cache.lookup("example.com.", Type.NS, Class.IN),
+                         [])
+
+    def test_lookup_any(self):
+        self.cache.add_record(ResourceRecord(
+            Name("www.example.com"), Type.CNAME, Class.IN, 300,
+            CNAMERecordData(Name("example.com"))))
+        self.cache.add_record(ResourceRecord(
+            Name("www.example.com"), Type.A, Class.IN, 300,
+            ARecordData("1.2.3.4")))
+        found = self.cache.lookup("www.example.com", Type.ANY, Class.IN)
+        self.assertEqual(sorted(rr.type_ for rr in found),
+                         [Type.A, Type.CNAME])
+
+    def test_duplicate_record(self):
+        for _ in range(2):
+            self.cache.add_record(ResourceRecord(
+                Name("example.com"), Type.A, Class.IN, 300,
+                ARecordData("1.2.3.4")))
+        self.assertEqual(
+            len(self.cache.lookup("example.com", Type.A, Class.IN)), 1)
+
+    def test_lookup_does_not_read_file(self):
+        self.cache.add_record(ResourceRecord(
+            Name("example.com"), Type.A, Class.IN, 300,
+            ARecordData("1.2.3.4")))
+        self.cache.lookup("example.com", Type.A, Class.IN)
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_snapshot_roundtrip(self):
+        self.cache.add_record(ResourceRecord(
+            Name("example.com"), Type.A, Class.IN, 300,
+            ARecordData("1.2.3.4")))
+        self.cache.start()
+        self.cache.shutdown()
+        other = RecordCache(0, self.filename)
+        other.read_cache_file()
+        found = other.lookup("example.com", Type.A, Class.IN)
+        self.assertEqual([rr.rdata.address for rr in found], ["1.2.3.4"])
+
+    def test_snapshot_roundtrip_from_empty(self):
+        self.cache.write_cache_file()
+        cache = RecordCache(0, self.filename)
+        cache.read_cache_file()
+        cache.add_record(ResourceRecord(
+            Name("example.com"), Type.A, Class.IN, 300,
+            ARecordData("1.2.3.4")))
+        cache.write_cache_file()
+        other = RecordCache(0, self.filename)
+        other.read_cache_file()
+        found = other.lookup("example.com", Type.A, Class.IN)
+        self.assertEqual([rr.rdata.address for rr in found], ["1.2.3.4"])
+
+    def test_ttl_decremented(self):
+        with patch("dns.cache.time.time", return_value=1000.0):
+            self.cache.add_record(ResourceRecord(
+                Name("example.com"), Type.A, Class.IN, 300,
+                ARecordData("1.2.3.4")))
+        with patch("dns.cache.time.time", return_value=1100.0):
+            found = self.cache.lookup("example.com", Type.A, Class.IN)
+        self.assertEqual([rr.ttl for rr in found], [200])
+        with patch("dns.cache.time.time", return_value=1300.0):
+            found = self.cache.lookup("example.com", Type.A, Class.IN)
+        self.assertEqual(found, [])
+
+    def test_ttl_override(self):
+        cache = RecordCache(60, self.filename)
+        cache.add_record(ResourceRecord(
+            Name("example.com"), Type.A, Class.IN, 300,
+            ARecordData("1.2.3.4")))
+        found = cache.lookup("example.com", Type.A, Class.IN)
+        self.assertLessEqual(found[0].ttl, 60)
+
+    def test_zero_ttl_not_cached(self):
+        self.cache.add_record(ResourceRecord(
+            Name("example.com"), Type.A, Class.IN, 0,
+            ARecordData("1.2.3.4")))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_expired_entries_removed(self):
+        now = time.time()
+        self.cache.add_record(ResourceRecord(
+            Name("a.example.com"), Type.A, Class.IN, 10,
+            ARecordData("1.2.3.4")))
+        self.cache.add_record(ResourceRecord(
+            Name("b.example.com"), Type.A, Class.IN, 1000,
+            ARecordData("1.2.3.5")))
+        with patch("dns.cache.time.time", return_value=now + 100):
+            self.cache.expire()
+        self.assertEqual(len(self.cache), 1)
+
+    def test_lru_eviction(self):
+        cache = RecordCache(0, self.filename, max_entries=2, shards=1)
+        for host in ("a", "b"):
+            cache.add_record(ResourceRecord(
+                Name(host + ".example.com"), Type.A, Class.IN, 300,
+                ARecordData("1.2.3.4")))
+        cache.lookup("a.example.com", Type.A, Class.IN)
+        cache.add_record(ResourceRecord(
+            Name("c.example.com"), Type.A, Class.IN, 300,
+            ARecordData("1.2.3.4")))
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.lookup("a.example.com", Type.A, Class.IN))
+        self.assertFalse(cache.lookup("b.example.com", Type.A, Class.IN))
+
+    def soa(self, ttl=3600, minimum=300):
+        return ResourceRecord(Name("example.com"), Type.SOA, Class.IN, ttl,
+                              SOARecordData(Name("ns.example.com"),
+                                            Name("admin.example.com"),
+                                            1, 7200, 3600, 86400, minimum))
+
+    def test_negative_lifetime(self):
+        with patch("dns.cache.time.time", return_value=1000.0):
+            self.cache.add_negative("nx.example.com", Type.A, Class.IN,
+                                    RCode.NXDomain, self.soa())
+        with patch("dns.cache.time.time", return_value=1100.0):
+            rcode, soa = self.cache.lookup_negative("NX.example.com", Type.A,
+                                                    Class.IN)
+        self.assertEqual(rcode, RCode.NXDomain)
+        self.assertEqual(soa.ttl, 200)
+        self.assertIsNone(self.cache.lookup_negative(
+            "nx.example.com", Type.MX, Class.IN))
+        with patch("dns.cache.time.time", return_value=1300.0):
+            self.assertIsNone(self.cache.lookup_negative(
+                "nx.example.com", Type.A, Class.IN))
+
+    def test_negative_soa_ttl(self):
+        with patch("dns.cache.time.time", return_value=1000.0):
+            self.cache.add_negative("nx.example.com", Type.A, Class.IN,
+                                    RCode.NoError, self.soa(ttl=60))
+            rcode, soa = self.cache.lookup_negative("nx.example.com", Type.A,
+                                                    Class.IN)
+        self.assertEqual(rcode, RCode.NoError)
+        self.assertEqual(soa.ttl, 60)
+
+    def test_positive_replaces_negative(self):
+        self.cache.add_negative("example.com", Type.A, Class.IN,
+                                RCode.NoError, self.soa())
+        self.cache.add_record(ResourceRecord(
+            Name("example.com"), Type.A, Class.IN, 300,
+            ARecordData("1.2.3.4")))
+        self.assertIsNone(self.cache.lookup_negative(
+            "example.com", Type.A, Class.IN))
+        self.assertEqual(
+            len(self.cache.lookup("example.com", Type.A, Class.IN)), 1)
+
+    def test_negative_snapshot_roundtrip(self):
+        self.cache.add_negative("nx.example.com", Type.A, Class.IN,
+                                RCode.NXDomain, self.soa())
+        self.cache.write_cache_file()
+        other = RecordCache(0, self.filename)
+        other.read_cache_file()
+        rcode, soa = other.lookup_negative("nx.example.com", Type.A, Class.IN)
+        self.assertEqual(rcode, RCode.NXDomain)
+        self.assertEqual(soa.rdata.minimum, 300)
+
+    def test_snapshot_is_lazy(self):
+        self.cache.add_record(ResourceRecord(
+            Name("example.com"), Type.TXT, Class.IN, 300,
+            GenericRecordData(b"\x05hello")))
+        self.cache.write_cache_file()
+        other = RecordCache(0, self.filename)
+        other.read_cache_file()
+        self.assertEqual(len(other), 0)
+        found = other.lookup("example.com", Type.TXT, Class.IN)
+        self.assertEqual([rr.rdata.data for rr in found], [b"\x05hello"])
+        self.assertEqual(len(other), 1)
+
+    def test_snapshot_keeps_unread_entries(self):
+        self.cache.add_record(ResourceRecord(
+            Name("a.example.com"), Type.A, Class.IN, 300,
+            ARecordData("1.2.3.4")))
+        self.cache.write_cache_file()
+        other = RecordCache(0, self.filename)
+        other.read_cache_file()
+        other.add_record(ResourceRecord(
+            Name("b.example.com"), Type.A, Class.IN, 300,
+            ARecordData("1.2.3.5")))
+        other.write_cache_file()
+        third = RecordCache(0, self.filename)
+        third.read_cache_file()
+        self.assertTrue(third.lookup("a.example.com", Type.A, Class.IN))
+        self.assertTrue(third.lookup("b.example.com", Type.A, Class.IN))
+
+    def test_read_json_cache(self):
+        with open(self.filename, "w") as file_:
+            file_.write('[{"name": "thalia.nu.", "type": "A", "class": "IN",'
+                        ' "ttl": 300, "rdata": {"address": "131.174.41.19"}}]')
+        self.cache.read_cache_file()
+        found = self.cache.lookup("thalia.nu", Type.A, Class.IN)
+        self.assertEqual([rr.rdata.address for rr in found],
+                         ["131.174.41.19"])
+
+    def test_prefetch_queued(self):
+        refresh = []
+        self.cache.refresh = refresh.append
+        with patch("dns.cache.time.time", return_value=1000.0):
+            self.cache.add_record(ResourceRecord(
+                Name("example.com"), Type.A, Class.IN, 100,
+                ARecordData("1.2.3.4")))
+        with patch("dns.cache.time.time", return_value=1050.0):
+            for _ in range(5):
+                self.cache.lookup("example.com", Type.A, Class.IN)
+        self.assertTrue(self.cache.prefetch_queue.empty())
+        with patch("dns.cache.time.time", return_value=1095.0):
+            for _ in range(5):
+                self.cache.lookup("example.com", Type.A, Class.IN)
+        self.assertEqual(self.cache.prefetch_queue.qsize(), 1)
+        self.assertEqual(self.cache.prefetch_queue.get(),
+                         ("example.com.", Type.A, Class.IN))
+
+    def test_prefetch_unpopular(self):
+        self.cache.refresh = lambda *key: None
+        with patch("dns.cache.time.time", return_value=1000.0):
+            self.cache.add_record(ResourceRecord(
+                Name("example.com"), Type.A, Class.IN, 100,
+                ARecordData("1.2.3.4")))
+        with patch("dns.cache.time.time", return_value=1095.0):
+            self.cache.lookup("example.com", Type.A, Class.IN)
+        self.assertTrue(self.cache.prefetch_queue.empty())
+
+    def test_prefetch_queue_bounded(self):
+        cache = RecordCache(0, self.filename, prefetch_hits=1,
+                            prefetch_queue=1)
+        cache.refresh = lambda *key: None
+        with patch("dns.cache.time.time", return_value=1000.0):
+            for host in ("a", "b"):
+                cache.add_record(ResourceRecord(
+                    Name(host + ".example.com"), Type.A, Class.IN, 100,
+                    ARecordData("1.2.3.4")))
+        with patch("dns.cache.time.time", return_value=1095.0):
+            cache.lookup("a.example.com", Type.A, Class.IN)
+            cache.lookup("b.example.com", Type.A, Class.IN)
+        self.assertEqual(cache.prefetch_queue.qsize(), 1)
+        self.assertEqual(cache.stats["prefetch_dropped"], 1)
+
+    def test_prefetch_refreshes(self):
+        done = Event()
+        def refresh(dname, type_, class_):
+            self.cache.add_record(ResourceRecord(
+                Name(dname), type_, class_, 100, ARecordData("1.2.3.4")))
+            done.set()
+        self.cache.prefetch_hits = 1
+        self.cache.add_record(ResourceRecord(
+            Name("example.com"), Type.A, Class.IN, 100,
+            ARecordData("1.2.3.4")))
+        self.cache.start(refresh)
+        with patch("dns.cache.time.time", return_value=time.time() + 95):
+            self.cache.lookup("example.com", Type.A, Class.IN)
+        self.assertTrue(done.wait(5))
+        self.cache.shutdown()
+        self.assertEqual(self.cache.stats["prefetches"], 1)
+        found = self.cache.lookup("example.com", Type.A, Class.IN)
+        self.assertGreater(found[0].ttl, 90)
+        self.assertEqual(self.cache.stats["prefetch_useful"], 1)
+
+    def test_prefetch_shutdown_bounded(self):
+        release = Event()
+        def refresh(dname, type_, class_):
+            release.wait(5)
+        for i in range(5):
+            key = ("{}.example.com.".format(i), Type.A, Class.IN)
+            self.cache.prefetch_queue.put(key)
+        self.cache.start(refresh)
+        start = time.monotonic()
+        with patch("dns.cache.PREFETCH_TIMEOUT", 0.1):
+            self.cache.shutdown()
+        release.set()
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertLessEqual(self.cache.stats["prefetches"], 1)
+
+    def test_stale_kept(self):
+        cache = RecordCache(0, self.filename, stale=600)
+        with patch("dns.cache.time.time", return_value=1000.0):
+            cache.add_record(ResourceRecord(
+                Name("example.com"), Type.A, Class.IN, 100,
+                ARecordData("1.2.3.4")))
+        with patch("dns.cache.time.time", return_value=1050.0):
+            self.assertEqual(cache.lookup_stale("example.com", Type.A,
+                                                Class.IN), [])
+        with patch("dns.cache.time.time", return_value=1200.0):
+            cache.expire()
+            self.assertEqual(cache.lookup("example.com", Type.A, Class.IN),
+                             [])
+            found = cache.lookup_stale("example.com", Type.ANY, Class.IN)
+            self.assertEqual([rr.ttl for rr in found], [30])
+        with patch("dns.cache.time.time", return_value=1800.0):
+            cache.expire()
+            self.assertEqual(cache.lookup_stale("example.com", Type.A,
+                                                Class.IN), [])
+        self.assertEqual(len(cache), 0)
+
+    def test_stale_disabled(self):
+        with patch("dns.cache.time.time", return_value=1000.0):
+            self.cache.add_record(ResourceRecord(
+                Name("example.com"), Type.A, Class.IN, 100,
+                ARecordData("1.2.3.4")))
+        with patch("dns.cache.time.time", return_value=1200.0):
+            self.assertEqual(self.cache.lookup_stale("example.com", Type.A,
+                                                     Class.IN), [])
+
+    def test_shards(self):
+        cache = RecordCache(0, self.filename, max_entries=256, shards=8)
+        self.assertEqual(len(cache.shards), 8)
+        for i in range(32):
+            cache.add_record(ResourceRecord(
+                Name("h{}.example.com".format(i)), Type.A, Class.IN, 300,
+                ARecordData("1.2.3.4")))
+        self.assertEqual(len(cache), 32)
+        self.assertGreater(len([shard for shard in cache.shards
+                                if shard.records]), 1)
+        for i in range(32):
+            self.assertTrue(cache.lookup("h{}.example.com".format(i), Type.A,
+                                         Class.IN))
+
+    def test_shard_size_rounded_up(self):
+        cache = RecordCache(0, self.filename, max_entries=10, shards=4)
+        self.assertEqual([shard.max_entries for shard in cache.shards],
+                         [3, 3, 3, 3])
+
+    def test_concurrent_writers(self):
+        cache = RecordCache(0, self.filename, max_entries=100000, shards=4)
+
+        def write(thread):
+            for i in range(500):
+                cache.add_record(ResourceRecord(
+                    Name("h{}-{}.example.com".format(thread, i)), Type.A,
+                    Class.IN, 300, ARecordData("1.2.3.4")))
+                cache.lookup("h{}-{}.example.com".format(thread, i // 2),
+                             Type.A, Class.IN)
+        threads = [Thread(target=write, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(cache), 4000)
+
+    def test_lookups_during_snapshot(self):
+        cache = RecordCache(0, self.filename, max_entries=100000, shards=2)
+        names = ["h{}.example.com".format(i) for i in range(10000)]
+        for name in names:
+            cache.add_record(ResourceRecord(Name(name), Type.A, Class.IN,
+                                            300, ARecordData("1.2.3.4")))
+        done = []
+
+        def lookup():
+            while not done:
+                for name in names:
+                    cache.lookup(name, Type.A, Class.IN)
+        threads = [Thread(target=lookup) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        try:
+            with patch("builtins.print") as mock_print:
+                for _ in range(3):
+                    cache.write_cache_file()
+        finally:
+            done.append(True)
+            for thread in threads:
+                thread.join()
+        mock_print.assert_not_called()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import time
+from unittest.mock import patch
+
+from util import DNSTestCase
+
+from dns.classes import Class
+from dns.delegation import DelegationCache
+from dns.name import Name
+from dns.resource import ResourceRecord, ARecordData, NSRecordData
+from dns.types import Type
+
+
+def ns(zone, nsname, ttl=3600):
+    return ResourceRecord(Name(zone), Type.NS, Class.IN, ttl,
+                          NSRecordData(Name(nsname)))
+
+
+def glue(nsname, address, ttl=3600):
+    return ResourceRecord(Name(nsname), Type.A, Class.IN, ttl,
+                          ARecordData(address))
+
+
+class DelegationCacheTestCase(DNSTestCase):
+    def setUp(self):
+        self.cache = DelegationCache()
+
+    def test_closest_zone(self):
+        self.cache.add_referral("www.example.com", ".",
+                                [ns("com", "a.gtld.com")],
+                                [glue("a.gtld.com", "10.0.0.1")])
+        self.cache.add_referral("www.example.com", "com",
+                                [ns("example.com", "ns1.example.com"),
+                                 ns("example.com", "ns2.example.com")],
+                                [glue("ns1.example.com", "10.0.1.1"),
+                                 glue("ns2.example.com", "10.0.1.2")])
+        self.assertEqual(self.cache.lookup("b.Example.com"),
+                         ("example.com.", ["10.0.1.1", "10.0.1.2"]))
+        self.assertIsNone(self.cache.lookup("example.org"))
+        self.assertEqual(self.cache.lookup("www.example.net.com"),
+                         ("com.", ["10.0.0.1"]))
+
+    def test_not_below_server_zone(self):
+        self.cache.add_referral("www.example.com", ".",
+                                [ns("example.com", "ns.example.com")],
+                                [glue("ns.example.com", "10.0.1.1")])
+        for zone in ("com", ".", "example.com"):
+            self.assertIsNone(self.cache.add_referral(
+                "www.example.com", "example.com",
+                [ns(zone, "ns.evil." + zone)],
+                [glue("ns.evil." + zone, "10.6.6.6")]))
+        self.assertEqual(self.cache.lookup("www.example.com"),
+                         ("example.com.", ["10.0.1.1"]))
+
+    def test_glue_outside_cut(self):
+        self.cache.add_referral("www.example.com", ".",
+                                [ns("example.com", "ns.example.com"),
+                                 ns("example.com", "ns.example.net")],
+                                [glue("ns.example.com", "10.0.1.1"),
+                                 glue("ns.example.net", "10.6.6.6")])
+        self.assertEqual(self.cache.lookup("www.example.com"),
+                         ("example.com.", ["10.0.1.1"]))
+
+    def test_out_of_bailiwick(self):
+        zone = self.cache.add_referral("www.example.com", ".",
+                                       [ns("example.org", "ns.example.org")],
+                                       [glue("ns.example.org", "10.0.0.1")])
+        self.assertIsNone(zone)
+        self.cache.add_referral("www.example.com", ".",
+                                [ns("example.com", "ns.example.com")],
+                                [glue("ns.example.com", "10.0.0.1"),
+                                 glue("www.example.com", "10.6.6.6")])
+        self.assertEqual(self.cache.lookup("www.example.com"),
+                         ("example.com.", ["10.0.0.1"]))
+
+    def test_without_glue(self):
+        self.cache.add_referral("www.example.com", ".",
+                                [ns("example.com", "ns.example.net")], [])
+        self.assertEqual(len(self.cache), 1)
+        self.assertIsNone(self.cache.lookup("www.example.com"))
+
+    def test_expiry(self):
+        now = time.time()
+        with patch("dns.delegation.time.time", return_value=now - 200):
+            self.cache.add_referral("www.example.com", ".",
+                                    [ns("example.com", "ns.example.com", 100)],
+                                    [glue("ns.example.com", "10.0.0.1")])
+        self.assertIsNone(self.cache.lookup("www.example.com"))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_max_entries(self):
+        cache = DelegationCache(max_entries=2)
+        for zone in ("a.com", "b.com", "c.com"):
+            cache.add_referral("www." + zone, ".", [ns(zone, "ns." + zone)],
+                               [glue("ns." + zone, "10.0.0.1")])
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.lookup("www.a.com"))
@@ -8,6 +8,7 @@ from dns.name import Name
 from dns.types import Type
 from dns.classes import Class
 from dns.message import Message, Header, Question
+from dns.resource import ResourceRecord, GenericRecordData
 import dns.message
 
 
@@ -149,6 +150,22 @@ class HeaderTestCase(DNSTestCase):
         self.assertEqual(Header.from_bytes(packet), header)
 
 
+class MemoryviewTestCase(DNSTestCase):
+    def test_message_from_memoryview(self):
+        header = Header(1, 0, 1, 1, 0, 0)
+        question = Question(Name("example.com"), Type.TXT, Class.IN)
+        answer = ResourceRecord(Name("example.com"), Type.TXT, Class.IN, 60,
+                                GenericRecordData(b"\x02hi"))
+        packet = Message(header, [question], [answer]).to_bytes()
+        buffer = bytearray(512)
+        buffer[:len(packet)] = packet
+        message = Message.from_bytes(memoryview(buffer)[:len(packet)])
+        buffer[:] = bytes(512)
+        self.assertEqual(message.questions[0].qname, Name("example.com"))
+        self.assertEqual(message.answers[0].rdata.data, b"\x02hi")
+        self.assertEqual(message.to_bytes(), packet)
+
+
 class QuestionTestCase(DNSTestCase):
     def setUp(self):
         self.addTypeEqualityFunc(Question, self.equalsQuestion)
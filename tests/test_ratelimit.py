@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+from unittest.mock import patch
+
+from util import DNSTestCase
+
+from dns.message import Message, Header, Question
+from dns.name import Name
+from dns.types import Type
+from dns.classes import Class
+from dns.ratelimit import ALLOW, DROP, SLIP, RateLimiter, prefix, question
+
+
+def query(name, ident=1):
+    header = Header(ident, 0, 1, 0, 0, 0)
+    return Message(header, [Question(Name(name), Type.A, Class.IN)]) \
+        .to_bytes()
+
+
+class RateLimiterTestCase(DNSTestCase):
+    def test_prefix(self):
+        self.assertEqual(prefix(("10.1.2.3", 53)), b"\x0a\x01\x02")
+        self.assertEqual(prefix(("2001:db8:1:2::1", 53)),
+                         b"\x20\x01\x0d\xb8\x00\x01\x00")
+
+    def test_question_case(self):
+        self.assertEqual(question(query("Example.COM")),
+                         question(query("example.com", 2)))
+
+    def test_burst_then_limit(self):
+        limiter = RateLimiter(1, burst=3, slip=0)
+        with patch("dns.ratelimit.time.monotonic", return_value=100.0):
+            results = [limiter.check(("10.0.0.1", 5000), query("a.nl"))
+                       for _ in range(4)]
+        self.assertEqual(results, [ALLOW, ALLOW, ALLOW, DROP])
+
+    def test_refill(self):
+        limiter = RateLimiter(2, burst=1)
+        with patch("dns.ratelimit.time.monotonic", return_value=100.0):
+            self.assertEqual(limiter.check(("10.0.0.1", 1), query("a.nl")),
+                             ALLOW)
+            self.assertNotEqual(limiter.check(("10.0.0.1", 1), query("a.nl")),
+                                ALLOW)
+        with patch("dns.ratelimit.time.monotonic", return_value=100.5):
+            self.assertEqual(limiter.check(("10.0.0.1", 1), query("a.nl")),
+                             ALLOW)
+
+    def test_separate_buckets(self):
+        limiter = RateLimiter(1, slip=0)
+        with patch("dns.ratelimit.time.monotonic", return_value=100.0):
+            self.assertEqual(limiter.check(("10.0.0.1", 1), query("a.nl")),
+                             ALLOW)
+            self.assertEqual(limiter.check(("10.0.0.2", 1), query("a.nl")),
+                             DROP)
+            self.assertEqual(limiter.check(("10.0.1.1", 1), query("a.nl")),
+                             ALLOW)
+            self.assertEqual(limiter.check(("10.0.0.1", 1), query("b.nl")),
+                             ALLOW)
+
+    def test_slip(self):
+        limiter = RateLimiter(1, burst=1, slip=2)
+        with patch("dns.ratelimit.time.monotonic", return_value=100.0):
+            results = [limiter.check(("10.0.0.1", 5000), query("a.nl"))
+                       for _ in range(5)]
+        self.assertEqual(results, [ALLOW, DROP, SLIP, DROP, SLIP])
+
+    def test_random_names_limited(self):
+        limiter = RateLimiter(1, slip=0)
+        with patch("dns.ratelimit.time.monotonic", return_value=100.0):
+            results = [limiter.check(("10.0.0.1", 1),
+                                     query("r{}.example.nl".format(i)))
+                       for i in range(100)]
+            self.assertEqual(results.count(ALLOW), 8)
+            self.assertEqual(limiter.check(("10.0.1.1", 1), query("a.nl")),
+                             ALLOW)
+
+    def test_shared_slot(self):
+        limiter = RateLimiter(1, size=1, slip=0)
+        with patch("dns.ratelimit.time.monotonic", return_value=100.0):
+            self.assertEqual(limiter.check(("10.0.0.1", 1), query("a.nl")),
+                             ALLOW)
+            self.assertEqual(limiter.check(("10.0.1.1", 1), query("b.nl")),
+                             DROP)
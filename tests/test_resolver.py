@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+
+import asyncio
+import socket
+import struct
+import time
+from threading import Event, Lock, Thread
+from unittest.mock import patch
+
+from util import DNSTestCase
+
+from dns.resolver import Resolver
+from dns.cache import RecordCache
+from dns.message import Message, Header
+from dns.resource import ResourceRecord, SOARecordData, NSRecordData
+from dns.resource import ARecordData
+from dns.name import Name
+from dns.rcodes import RCode
+from dns.types import Type
+from dns.classes import Class
+from dns.transport import Pending
+
+
+class FakeTransport:
+    """Answers every query with the next response, None for no response"""
+
+    def __init__(self, *responses, port=53):
+        self.responses = list(responses)
+        self.servers = []
+        self.port = port
+
+    def send(self, data, server, replies):
+        self.servers.append(server)
+        pending = Pending(None, server, replies)
+        response = self.responses.pop(0)
+        if response is not None:
+            pending.received = time.monotonic()
+            pending.response = response
+            replies.put(pending)
+        return pending
+
+    def cancel(self, pending):
+        pass
+
+    def close(self):
+        pass
+
+
+class EchoTransport(FakeTransport):
+    """Answers every query for a name with an address from a thread"""
+
+    def __init__(self):
+        super().__init__()
+        self.lock = Lock()
+
+    def send(self, data, server, replies):
+        with self.lock:
+            self.servers.append(server)
+        pending = Pending(None, server, replies)
+        query = Message.from_bytes(data)
+        header = Header(query.header.ident, 0, 0, 1, 0, 0)
+        header.qr = 1
+        pending.response = Message(header, [], [
+            ResourceRecord(query.questions[0].qname, Type.A, Class.IN, 60,
+                           ARecordData("1.2.3.4"))]).to_bytes()
+        pending.received = time.monotonic()
+        Thread(target=replies.put, args=(pending,)).start()
+        return pending
+
+
+class ResolverTestCase(DNSTestCase):
+    def setUp(self):
+        self.soa = ResourceRecord(
+            Name("example.com"), Type.SOA, Class.IN, 3600,
+            SOARecordData(Name("ns.example.com"), Name("admin.example.com"),
+                          1, 7200, 3600, 86400, 300))
+
+    def response(self, rcode, authorities):
+        header = Header(9001, 0, 1, 0, len(authorities), 0)
+        header.qr = 1
+        header.rcode = rcode
+        return Message(header, [], [], authorities)
+
+    def test_getsoa_nxdomain(self):
+        resolver = Resolver(5, False, 0, True)
+        response = self.response(RCode.NXDomain, [self.soa])
+        self.assertIs(resolver.getsoa(response), self.soa)
+
+    def test_getsoa_referral(self):
+        resolver = Resolver(5, False, 0, True)
+        ns = ResourceRecord(Name("example.com"), Type.NS, Class.IN, 3600,
+                            NSRecordData(Name("ns.example.com")))
+        response = self.response(RCode.NoError, [ns])
+        self.assertIsNone(resolver.getsoa(response))
+
+    def test_negative_cache_hit(self):
+        cache = RecordCache(0)
+        cache.add_negative("nx.example.com", Type.A, Class.IN,
+                           RCode.NXDomain, self.soa)
+        transport = FakeTransport()
+        resolver = Resolver(5, True, 0, True, cache, transport=transport)
+        self.assertEqual(resolver.gethostbyname("nx.example.com"),
+                         ("nx.example.com", [], []))
+        self.assertEqual(transport.servers, [])
+
+    def test_serve_stale(self):
+        cache = RecordCache(0, stale=600)
+        with patch("dns.cache.time.time", return_value=time.time() - 110):
+            cache.add_record(ResourceRecord(Name("example.com"), Type.A,
+                                            Class.IN, 100,
+                                            ARecordData("1.2.3.4")))
+        resolver = Resolver(0.1, True, 0, True, cache, stale_deadline=1,
+                            transport=FakeTransport(None))
+        self.assertEqual(resolver.gethostbyname("example.com"),
+                         ("example.com", [], ["1.2.3.4"]))
+        self.assertEqual(cache.stats["stale_served"], 1)
+
+    def test_stale_refreshed_once(self):
+        cache = RecordCache(0, stale=600)
+        with patch("dns.cache.time.time", return_value=time.time() - 110):
+            cache.add_record(ResourceRecord(Name("example.com"), Type.A,
+                                            Class.IN, 100,
+                                            ARecordData("1.2.3.4")))
+        release = Event()
+        sent = []
+
+        class BlockingTransport(FakeTransport):
+            def send(self, data, server, replies):
+                sent.append(server)
+                release.wait(5)
+                return super().send(data, server, replies)
+
+        transport = BlockingTransport(None)
+        resolver = Resolver(0.1, True, 0, True, cache, stale_deadline=0.05,
+                            transport=transport)
+        results = []
+        threads = [Thread(target=lambda: results.append(
+            resolver.gethostbyname("example.com"))) for _ in range(5)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            start = time.monotonic()
+            results.append(resolver.gethostbyname("example.com"))
+            self.assertLess(time.monotonic() - start, 0.05)
+        finally:
+            release.set()
+        self.assertEqual(results, [("example.com", [], ["1.2.3.4"])] * 6)
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(resolver.stats["stale_recheck"], 1)
+
+    @patch("dns.resolver.socket.create_connection")
+    def test_truncated_retry_tcp(self, MockConnection):
+        truncated = Header(9001, 0, 0, 0, 0, 0)
+        truncated.qr = 1
+        truncated.tc = 1
+        header = Header(9001, 0, 0, 1, 0, 0)
+        header.qr = 1
+        answer = ResourceRecord(Name("example.com"), Type.A, Class.IN, 60,
+                                ARecordData("1.2.3.4"))
+        data = Message(header, [], [answer]).to_bytes()
+        sock = MockConnection.return_value.__enter__.return_value
+        sock.recv.side_effect = [struct.pack("!H", len(data)), data]
+        resolver = Resolver(5, False, 0, True, transport=FakeTransport(
+            Message(truncated).to_bytes(), port=5300))
+        self.assertEqual(resolver.gethostbyname("example.com"),
+                         ("example.com", [], ["1.2.3.4"]))
+        self.assertEqual(MockConnection.call_args[0][0],
+                         ("192.112.36.4", 5300))
+        self.assertEqual(resolver.stats["truncated"], 1)
+        self.assertEqual(resolver.stats["tcp_queries"], 1)
+        sent = sock.sendall.call_args[0][0]
+        self.assertEqual(struct.unpack_from("!H", sent)[0], len(sent) - 2)
+
+    def test_coalesce_lookups(self):
+        resolver = Resolver(5, False, 0, True)
+        with patch.object(resolver, "flights") as flights:
+            flights.do.return_value = ("Example.com", [], ["1.2.3.4"])
+            self.assertEqual(resolver.gethostbyname("Example.com"),
+                             ("Example.com", [], ["1.2.3.4"]))
+        key, function = flights.do.call_args[0][:2]
+        self.assertEqual(key, ("example.com.", Type.A, Class.IN))
+        self.assertEqual(function, resolver.resolve)
+
+    def referral(self, zone, nsname, address):
+        header = Header(9001, 0, 0, 0, 1, 1)
+        header.qr = 1
+        return Message(header, [], [], [
+            ResourceRecord(Name(zone), Type.NS, Class.IN, 3600,
+                           NSRecordData(Name(nsname)))], [
+            ResourceRecord(Name(nsname), Type.A, Class.IN, 3600,
+                           ARecordData(address))]).to_bytes()
+
+    def answer(self, name, address):
+        header = Header(9001, 0, 0, 1, 0, 0)
+        header.qr = 1
+        return Message(header, [], [
+            ResourceRecord(Name(name), Type.A, Class.IN, 60,
+                           ARecordData(address))]).to_bytes()
+
+    def test_start_at_closest_zone(self):
+        transport = FakeTransport(
+            self.referral("com", "a.gtld-servers.net", "10.0.0.1"),
+            self.referral("example.com", "ns.example.com", "10.0.1.1"),
+            self.answer("a.example.com", "1.2.3.4"),
+            self.answer("b.example.com", "1.2.3.5"))
+        resolver = Resolver(5, True, 0, True, RecordCache(0),
+                            transport=transport)
+        self.assertEqual(resolver.gethostbyname("a.example.com"),
+                         ("a.example.com", [], ["1.2.3.4"]))
+        self.assertEqual(resolver.gethostbyname("b.example.com"),
+                         ("b.example.com", [], ["1.2.3.5"]))
+        self.assertEqual(transport.servers, ["192.112.36.4", "10.0.0.1",
+                                             "10.0.1.1", "10.0.1.1"])
+        self.assertEqual(resolver.stats["delegation_hits"], 1)
+
+    def test_closest_zone_unreachable(self):
+        transport = FakeTransport(None,
+                                  self.answer("b.example.com", "1.2.3.5"))
+        resolver = Resolver(0.1, True, 0, True, RecordCache(0),
+                            transport=transport)
+        resolver.delegations.add_referral("b.example.com", ".", [
+            ResourceRecord(Name("example.com"), Type.NS, Class.IN, 3600,
+                           NSRecordData(Name("ns.example.com")))], [
+            ResourceRecord(Name("ns.example.com"), Type.A, Class.IN, 3600,
+                           ARecordData("10.0.1.1"))])
+        self.assertEqual(resolver.gethostbyname("b.example.com"),
+                         ("b.example.com", [], ["1.2.3.5"]))
+        self.assertEqual(transport.servers, ["10.0.1.1", "192.112.36.4"])
+        self.assertEqual(resolver.stats["delegation_failures"], 1)
+
+    def test_upward_referral_ignored(self):
+        transport = FakeTransport(
+            self.referral("example.com", "ns.example.com", "10.0.1.1"),
+            self.referral("com", "ns.example.com", "10.6.6.6"))
+        resolver = Resolver(5, True, 0, True, RecordCache(0),
+                            transport=transport)
+        self.assertEqual(resolver.gethostbyname("a.example.com"),
+                         ("a.example.com", [], []))
+        self.assertEqual(transport.servers, ["192.112.36.4", "10.0.1.1"])
+        self.assertEqual(resolver.stats["lame_referrals"], 1)
+        self.assertEqual(resolver.delegations.lookup("a.example.com"),
+                         ("example.com.", ["10.0.1.1"]))
+
+    def test_fastest_server_first(self):
+        header = Header(9001, 0, 0, 0, 2, 2)
+        header.qr = 1
+        referral = Message(header, [], [], [
+            ResourceRecord(Name("example.com"), Type.NS, Class.IN, 3600,
+                           NSRecordData(Name(nsname)))
+            for nsname in ("ns1.example.com", "ns2.example.com")], [
+            ResourceRecord(Name(nsname), Type.A, Class.IN, 3600,
+                           ARecordData(address))
+            for nsname, address in (("ns1.example.com", "10.0.1.1"),
+                                    ("ns2.example.com", "10.0.1.2"))])
+        transport = FakeTransport(referral.to_bytes(), None,
+                                  self.answer("a.example.com", "1.2.3.4"))
+        resolver = Resolver(0.1, False, 0, True, transport=transport)
+        resolver.servers.explore = 0
+        resolver.servers.record("10.0.1.1", 0.2)
+        resolver.servers.record("10.0.1.2", 0.1)
+        self.assertEqual(resolver.gethostbyname("a.example.com"),
+                         ("a.example.com", [], ["1.2.3.4"]))
+        self.assertEqual(transport.servers, ["192.112.36.4", "10.0.1.2",
+                                             "10.0.1.1"])
+        self.assertEqual(resolver.servers.table()["10.0.1.2"][1], 1)
+
+    def referral_to(self, zone, servers):
+        header = Header(9001, 0, 0, 0, len(servers), len(servers))
+        header.qr = 1
+        return Message(header, [], [], [
+            ResourceRecord(Name(zone), Type.NS, Class.IN, 3600,
+                           NSRecordData(Name(nsname)))
+            for nsname, _ in servers], [
+            ResourceRecord(Name(nsname), Type.A, Class.IN, 3600,
+                           ARecordData(address))
+            for nsname, address in servers]).to_bytes()
+
+    def test_race_slow_server(self):
+        transport = FakeTransport(
+            self.referral_to("example.com", [("ns1.example.com", "10.0.1.1"),
+                                             ("ns2.example.com", "10.0.1.2")]),
+            None, self.answer("a.example.com", "1.2.3.4"))
+        resolver = Resolver(5, False, 0, True, stagger=0.01,
+                            transport=transport)
+        resolver.servers.explore = 0
+        resolver.servers.record("10.0.1.1", 0.1)
+        resolver.servers.record("10.0.1.2", 0.2)
+        self.assertEqual(resolver.gethostbyname("a.example.com"),
+                         ("a.example.com", [], ["1.2.3.4"]))
+        self.assertEqual(transport.servers, ["192.112.36.4", "10.0.1.1",
+                                             "10.0.1.2"])
+        self.assertEqual(resolver.stats["raced"], 1)
+
+    def test_race_all_silent(self):
+        resolver = Resolver(0.05, False, 0, True, stagger=0.01,
+                            transport=FakeTransport(None, None))
+        with self.assertRaises(socket.timeout):
+            resolver.resolve("a.example.com", ["10.0.1.1", "10.0.1.2"])
+        self.assertEqual(resolver.stats["raced"], 1)
+        self.assertEqual(resolver.servers.table()["10.0.1.1"][1], 1)
+        self.assertEqual(resolver.servers.table()["10.0.1.2"][1], 1)
+
+    def refused(self):
+        header = Header(9001, 0, 0, 0, 0, 0)
+        header.qr = 1
+        header.rcode = RCode.Refused
+        return Message(header).to_bytes()
+
+    def test_lame_server_skipped(self):
+        transport = FakeTransport(
+            self.referral_to("example.com", [("ns1.example.com", "10.0.1.1"),
+                                             ("ns2.example.com", "10.0.1.2")]),
+            self.refused(), self.answer("a.example.com", "1.2.3.4"))
+        resolver = Resolver(5, False, 0, True, stagger=5,
+                            transport=transport)
+        resolver.servers.explore = 0
+        resolver.servers.record("10.0.1.1", 0.01)
+        resolver.servers.record("10.0.1.2", 0.2)
+        self.assertEqual(resolver.gethostbyname("a.example.com"),
+                         ("a.example.com", [], ["1.2.3.4"]))
+        self.assertEqual(transport.servers, ["192.112.36.4", "10.0.1.1",
+                                             "10.0.1.2"])
+        self.assertEqual(resolver.stats["lame"], 1)
+        self.assertEqual(resolver.servers.choose(["10.0.1.1", "10.0.1.2"]),
+                         ["10.0.1.2", "10.0.1.1"])
+
+    def test_all_servers_refuse(self):
+        transport = FakeTransport(
+            self.referral("example.com", "ns.example.com", "10.0.1.1"),
+            self.refused())
+        resolver = Resolver(5, False, 0, True, transport=transport)
+        with self.assertRaises(ConnectionRefusedError):
+            resolver.gethostbyname("a.example.com")
+        self.assertEqual(resolver.stats["rejected"], 1)
+
+    def test_async_lame_server_skipped(self):
+        transport = FakeTransport(self.refused(),
+                                  self.answer("a.example.com", "1.2.3.4"))
+        resolver = Resolver(5, False, 0, True, stagger=5,
+                            transport=transport)
+        self.assertEqual(
+            asyncio.run(resolver.async_resolve("a.example.com",
+                                               ["10.0.1.1", "10.0.1.2"])),
+            ("a.example.com", [], ["1.2.3.4"]))
+        self.assertEqual(transport.servers, ["10.0.1.1", "10.0.1.2"])
+
+    def glueless_lookup(self):
+        header = Header(9001, 0, 0, 0, 1, 0)
+        header.qr = 1
+        referral = Message(header, [], [], [
+            ResourceRecord(Name("example.com"), Type.NS, Class.IN, 3600,
+                           NSRecordData(Name("ns.example.net")))]).to_bytes()
+        return FakeTransport(referral,
+                             self.answer("ns.example.net", "10.0.2.1"),
+                             self.answer("a.example.com", "1.2.3.4"))
+
+    def test_glueless_referral(self):
+        transport = self.glueless_lookup()
+        resolver = Resolver(5, False, 0, True, transport=transport)
+        self.assertEqual(resolver.gethostbyname("a.example.com"),
+                         ("a.example.com", [], ["1.2.3.4"]))
+        self.assertEqual(transport.servers, ["192.112.36.4", "192.112.36.4",
+                                             "10.0.2.1"])
+        self.assertEqual(resolver.stats["glueless"], 1)
+
+    def test_async_glueless_referral(self):
+        transport = self.glueless_lookup()
+        resolver = Resolver(5, False, 0, True, transport=transport)
+        self.assertEqual(
+            asyncio.run(resolver.async_gethostbyname("a.example.com")),
+            ("a.example.com", [], ["1.2.3.4"]))
+        self.assertEqual(transport.servers, ["192.112.36.4", "192.112.36.4",
+                                             "10.0.2.1"])
+
+    def test_async_server_name(self):
+        transport = FakeTransport(self.answer("a.example.com", "1.2.3.4"))
+        resolver = Resolver(5, False, 0, True, transport=transport)
+        self.assertEqual(
+            asyncio.run(resolver.async_gethostbyname("a.example.com",
+                                                     "localhost")),
+            ("a.example.com", [], ["1.2.3.4"]))
+        self.assertEqual(transport.servers, ["127.0.0.1"])
+
+    def test_async_start_at_closest_zone(self):
+        transport = FakeTransport(
+            self.referral("com", "a.gtld-servers.net", "10.0.0.1"),
+            self.referral("example.com", "ns.example.com", "10.0.1.1"),
+            self.answer("a.example.com", "1.2.3.4"),
+            self.answer("b.example.com", "1.2.3.5"))
+        resolver = Resolver(5, True, 0, True, RecordCache(0),
+                            transport=transport)
+
+        async def lookups():
+            return [await resolver.async_gethostbyname("a.example.com"),
+                    await resolver.async_gethostbyname("b.example.com"),
+                    await resolver.async_gethostbyname("a.example.com")]
+
+        self.assertEqual(asyncio.run(lookups()), [
+            ("a.example.com", [], ["1.2.3.4"]),
+            ("b.example.com", [], ["1.2.3.5"]),
+            ("a.example.com", [], ["1.2.3.4"])])
+        self.assertEqual(transport.servers, ["192.112.36.4", "10.0.0.1",
+                                             "10.0.1.1", "10.0.1.1"])
+        self.assertEqual(resolver.gethostbyname("a.example.com"),
+                         ("a.example.com", [], ["1.2.3.4"]))
+
+    def test_async_many_lookups(self):
+        transport = EchoTransport()
+        resolver = Resolver(5, False, 0, True, transport=transport)
+        names = ["host{}.example.com".format(i) for i in range(1000)]
+
+        async def lookups():
+            return await asyncio.gather(*[
+                resolver.async_gethostbyname(name, "10.0.1.1")
+                for name in names + names[:10]])
+
+        results = asyncio.run(lookups())
+        self.assertEqual(results, [(name, [], ["1.2.3.4"])
+                                   for name in names + names[:10]])
+        self.assertEqual(len(transport.servers), 1000)
+        self.assertEqual(resolver.stats["coalesced"], 10)
+        self.assertEqual(resolver.async_flights, {})
+
+    def test_async_negative_cache_hit(self):
+        cache = RecordCache(0)
+        cache.add_negative("nx.example.com", Type.A, Class.IN,
+                           RCode.NXDomain, self.soa)
+        transport = FakeTransport()
+        resolver = Resolver(5, True, 0, True, cache, transport=transport)
+        self.assertEqual(
+            asyncio.run(resolver.async_gethostbyname("nx.example.com")),
+            ("nx.example.com", [], []))
+        self.assertEqual(transport.servers, [])
+
+    def test_async_race_all_silent(self):
+        resolver = Resolver(0.05, False, 0, True, stagger=0.01,
+                            transport=FakeTransport(None, None))
+        with self.assertRaises(socket.timeout):
+            asyncio.run(resolver.async_resolve("a.example.com",
+                                               ["10.0.1.1", "10.0.1.2"]))
+        self.assertEqual(resolver.stats["raced"], 1)
+        self.assertEqual(resolver.servers.table()["10.0.1.2"][1], 1)
@@ -4,7 +4,7 @@ from unittest.mock import MagicMock, patch
 
 from util import DNSTestCase
 
-from dns.resource import ResourceRecord, ARecordData
+from dns.resource import ResourceRecord, ARecordData, SOARecordData
 from dns.name import Name
 from dns.types import Type
 from dns.classes import Class
@@ -53,3 +53,18 @@ class RecordDataTestCase(DNSTestCase):
 
 class ARecordDataTestCase(DNSTestCase):
     pass
+
+
+class SOARecordDataTestCase(DNSTestCase):
+    def test_soa_bytes_roundtrip(self):
+        rdata = SOARecordData(Name("ns.example.com"), Name("admin.example.com"),
+                              1, 7200, 3600, 86400, 300)
+        data = rdata.to_bytes(0, {})
+        rdata2 = SOARecordData.from_bytes(data, 0, len(data))
+        self.assertEqual(rdata2.to_dict(), rdata.to_dict())
+
+    def test_soa_dict_roundtrip(self):
+        rdata = SOARecordData(Name("ns.example.com"), Name("admin.example.com"),
+                              1, 7200, 3600, 86400, 300)
+        rdata2 = SOARecordData.from_dict(rdata.to_dict())
+        self.assertEqual(rdata2.to_dict(), rdata.to_dict())
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import struct
+from unittest.mock import MagicMock, patch
+
+from util import DNSTestCase
+
+from dns.responsecache import ResponseCache, query_key, ttl_offsets
+from dns.message import Message, Header, Question
+from dns.resource import ResourceRecord, ARecordData, CNAMERecordData
+from dns.server import RequestHandler, Server
+from dns.name import Name
+from dns.types import Type
+from dns.classes import Class
+
+
+class ResponseCacheTestCase(DNSTestCase):
+    def query(self, ident, rd=1, name="www.example.com"):
+        header = Header(ident, 0, 1, 0, 0, 0)
+        header.rd = rd
+        return Message(header, [Question(Name(name), Type.A, Class.IN)])
+
+    def response(self, query):
+        header = Header(query.header.ident, 0, 1, 2, 0, 0)
+        header.qr = 1
+        header.rd = query.header.rd
+        header.ra = 1
+        answers = [
+            ResourceRecord(Name("www.example.com"), Type.CNAME, Class.IN, 600,
+                           CNAMERecordData(Name("example.com"))),
+            ResourceRecord(Name("example.com"), Type.A, Class.IN, 300,
+                           ARecordData("1.2.3.4"))]
+        return Message(header, query.questions, answers).to_bytes()
+
+    def test_query_key(self):
+        self.assertIsNotNone(query_key(self.query(1).to_bytes()))
+        self.assertEqual(query_key(self.query(1).to_bytes()),
+                         query_key(self.query(2).to_bytes()))
+        self.assertNotEqual(query_key(self.query(1, rd=1).to_bytes()),
+                            query_key(self.query(1, rd=0).to_bytes()))
+        response = self.response(self.query(1))
+        self.assertIsNone(query_key(response))
+        self.assertIsNone(query_key(b"\x00\x01"))
+
+    def test_ttl_offsets(self):
+        response = self.response(self.query(1))
+        offsets = ttl_offsets(response)
+        self.assertEqual([ttl for _, ttl in offsets], [600, 300])
+        for offset, ttl in offsets:
+            self.assertEqual(struct.unpack_from("!I", response, offset)[0],
+                             ttl)
+
+    def test_hit_patches_id_and_ttl(self):
+        cache = ResponseCache()
+        query = self.query(1)
+        with patch("dns.responsecache.time.time", return_value=1000.0):
+            cache.put(query.to_bytes(), self.response(query))
+        with patch("dns.responsecache.time.time", return_value=1100.0):
+            data = cache.get(self.query(4242).to_bytes())
+        response = Message.from_bytes(data)
+        self.assertEqual(response.header.ident, 4242)
+        self.assertEqual([rr.ttl for rr in response.answers], [500, 200])
+        with patch("dns.responsecache.time.time", return_value=1300.0):
+            self.assertIsNone(cache.get(self.query(4242).to_bytes()))
+
+    def test_miss(self):
+        cache = ResponseCache()
+        query = self.query(1)
+        cache.put(query.to_bytes(), self.response(query))
+        self.assertIsNone(cache.get(self.query(1, rd=0).to_bytes()))
+        self.assertIsNone(cache.get(
+            self.query(1, name="example.com").to_bytes()))
+
+    def test_bounded(self):
+        cache = ResponseCache(max_entries=1)
+        for name in ("a.example.com", "b.example.com"):
+            query = self.query(1, name=name)
+            cache.put(query.to_bytes(), self.response(query))
+        self.assertEqual(len(cache), 1)
+
+    def test_request_handler_fast_path(self):
+        server = Server(5353, True, 0)
+        query = self.query(1)
+        server.responses.put(query.to_bytes(), self.response(query))
+        sock = MagicMock()
+        handler = RequestHandler(self.query(7).to_bytes(), ("127.0.0.1", 5000),
+                                 None, sock, server)
+        handler.run()
+        data, addr = sock.sendto.call_args[0]
+        self.assertEqual(Message.from_bytes(data).header.ident, 7)
+        self.assertEqual(addr, ("127.0.0.1", 5000))
+        self.assertEqual(server.stats["response_cache_hits"], 1)
+        self.assertEqual(server.qtypes[Type.A], 1)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import time
+from unittest.mock import patch
+
+from util import DNSTestCase
+
+from dns.cache import RecordCache
+from dns.rtt import RTTTable
+
+
+class RTTTableTestCase(DNSTestCase):
+    def setUp(self):
+        self.table = RTTTable(smoothing=0.5, half_life=100, explore=0)
+
+    def test_smoothing(self):
+        self.table.record("10.0.0.1", 0.1)
+        self.assertAlmostEqual(self.table.score("10.0.0.1"), 0.1, 3)
+        self.table.record("10.0.0.1", 0.3)
+        self.assertAlmostEqual(self.table.score("10.0.0.1"), 0.2, 3)
+        self.assertIsNone(self.table.score("10.0.0.2"))
+
+    def test_timeout_penalty(self):
+        self.table.record("10.0.0.1", 0.1)
+        self.table.timeout("10.0.0.1", 0.05)
+        self.assertAlmostEqual(self.table.score("10.0.0.1"), 0.2, 3)
+        self.table.timeout("10.0.0.1", 2)
+        self.assertAlmostEqual(self.table.score("10.0.0.1"), 2, 3)
+        self.assertEqual(self.table.table()["10.0.0.1"][1], 2)
+
+    def test_error_penalty(self):
+        self.table.record("10.0.0.1", 0.01)
+        self.table.record("10.0.0.2", 0.1)
+        self.table.error("10.0.0.1")
+        self.assertAlmostEqual(self.table.score("10.0.0.1"), 1, 3)
+        self.assertEqual(self.table.choose(["10.0.0.1", "10.0.0.2"]),
+                         ["10.0.0.2", "10.0.0.1"])
+        self.table.error("10.0.0.1")
+        self.assertAlmostEqual(self.table.score("10.0.0.1"), 2, 3)
+
+    def test_decay(self):
+        self.table.record("10.0.0.1", 0.4)
+        later = time.time() + 200
+        self.assertAlmostEqual(self.table.score("10.0.0.1", later), 0.1, 3)
+
+    def test_choose_fastest(self):
+        self.table.record("10.0.0.1", 0.3)
+        self.table.record("10.0.0.2", 0.1)
+        self.table.timeout("10.0.0.3", 1)
+        self.assertEqual(self.table.choose(["10.0.0.1", "10.0.0.2",
+                                            "10.0.0.3"]),
+                         ["10.0.0.2", "10.0.0.1", "10.0.0.3"])
+        self.assertEqual(self.table.choose(["10.0.0.3", "10.0.0.4"]),
+                         ["10.0.0.4", "10.0.0.3"])
+
+    def test_explore(self):
+        table = RTTTable(explore=1)
+        table.record("10.0.0.1", 0.1)
+        table.record("10.0.0.2", 0.2)
+        with patch("dns.rtt.random.randrange", return_value=1):
+            self.assertEqual(table.choose(["10.0.0.1", "10.0.0.2"]),
+                             ["10.0.0.2", "10.0.0.1"])
+
+    def test_persisted_with_cache(self):
+        self.table.record("10.0.0.1", 0.1)
+        self.table.timeout("10.0.0.2", 1)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "cache")
+            cache = RecordCache(0, filename)
+            cache.attach(".rtt", self.table)
+            cache.write_cache_file()
+            self.assertTrue(os.path.exists(filename + ".rtt"))
+
+            other = RTTTable()
+            cache = RecordCache(0, filename)
+            cache.attach(".rtt", other)
+            cache.read_cache_file()
+            self.assertEqual(sorted(other.table()), ["10.0.0.1", "10.0.0.2"])
+            self.assertAlmostEqual(other.score("10.0.0.1"), 0.1, 3)
+            self.assertEqual(other.table()["10.0.0.2"][1], 1)
+
+    def test_damaged_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "rtt")
+            with open(filename, "w") as file_:
+                file_.write("[1, 2")
+            self.table.read_file(filename)
+            self.table.read_file(os.path.join(tmpdir, "missing"))
+        self.assertEqual(len(self.table), 0)
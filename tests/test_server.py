@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+
+import os
+import socket
+import tempfile
+import time
+from collections import Counter
+from threading import Event, Thread
+from unittest.mock import MagicMock
+
+from util import DNSTestCase
+
+from dns.server import BufferPool, RequestHandler, Server, WorkerPool
+from dns.server import AdmissionControl, TCPConnection, truncate
+from dns.tcp import recv_message, send_message
+from dns.message import Message, Header, Question
+from dns.name import Name
+from dns.rcodes import RCode
+from dns.types import Type
+from dns.classes import Class
+from dns.resource import ResourceRecord, GenericRecordData, ARecordData
+from dns.resource import SOARecordData, CNAMERecordData
+from dns.zone import Zone
+
+
+class ChaosTestCase(DNSTestCase):
+    def setUp(self):
+        self.server = Server(5353, True, 0)
+
+    def ask(self, name, qtype=Type.TXT):
+        header = Header(1234, 0, 1, 0, 0, 0)
+        query = Message(header, [Question(Name(name), qtype, Class.CH)])
+        sock = MagicMock()
+        handler = RequestHandler(query.to_bytes(), ("127.0.0.1", 5000), None,
+                                 sock, self.server)
+        handler.run()
+        return Message.from_bytes(sock.sendto.call_args[0][0])
+
+    def texts(self, response):
+        return [rr.rdata.data[1:].decode() for rr in response.answers]
+
+    def test_single_counter(self):
+        self.server.cache.stats["hits"] = 42
+        response = self.ask("hits.cache.")
+        self.assertEqual(response.header.ident, 1234)
+        self.assertEqual(response.header.rcode, RCode.NoError)
+        self.assertEqual(self.texts(response), ["42"])
+        self.assertEqual(response.answers[0].class_, Class.CH)
+
+    def test_stats_bind(self):
+        self.server.cache.stats["hits"] = 42
+        texts = self.texts(self.ask("stats.bind."))
+        self.assertIn("cache.hits=42", texts)
+        self.assertIn("cache.entries=0", texts)
+        self.assertIn("server.queries=1", texts)
+        self.assertIn("server.qtype.TXT=1", texts)
+
+    def test_counter_before_traffic(self):
+        for name in ("hits.cache.", "prefetches.cache.", "shed.server.",
+                     "glueless.resolver.", "qtype.aaaa.server."):
+            response = self.ask(name)
+            self.assertEqual(response.header.rcode, RCode.NoError)
+            self.assertEqual(self.texts(response), ["0"])
+
+    def test_qtype_counter(self):
+        self.server.qtypes[Type.MX] = 3
+        self.server.qtypes[65] = 2
+        self.assertEqual(self.texts(self.ask("qtype.mx.server.")), ["3"])
+        self.assertEqual(self.texts(self.ask("qtype.type65.server.")), ["2"])
+
+    def test_server_rtt(self):
+        self.server.resolver.servers.record("10.0.0.1", 0.05)
+        self.server.resolver.servers.timeout("10.0.0.1", 0.1)
+        srtt = int(self.texts(self.ask("10.0.0.1.srtt_ms.rtt."))[0])
+        self.assertGreater(srtt, 0)
+        self.assertEqual(self.texts(self.ask("10.0.0.1.timeouts.rtt.")),
+                         ["1"])
+        texts = self.texts(self.ask("stats.bind."))
+        self.assertIn("rtt.10.0.0.1.srtt_ms={}".format(srtt), texts)
+
+    def test_unknown_counter(self):
+        response = self.ask("nothing.cache.")
+        self.assertEqual(response.header.rcode, RCode.NXDomain)
+        self.assertEqual(response.answers, [])
+
+    def test_other_qtype(self):
+        self.server.cache.stats["hits"] = 42
+        response = self.ask("hits.cache.", Type.A)
+        self.assertEqual(response.header.rcode, RCode.NoError)
+        self.assertEqual(response.answers, [])
+
+
+class WorkerPoolTestCase(DNSTestCase):
+    def query(self):
+        header = Header(4321, 0, 1, 0, 0, 0)
+        header.rd = 1
+        return Message(header, [Question(Name("example.com."), Type.A,
+                                         Class.IN)]).to_bytes()
+
+    def test_full_queue(self):
+        pool = WorkerPool(1, 2, Counter())
+        self.assertTrue(pool.submit(MagicMock()))
+        self.assertTrue(pool.submit(MagicMock()))
+        self.assertFalse(pool.submit(MagicMock()))
+
+    def test_workers_run_handlers(self):
+        pool = WorkerPool(2, 10, Counter())
+        done = Event()
+        handler = MagicMock()
+        handler.run.side_effect = done.set
+        pool.start()
+        pool.submit(handler)
+        self.assertTrue(done.wait(5))
+        pool.shutdown()
+        self.assertEqual(pool.workers, [])
+
+    def test_failing_handler(self):
+        stats = Counter()
+        pool = WorkerPool(1, 10, stats)
+        handler = MagicMock()
+        handler.run.side_effect = ValueError
+        pool.start()
+        pool.submit(handler)
+        pool.shutdown()
+        self.assertEqual(stats["errors"], 1)
+        handler.servfail.assert_called_once_with()
+
+    def test_failing_servfail(self):
+        stats = Counter()
+        pool = WorkerPool(1, 10, stats)
+        failing = MagicMock()
+        failing.run.side_effect = ValueError
+        failing.servfail.side_effect = OSError
+        done = Event()
+        handler = MagicMock()
+        handler.run.side_effect = done.set
+        pool.start()
+        pool.submit(failing)
+        pool.submit(failing)
+        pool.submit(handler)
+        self.assertTrue(done.wait(5))
+        pool.shutdown()
+        self.assertEqual(stats["errors"], 2)
+
+    def test_shutdown_timeout(self):
+        pool = WorkerPool(1, 10, Counter())
+        release = Event()
+        handler = MagicMock()
+        handler.run.side_effect = release.wait
+        pool.start()
+        pool.submit(handler)
+        self.assertFalse(pool.shutdown(0.1))
+        release.set()
+        self.assertTrue(pool.shutdown(5))
+
+    def test_servfail(self):
+        sock = MagicMock()
+        handler = RequestHandler(self.query(), ("127.0.0.1", 5000), None,
+                                 sock, Server(5353, False, 0))
+        handler.servfail()
+        response = Message.from_bytes(sock.sendto.call_args[0][0])
+        self.assertEqual(response.header.ident, 4321)
+        self.assertEqual(response.header.qr, 1)
+        self.assertEqual(response.header.rd, 1)
+        self.assertEqual(response.header.rcode, RCode.ServFail)
+        self.assertEqual(response.questions[0].qname, Name("example.com."))
+
+    def test_servfail_garbage(self):
+        sock = MagicMock()
+        handler = RequestHandler(b"\x01\x02", ("127.0.0.1", 5000), None,
+                                 sock, Server(5353, False, 0))
+        handler.servfail()
+        sock.sendto.assert_not_called()
+
+
+class BufferPoolTestCase(DNSTestCase):
+    def test_reuse(self):
+        pool = BufferPool(512, 1)
+        buffer = pool.get()
+        self.assertEqual(len(buffer), 512)
+        pool.put(buffer)
+        self.assertIs(pool.get(), buffer)
+
+    def test_bounded(self):
+        pool = BufferPool(512, 1)
+        first, second = pool.get(), pool.get()
+        pool.put(first)
+        pool.put(second)
+        self.assertEqual(len(pool.free), 1)
+
+    def test_handler_releases_buffer(self):
+        server = Server(5353, False, 0)
+        header = Header(1234, 0, 1, 0, 0, 0)
+        query = Message(header, [Question(Name("queries.server."), Type.TXT,
+                                          Class.CH)]).to_bytes()
+        buffer = server.buffers.get()
+        buffer[:len(query)] = query
+        sock = MagicMock()
+        handler = RequestHandler(memoryview(buffer)[:len(query)],
+                                 ("127.0.0.1", 5000), None, sock, server,
+                                 buffer)
+        handler.run()
+        handler.close()
+        response = Message.from_bytes(sock.sendto.call_args[0][0])
+        self.assertEqual(response.answers[0].rdata.data, b"\x011")
+        self.assertIs(server.buffers.get(), buffer)
+
+
+class TCPTestCase(DNSTestCase):
+    def query(self, ident, name):
+        header = Header(ident, 0, 1, 0, 0, 0)
+        return Message(header, [Question(Name(name), Type.TXT, Class.CH)]) \
+            .to_bytes()
+
+    def test_truncate(self):
+        header = Header(1234, 0, 1, 1, 0, 0)
+        header.qr = 1
+        question = Question(Name("example.com."), Type.TXT, Class.IN)
+        answer = ResourceRecord(Name("example.com."), Type.TXT, Class.IN, 60,
+                                GenericRecordData(bytes(600)))
+        response = Message.from_bytes(truncate(
+            Message(header, [question], [answer]).to_bytes()))
+        self.assertEqual(response.header.ident, 1234)
+        self.assertEqual(response.header.tc, 1)
+        self.assertEqual(response.questions[0].qname, Name("example.com."))
+        self.assertEqual(response.answers, [])
+
+    def test_udp_truncated(self):
+        server = Server(5353, False, 0)
+        for i in range(5):
+            server.stats["x" * 200 + str(i)] = 1
+        sock = MagicMock()
+        handler = RequestHandler(self.query(1, "stats.bind."),
+                                 ("127.0.0.1", 5000), None, sock, server)
+        handler.run()
+        response = Message.from_bytes(sock.sendto.call_args[0][0])
+        self.assertEqual(response.header.tc, 1)
+        self.assertEqual(server.stats["truncated"], 1)
+
+    def test_pipelined_queries(self):
+        server = Server(5353, False, 0, workers=2)
+        for i in range(5):
+            server.stats["x" * 200 + str(i)] = 1
+        server.pool.start()
+        self.addCleanup(server.pool.shutdown)
+        client, conn = socket.socketpair()
+        self.addCleanup(client.close)
+        server.tcp_slots.acquire()
+        connection = TCPConnection(conn, ("127.0.0.1", 5000), server)
+        send_message(client, self.query(1, "stats.bind."))
+        send_message(client, self.query(2, "queries.server."))
+        client.shutdown(socket.SHUT_WR)
+        connection.serve()
+        responses = {}
+        while True:
+            data = recv_message(client)
+            if data is None:
+                break
+            response = Message.from_bytes(data)
+            responses[response.header.ident] = response
+        self.assertEqual(sorted(responses), [1, 2])
+        self.assertEqual(responses[1].header.tc, 0)
+        self.assertEqual(server.stats["tcp_queries"], 2)
+        self.assertEqual(server.stats["truncated"], 0)
+
+
+class RateLimitTestCase(DNSTestCase):
+    def test_slipped_response(self):
+        server = Server(5353, False, 0, rate_limit=1, slip=1)
+        header = Header(1234, 0, 1, 0, 0, 0)
+        header.rd = 1
+        query = Message(header, [Question(Name("example.com."), Type.A,
+                                          Class.IN)]).to_bytes()
+        sock = MagicMock()
+        handlers = [RequestHandler(query, ("10.0.0.1", 5000), None, sock,
+                                   server) for _ in range(2)]
+        self.assertFalse(server.limited(handlers[0]))
+        self.assertTrue(server.limited(handlers[1]))
+        response = Message.from_bytes(sock.sendto.call_args[0][0])
+        self.assertEqual(response.header.ident, 1234)
+        self.assertEqual(response.header.tc, 1)
+        self.assertEqual(response.header.rcode, RCode.NoError)
+        self.assertEqual(response.questions[0].qname, Name("example.com."))
+        self.assertEqual(server.stats["rate_limited"], 1)
+        self.assertEqual(server.stats["slipped"], 1)
+
+    def test_disabled(self):
+        server = Server(5353, False, 0)
+        handler = RequestHandler(b"", ("10.0.0.1", 5000), None, MagicMock(),
+                                 server)
+        self.assertFalse(server.limited(handler))
+
+
+class AdmissionTestCase(DNSTestCase):
+    def setUp(self):
+        self.server = Server(5353, True, 0, shed_delay=0.05)
+        self.server.resolver.resolve = MagicMock(
+            return_value=("example.com.", [], ["10.0.0.9"]))
+        self.server.admission.delay = 1.0
+
+    def ask(self, name):
+        header = Header(1234, 0, 1, 0, 0, 0)
+        header.rd = 1
+        query = Message(header, [Question(Name(name), Type.A, Class.IN)])
+        sock = MagicMock()
+        RequestHandler(query.to_bytes(), ("127.0.0.1", 5000), Zone(), sock,
+                       self.server).run()
+        return Message.from_bytes(sock.sendto.call_args[0][0])
+
+    def test_record(self):
+        admission = AdmissionControl(0.05)
+        admission.record(time.monotonic() - 1)
+        self.assertAlmostEqual(admission.delay, 0.1, 2)
+        self.assertTrue(admission.overloaded())
+        self.assertFalse(AdmissionControl(0).overloaded())
+
+    def test_shed_cache_miss(self):
+        response = self.ask("example.com.")
+        self.assertEqual(response.header.rcode, RCode.ServFail)
+        self.assertEqual(self.server.stats["shed"], 1)
+        self.server.resolver.resolve.assert_not_called()
+
+    def test_answer_cache_hit(self):
+        self.server.cache.add_record(ResourceRecord(
+            Name("example.com."), Type.A, Class.IN, 60,
+            ARecordData("10.0.0.1")))
+        response = self.ask("example.com.")
+        self.assertEqual(response.header.rcode, RCode.NoError)
+        self.assertEqual(response.answers[0].rdata.address, "10.0.0.1")
+        self.assertEqual(self.server.stats["shed"], 0)
+        self.assertEqual(self.server.stats["shed_cache_answers"], 1)
+
+    def test_not_overloaded(self):
+        self.server.admission.delay = 0
+        response = self.ask("example.com.")
+        self.assertEqual(response.answers[0].rdata.address, "10.0.0.9")
+        self.assertEqual(self.server.stats["shed"], 0)
+
+    def test_statistics(self):
+        self.assertEqual(self.server.statistics()["server.queue_delay_ms"],
+                         1000)
+
+
+class RecursiveTestCase(DNSTestCase):
+    def setUp(self):
+        self.server = Server(5353, True, 0)
+        self.server.responses = None
+        self.server.resolver.resolve = MagicMock(side_effect=self.resolve)
+
+    def resolve(self, hostname, dnsserv):
+        self.server.cache.add_record(ResourceRecord(
+            Name("www.example.com."), Type.CNAME, Class.IN, 300,
+            CNAMERecordData(Name("example.com."))))
+        self.server.cache.add_record(ResourceRecord(
+            Name("example.com."), Type.A, Class.IN, 60,
+            ARecordData("10.0.0.9")))
+        return "www.example.com.", ["example.com."], ["10.0.0.9"]
+
+    def ask(self, name):
+        header = Header(1234, 0, 1, 0, 0, 0)
+        header.rd = 1
+        query = Message(header, [Question(Name(name), Type.A, Class.IN)])
+        sock = MagicMock()
+        RequestHandler(query.to_bytes(), ("127.0.0.1", 5000), Zone(), sock,
+                       self.server).run()
+        return Message.from_bytes(sock.sendto.call_args[0][0])
+
+    def test_cname_from_cache(self):
+        first = self.ask("www.example.com.")
+        second = self.ask("www.example.com.")
+        self.server.resolver.resolve.assert_called_once()
+        for response in (first, second):
+            cname, address = response.answers
+            self.assertEqual(cname.type_, Type.CNAME)
+            self.assertEqual(str(cname.rdata.cname), "example.com.")
+            self.assertGreater(cname.ttl, 250)
+            self.assertEqual(str(address.name), "example.com.")
+            self.assertEqual(address.rdata.address, "10.0.0.9")
+            self.assertGreater(address.ttl, 0)
+
+
+class AuthoritativeTestCase(DNSTestCase):
+    def setUp(self):
+        self.zone = Zone()
+        self.zone.add_record(ResourceRecord(
+            Name("example.com."), Type.SOA, Class.IN, 3600,
+            SOARecordData(Name("ns.example.com."), Name("admin.example.com."),
+                          1, 7200, 3600, 86400, 300)))
+        self.zone.add_record(ResourceRecord(
+            Name("www.example.com."), Type.A, Class.IN, 300,
+            ARecordData("10.0.0.1")))
+        self.zone.compile()
+        self.server = Server(5353, False, 0)
+        self.server.resolver = MagicMock()
+
+    def ask(self, query):
+        sock = MagicMock()
+        RequestHandler(query, ("127.0.0.1", 5000), self.zone, sock,
+                       self.server).run()
+        return Message.from_bytes(sock.sendto.call_args[0][0])
+
+    def test_fast_path(self):
+        header = Header(1234, 0, 1, 0, 0, 0)
+        query = Message(header, [Question(Name("www.example.com."), Type.A,
+                                          Class.IN)]).to_bytes()
+        response = self.ask(query)
+        self.assertEqual(response.answers[0].rdata.address, "10.0.0.1")
+        self.assertEqual(self.server.stats["authoritative"], 1)
+        self.assertEqual(self.server.qtypes[Type.A], 1)
+        self.server.resolver.gethostbyname.assert_not_called()
+
+    def test_parsed_path(self):
+        header = Header(1234, 0, 2, 0, 0, 0)
+        header.rd = 1
+        query = Message(header, [
+            Question(Name("www.example.com."), Type.A, Class.IN),
+            Question(Name("www.example.com."), Type.A, Class.IN)]).to_bytes()
+        response = self.ask(query)
+        self.assertEqual(response.header.ident, 1234)
+        self.assertEqual(response.header.rd, 1)
+        self.assertEqual(response.answers[0].rdata.address, "10.0.0.1")
+        self.server.resolver.gethostbyname.assert_not_called()
+
+
+class LifecycleTestCase(DNSTestCase):
+    def query(self, ident, name):
+        header = Header(ident, 0, 1, 0, 0, 0)
+        return Message(header, [Question(Name(name), Type.TXT,
+                                         Class.CH)]).to_bytes()
+
+    def start(self, server):
+        thread = Thread(target=server.serve, daemon=True)
+        thread.start()
+        deadline = time.time() + 5
+        while server.sock is None:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+        return thread
+
+    def test_shutdown_drains_queries(self):
+        server = Server(0, False, 0, workers=1)
+        server.cache = MagicMock()
+        thread = self.start(server)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(client.close)
+        client.settimeout(5)
+        for ident in range(5):
+            client.sendto(self.query(ident, "queries.server."),
+                          server.sock.getsockname())
+        server.shutdown()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        idents = sorted(Message.from_bytes(client.recv(512)).header.ident
+                        for _ in range(5))
+        self.assertEqual(idents, list(range(5)))
+        server.cache.shutdown.assert_called_once_with()
+
+    def test_stale_shared_cache(self):
+        with self.assertRaises(ValueError):
+            Server(5353, True, 0, shared_cache="/nonexistent/cache",
+                   stale=600)
+
+    def test_shutdown_before_serve(self):
+        server = Server(0, False, 0, workers=1)
+        server.shutdown()
+        thread = self.start(server)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_reload(self):
+        soa = ("example.com. 3600 SOA ns.example.com. admin.example.com. "
+               "1 7200 3600 86400 300\n")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "zone")
+            with open(filename, "w") as file_:
+                file_.write(soa + "www.example.com. 300 A 10.0.0.1\n")
+            server = Server(5353, False, 0, zone_file=filename)
+            server.responses = MagicMock()
+            server.setup()
+
+            with open(filename, "w") as file_:
+                file_.write(soa + "www.example.com. 300 A 10.0.0.2\n")
+            self.assertTrue(server.reload())
+            address = server.zone.records["www.example.com."][0].rdata.address
+            self.assertEqual(address, "10.0.0.2")
+            server.responses.clear.assert_called_once_with()
+
+            zone = server.zone
+            with open(filename, "w") as file_:
+                file_.write("www.example.com. 300 A 10.0.0.3\n")
+            self.assertFalse(server.reload())
+            self.assertIs(server.zone, zone)
+            self.assertEqual(server.stats["zone_reloads"], 1)
+            self.assertEqual(server.stats["zone_reload_errors"], 1)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+from unittest.mock import patch
+
+from util import DNSTestCase
+
+from dns.shmcache import SharedRecordCache
+from dns.resource import ResourceRecord, ARecordData, SOARecordData
+from dns.resource import GenericRecordData
+from dns.name import Name
+from dns.rcodes import RCode
+from dns.types import Type
+from dns.classes import Class
+
+
+class SharedRecordCacheTestCase(DNSTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, "shm")
+        self.cache = SharedRecordCache(0, self.filename, max_entries=64)
+        self.cache.start()
+
+    def tearDown(self):
+        self.cache.shutdown()
+        self.tmpdir.cleanup()
+
+    def record(self, name, address, ttl=300):
+        return ResourceRecord(Name(name), Type.A, Class.IN, ttl,
+                              ARecordData(address))
+
+    def test_lookup(self):
+        self.cache.add_record(self.record("Example.com", "1.2.3.4"))
+        self.cache.add_record(self.record("example.com", "1.2.3.5"))
+        self.cache.add_record(self.record("example.com", "1.2.3.4"))
+        found = self.cache.lookup("example.COM", Type.A, Class.IN)
+        self.assertEqual(sorted(rr.rdata.address for rr in found),
+                         ["1.2.3.4", "1.2.3.5"])
+        self.assertEqual(self.cache.lookup("example.com", Type.NS, Class.IN),
+                         [])
+        self.assertEqual(len(self.cache), 1)
+
+    def test_ttl_decremented(self):
+        with patch("dns.shmcache.time.time", return_value=1000.0):
+            self.cache.add_record(self.record("example.com", "1.2.3.4"))
+        with patch("dns.shmcache.time.time", return_value=1100.0):
+            found = self.cache.lookup("example.com", Type.A, Class.IN)
+        self.assertEqual([rr.ttl for rr in found], [200])
+        with patch("dns.shmcache.time.time", return_value=1300.0):
+            found = self.cache.lookup("example.com", Type.A, Class.IN)
+        self.assertEqual(found, [])
+
+    def test_negative(self):
+        soa = ResourceRecord(
+            Name("example.com"), Type.SOA, Class.IN, 3600,
+            SOARecordData(Name("ns.example.com"), Name("admin.example.com"),
+                          1, 7200, 3600, 86400, 300))
+        self.cache.add_record(self.record("nx.example.com", "1.2.3.4"))
+        self.cache.add_negative("nx.example.com", Type.A, Class.IN,
+                                RCode.NXDomain, soa)
+        rcode, soa = self.cache.lookup_negative("nx.example.com", Type.A,
+                                                Class.IN)
+        self.assertEqual(rcode, RCode.NXDomain)
+        self.assertLessEqual(soa.ttl, 300)
+        self.assertEqual(self.cache.lookup("nx.example.com", Type.A, Class.IN),
+                         [])
+
+    def test_shared_between_mappings(self):
+        other = SharedRecordCache(0, self.filename, max_entries=64)
+        other.start()
+        try:
+            other.add_record(ResourceRecord(
+                Name("example.com"), Type.TXT, Class.IN, 300,
+                GenericRecordData(b"\x05hello")))
+            found = self.cache.lookup("example.com", Type.TXT, Class.IN)
+            self.assertEqual([rr.rdata.data for rr in found], [b"\x05hello"])
+        finally:
+            other.shutdown()
+
+    def test_bucket_full(self):
+        cache = SharedRecordCache(0, self.filename + "2", max_entries=2,
+                                  slots=2)
+        cache.start()
+        try:
+            for i in range(5):
+                cache.add_record(self.record("h{}.example.com".format(i),
+                                             "1.2.3.4", 300 + i))
+            self.assertEqual(len(cache), 2)
+            self.assertTrue(cache.lookup("h4.example.com", Type.A, Class.IN))
+        finally:
+            cache.shutdown()
+
+    def test_other_size_in_use(self):
+        ready_r, ready_w = os.pipe()
+        done_r, done_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(ready_r)
+                os.close(done_w)
+                cache = SharedRecordCache(0, self.filename + "2",
+                                          max_entries=64)
+                cache.start()
+                os.write(ready_w, b"x")
+                os.read(done_r, 1)
+            finally:
+                os._exit(0)
+        os.close(ready_w)
+        os.close(done_r)
+        try:
+            os.read(ready_r, 1)
+            other = SharedRecordCache(0, self.filename + "2",
+                                      max_entries=128)
+            with self.assertRaises(ValueError):
+                other.start()
+            self.assertIsNone(other.fd)
+        finally:
+            os.write(done_w, b"x")
+            os.waitpid(pid, 0)
+            os.close(ready_r)
+            os.close(done_w)
+        other.start()
+        other.add_record(self.record("example.com", "1.2.3.4"))
+        self.assertTrue(other.lookup("example.com", Type.A, Class.IN))
+        other.shutdown()
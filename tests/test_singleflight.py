@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import time
+from threading import Event, Thread
+
+from util import DNSTestCase
+
+from dns.singleflight import SingleFlight
+
+
+class SingleFlightTestCase(DNSTestCase):
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.release = Event()
+        self.calls = 0
+
+    def slow(self, value):
+        self.calls += 1
+        self.release.wait(5)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def start(self, key, value, results):
+        def call():
+            try:
+                results.append(self.flights.do(key, self.slow, value))
+            except Exception as error:
+                results.append(error)
+        thread = Thread(target=call)
+        thread.start()
+        return thread
+
+    def wait_for_waiters(self, count):
+        deadline = time.time() + 5
+        while self.flights.stats["coalesced"] < count:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def test_coalesce(self):
+        results = []
+        threads = [self.start("key", 42, results)]
+        while not self.flights.flights:
+            time.sleep(0.01)
+        threads += [self.start("key", 43, results) for _ in range(3)]
+        self.wait_for_waiters(3)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [42] * 4)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(len(self.flights), 0)
+
+    def test_different_keys(self):
+        self.release.set()
+        self.assertEqual(self.flights.do("a", self.slow, 1), 1)
+        self.assertEqual(self.flights.do("b", self.slow, 2), 2)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(self.flights.stats["coalesced"], 0)
+
+    def test_error_shared(self):
+        error = OSError("timeout")
+        results = []
+        threads = [self.start("key", error, results)]
+        while not self.flights.flights:
+            time.sleep(0.01)
+        threads.append(self.start("key", 1, results))
+        self.wait_for_waiters(1)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [error, error])
+        self.assertEqual(len(self.flights), 0)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+
+from util import DNSTestCase
+
+from dns.snapshot import Snapshot, SnapshotWriter, POSITIVE, NEGATIVE
+from dns.resource import ResourceRecord, ARecordData, GenericRecordData
+from dns.resource import SOARecordData
+from dns.name import Name
+from dns.rcodes import RCode
+from dns.types import Type
+from dns.classes import Class
+
+
+class SnapshotTestCase(DNSTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, "cache")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_find(self):
+        writer = SnapshotWriter()
+        for i in range(50):
+            record = ResourceRecord(Name("h{}.example.com".format(i)), Type.A,
+                                    Class.IN, 300, ARecordData("10.0.0.1"))
+            writer.add_record(("h{}.example.com.".format(i), Type.A, Class.IN),
+                              1000.0 + i, record)
+        writer.write(self.filename)
+        snapshot = Snapshot.open(self.filename)
+        found = snapshot.find(("h7.example.com.", Type.A, Class.IN))
+        self.assertEqual(len(found), 1)
+        expires, kind, record = found[0]
+        self.assertEqual(expires, 1007.0)
+        self.assertEqual(kind, POSITIVE)
+        self.assertEqual(str(record.name), "h7.example.com.")
+        self.assertEqual(record.rdata.address, "10.0.0.1")
+        self.assertEqual(snapshot.find(("h7.example.com.", Type.NS, Class.IN)),
+                         [])
+        self.assertEqual(len(list(snapshot)), 50)
+
+    def test_empty(self):
+        SnapshotWriter().write(self.filename)
+        snapshot = Snapshot.open(self.filename)
+        self.assertEqual(list(snapshot), [])
+        self.assertEqual(snapshot.find(("example.com.", Type.A, Class.IN)),
+                         [])
+
+    def test_generic_record(self):
+        record = ResourceRecord(Name("example.com"), Type.TXT, Class.IN, 300,
+                                GenericRecordData(b"\x05hello"))
+        writer = SnapshotWriter()
+        writer.add_record(("example.com.", Type.TXT, Class.IN), 1000.0, record)
+        writer.write(self.filename)
+        snapshot = Snapshot.open(self.filename)
+        _, _, record = snapshot.find(("example.com.", Type.TXT, Class.IN))[0]
+        self.assertEqual(record.rdata.data, b"\x05hello")
+
+    def test_negative(self):
+        soa = ResourceRecord(
+            Name("example.com"), Type.SOA, Class.IN, 3600,
+            SOARecordData(Name("ns.example.com"), Name("admin.example.com"),
+                          1, 7200, 3600, 86400, 300))
+        writer = SnapshotWriter()
+        writer.add_negative(("nx.example.com.", Type.A, Class.IN), 1000.0,
+                            RCode.NXDomain, soa)
+        writer.write(self.filename)
+        snapshot = Snapshot.open(self.filename)
+        _, kind, (rcode, soa) = snapshot.find(
+            ("nx.example.com.", Type.A, Class.IN))[0]
+        self.assertEqual(kind, NEGATIVE)
+        self.assertEqual(rcode, RCode.NXDomain)
+        self.assertEqual(soa.rdata.minimum, 300)
+
+    def test_not_a_snapshot(self):
+        with open(self.filename, "w") as file_:
+            file_.write("[]")
+        with self.assertRaises(ValueError):
+            Snapshot.open(self.filename)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import os
+import signal
+import time
+
+from util import DNSTestCase
+
+import dns.supervisor
+from dns.supervisor import Supervisor
+
+
+class FakeServer:
+    def __init__(self, crash=False):
+        self.crash = crash
+
+    def statistics(self):
+        return {"server.queries": 5, "cache.entries": 1}
+
+    def handle_signals(self):
+        pass
+
+    def serve(self):
+        if self.crash:
+            raise OSError("can not bind")
+        time.sleep(60)
+
+
+class SupervisorTestCase(DNSTestCase):
+    def setUp(self):
+        self.supervisor = None
+
+    def tearDown(self):
+        if self.supervisor is not None:
+            self.supervisor.stop()
+
+    def poll_until(self, condition):
+        deadline = time.time() + 10
+        while not condition():
+            self.assertLess(time.time(), deadline)
+            self.supervisor.poll(0.05)
+
+    def test_collects_statistics(self):
+        self.supervisor = Supervisor(FakeServer, 2, interval=0.05)
+        self.supervisor.start()
+        self.poll_until(lambda:
+                        self.supervisor.statistics().get("server.queries") == 10)
+        stats = self.supervisor.statistics()
+        self.assertEqual(stats["supervisor.workers"], 2)
+        self.assertEqual(stats["cache.entries"], 2)
+
+    def test_restarts_killed_worker(self):
+        self.supervisor = Supervisor(FakeServer, 2, interval=0.05)
+        self.supervisor.start()
+        self.poll_until(lambda: all(worker.stats for worker
+                                    in self.supervisor.children.values()))
+        os.kill(next(iter(self.supervisor.children)), signal.SIGKILL)
+        self.poll_until(lambda: self.supervisor.stats["restarts"] == 1)
+        self.assertEqual(len(self.supervisor.children), 2)
+        self.assertEqual(sorted(worker.index for worker
+                                in self.supervisor.children.values()), [0, 1])
+        self.poll_until(lambda:
+                        self.supervisor.statistics()["server.queries"] == 15)
+        self.assertEqual(self.supervisor.statistics()["cache.entries"], 2)
+
+    def test_delays_crashing_worker(self):
+        delay = dns.supervisor.RESTART_DELAY
+        dns.supervisor.RESTART_DELAY = 0.3
+        try:
+            self.supervisor = Supervisor(lambda: FakeServer(True), 1,
+                                         interval=0.05)
+            self.supervisor.start()
+            self.poll_until(lambda: self.supervisor.restarts)
+            self.assertEqual(self.supervisor.stats["restarts"], 0)
+            self.poll_until(lambda: self.supervisor.stats["restarts"] == 1)
+        finally:
+            dns.supervisor.RESTART_DELAY = delay
+
+    def test_stop(self):
+        self.supervisor = Supervisor(FakeServer, 2, interval=0.05)
+        self.supervisor.start()
+        self.supervisor.stop()
+        self.assertEqual(self.supervisor.children, {})
+        self.supervisor.poll(0.01)
+        self.assertEqual(self.supervisor.children, {})
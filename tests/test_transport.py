@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import socket
+import struct
+from queue import Queue
+from threading import Thread
+
+from util import DNSTestCase
+
+from dns.classes import Class
+from dns.message import Message, Header, Question
+from dns.name import Name
+from dns.transport import Transport
+from dns.types import Type
+
+
+class TransportTestCase(DNSTestCase):
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.settimeout(5)
+        self.transport = Transport(sockets=2,
+                                   port=self.server.getsockname()[1])
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.close()
+
+    def query(self, name):
+        header = Header(9001, 0, 1, 0, 0, 0)
+        return Message(header, [Question(Name(name), Type.A,
+                                         Class.IN)]).to_bytes()
+
+    def test_routes_responses(self):
+        replies = Queue()
+        first = self.transport.send(self.query("a.example.com"), "127.0.0.1",
+                                    replies)
+        second = self.transport.send(self.query("b.example.com"),
+                                     "127.0.0.1", replies)
+        received = [self.server.recvfrom(512) for _ in range(2)]
+        self.assertNotEqual(received[0][1], received[1][1])
+        for data, addr in reversed(received):
+            self.server.sendto(data[:2] + b"\x80\x00" + data[4:], addr)
+        replies_by_query = {replies.get(timeout=5) for _ in range(2)}
+        self.assertEqual(replies_by_query, {first, second})
+        self.assertEqual(Message.from_bytes(first.response).questions[0]
+                         .qname, Name("a.example.com"))
+        self.assertGreaterEqual(first.rtt(), 0)
+        self.assertEqual(len(self.transport), 0)
+
+    def test_random_ids(self):
+        replies = Queue()
+        idents = set()
+        for _ in range(20):
+            self.transport.send(self.query("example.com"), "127.0.0.1",
+                                replies)
+            data, _ = self.server.recvfrom(512)
+            idents.add(struct.unpack_from("!H", data)[0])
+        self.assertGreater(len(idents), 1)
+        self.assertNotIn(9001, idents)
+        self.assertEqual(len(self.transport), 20)
+
+    def test_drops_mismatched_responses(self):
+        replies = Queue()
+        pending = self.transport.send(self.query("a.example.com"),
+                                      "127.0.0.1", replies)
+        data, addr = self.server.recvfrom(512)
+        other = self.query("b.example.com")
+        wrong_id = bytes([data[0] ^ 1, data[1]]) + data[2:]
+        self.server.sendto(wrong_id, addr)
+        self.server.sendto(data[:2] + other[2:], addr)
+        stranger = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(stranger.close)
+        stranger.sendto(data, addr)
+        self.server.sendto(data, addr)
+        self.assertIs(replies.get(timeout=5), pending)
+        self.assertEqual(self.transport.stats["unmatched"], 3)
+
+    def test_cancel(self):
+        replies = Queue()
+        pending = self.transport.send(self.query("a.example.com"),
+                                      "127.0.0.1", replies)
+        self.transport.cancel(pending)
+        self.assertEqual(len(self.transport), 0)
+        data, addr = self.server.recvfrom(512)
+        self.server.sendto(data, addr)
+        follow = self.transport.send(self.query("b.example.com"),
+                                     "127.0.0.1", replies)
+        data, addr = self.server.recvfrom(512)
+        self.server.sendto(data, addr)
+        self.assertIs(replies.get(timeout=5), follow)
+        self.assertEqual(self.transport.stats["unmatched"], 1)
+
+    def test_concurrent_senders(self):
+        replies = Queue()
+
+        def echo():
+            for _ in range(200):
+                data, addr = self.server.recvfrom(512)
+                self.server.sendto(data, addr)
+        thread = Thread(target=echo)
+        thread.start()
+        senders = [Thread(target=lambda: [
+            self.transport.send(self.query("example.com"), "127.0.0.1",
+                                replies) for _ in range(50)])
+            for _ in range(4)]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+        thread.join(5)
+        self.assertEqual(len({replies.get(timeout=5) for _ in range(200)}),
+                         200)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+
+from util import DNSTestCase
+
+from dns.classes import Class
+from dns.message import Message, Header, Question
+from dns.name import Name
+from dns.rcodes import RCode
+from dns.types import Type
+from dns.zone import Zone
+
+
+ZONE = """; example zone
+example.com. 3600 IN SOA ns1.example.com. admin.example.com. (
+        1 7200 3600 86400 300 )
+             3600 NS ns1.example.com.
+ns1.example.com. 3600 A 10.0.0.1
+www.example.com. IN 300 A 10.0.0.2 ; two addresses
+             A 10.0.0.3
+alias.example.com. 300 CNAME www.example.com.
+out.example.com. 300 CNAME www.example.org.
+a.b.example.com. 300 A 10.0.0.4
+sub.example.com. 3600 NS ns.sub.example.com.
+ns.sub.example.com. 3600 A 10.0.1.1
+v6.example.com. 300 AAAA ::1
+"""
+
+
+class ZoneTestCase(DNSTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.zone = self.read(ZONE)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read(self, text):
+        filename = os.path.join(self.tmpdir.name, "zone")
+        with open(filename, "w") as file_:
+            file_.write(text)
+        zone = Zone()
+        zone.read_master_file(filename)
+        return zone
+
+    def ask(self, name, qtype=Type.A, rd=1):
+        header = Header(4321, 0, 1, 0, 0, 0)
+        header.rd = rd
+        query = Message(header, [Question(Name(name), qtype, Class.IN)])
+        response = self.zone.answer(query.to_bytes())
+        return None if response is None else Message.from_bytes(response)
+
+    def addresses(self, records):
+        return sorted(rr.rdata.address for rr in records
+                      if rr.type_ == Type.A)
+
+    def test_read(self):
+        self.assertEqual(self.zone.origin, "example.com.")
+        www = self.zone.records["www.example.com."]
+        self.assertEqual([rr.ttl for rr in www], [300, 300])
+        self.assertEqual(self.zone.records["example.com."][1].ttl, 3600)
+        self.assertNotIn("v6.example.com.", self.zone.records)
+
+    def test_answer(self):
+        response = self.ask("WWW.Example.com.")
+        self.assertEqual(response.header.ident, 4321)
+        self.assertEqual(response.header.aa, 1)
+        self.assertEqual(response.header.rd, 1)
+        self.assertEqual(response.header.rcode, RCode.NoError)
+        self.assertEqual(response.questions[0].qname.labels,
+                         ["WWW", "Example", "com"])
+        self.assertEqual(self.addresses(response.answers),
+                         ["10.0.0.2", "10.0.0.3"])
+        self.assertEqual(self.ask("www.example.com.", rd=0).header.rd, 0)
+
+    def test_cname_chain(self):
+        response = self.ask("alias.example.com.")
+        self.assertEqual(response.answers[0].type_, Type.CNAME)
+        self.assertEqual(self.addresses(response.answers),
+                         ["10.0.0.2", "10.0.0.3"])
+        response = self.ask("out.example.com.")
+        self.assertEqual([rr.type_ for rr in response.answers], [Type.CNAME])
+
+    def test_nxdomain(self):
+        response = self.ask("nope.example.com.")
+        self.assertEqual(response.header.rcode, RCode.NXDomain)
+        self.assertEqual(response.header.aa, 1)
+        self.assertEqual(response.authorities[0].type_, Type.SOA)
+        self.assertEqual(response.authorities[0].ttl, 300)
+
+    def test_nodata(self):
+        for name, qtype in (("www.example.com.", Type.MX),
+                            ("b.example.com.", Type.A)):
+            response = self.ask(name, qtype)
+            self.assertEqual(response.header.rcode, RCode.NoError)
+            self.assertEqual(response.answers, [])
+            self.assertEqual(response.authorities[0].type_, Type.SOA)
+
+    def test_ns_with_glue(self):
+        response = self.ask("example.com.", Type.NS)
+        self.assertEqual(response.answers[0].rdata.nsdname,
+                         Name("ns1.example.com."))
+        self.assertEqual(self.addresses(response.additionals), ["10.0.0.1"])
+
+    def test_referral(self):
+        response = self.ask("host.sub.example.com.")
+        self.assertEqual(response.header.aa, 0)
+        self.assertEqual(response.header.rcode, RCode.NoError)
+        self.assertEqual(response.answers, [])
+        self.assertEqual(response.authorities[0].rdata.nsdname,
+                         Name("ns.sub.example.com."))
+        self.assertEqual(self.addresses(response.additionals), ["10.0.1.1"])
+
+    def test_outside_zone(self):
+        self.assertIsNone(self.ask("www.example.org."))
+        self.assertIsNone(Zone().answer(b"\x00" * 17))
+
+    def test_invalid_zones(self):
+        soa = ("example.com. 3600 SOA ns1.example.com. admin.example.com. "
+               "1 7200 3600 86400 300\n")
+        for text in ("www.example.com. 300 A 10.0.0.1\n",
+                     soa + "www.example.org. 300 A 10.0.0.1\n",
+                     soa + "sub.example.com. 300 NS ns.sub.example.com.\n",
+                     soa + "sub.example.com. 300 NS ns.example.net.\n"
+                           "www.sub.example.com. 300 A 10.0.0.1\n",
+                     soa + "www.example.com. 300 A\n",
+                     soa + "www.example.com. A 10.0.0.1 (\n"):
+            with self.assertRaises(ValueError):
+                self.read(text)